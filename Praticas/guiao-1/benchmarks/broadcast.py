@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: CPU cost of a channel broadcast as the channel grows.
+                  Compares re-encoding the message per recipient (legacy
+                  CDProto.send_msg loop) with Server.broadcast (encode once).
+
+ Usage: python3 -m benchmarks.broadcast [--rounds 200] [--sizes 1 10 100 1000]
+ '''
+
+import argparse
+import json
+import logging
+import resource
+import selectors
+import socket
+import time
+
+from src.protocol import CDProto
+from src.server import Server, DEFAULT_CHANNEL
+
+
+class Listener:
+    """Stands in for the listening socket, handing over a socketpair end."""
+
+    def __init__(self, conn):
+        self.conns = [conn]
+
+    def accept(self):
+        if not self.conns:
+            raise BlockingIOError()
+        return self.conns.pop(), ("local", 0)
+
+
+def attach_clients(server, count):
+    """Connect count socketpairs to the server, returning the client ends."""
+    clients = []
+    for _ in range(count):
+        client, conn = socket.socketpair()
+        server.handle_new_connection(Listener(conn), selectors.EVENT_READ)
+        client.sendall(CDProto.encode(CDProto.register("bench")))
+        server.handle_client(conn, selectors.EVENT_READ)
+        client.setblocking(False)
+        clients.append(client)
+    return clients
+
+
+def drain(clients):
+    for client in clients:
+        try:
+            while client.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def legacy_broadcast(server, message):
+    """Pre encode-once fan-out: one json.dumps + header per recipient."""
+    for conn in server.channels.members(DEFAULT_CHANNEL):
+        CDProto.send_msg(conn, message)
+
+
+def encode_once_broadcast(server, message):
+    """Server.broadcast plus the end-of-wake-up flush."""
+    server.broadcast(DEFAULT_CHANNEL, message)
+    server.flush_pending()
+
+
+def measure(server, clients, rounds, fanout):
+    message = CDProto.message("Hello World " * 8, DEFAULT_CHANNEL)
+    elapsed = 0.0
+    for _ in range(rounds):
+        start = time.process_time()
+        fanout(server, message)
+        elapsed += time.process_time() - start
+        drain(clients)
+    return elapsed / rounds
+
+
+def main(rounds, sizes):
+    logging.disable(logging.CRITICAL) # measure the fan-out only
+
+    # Each client needs two descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for size in sizes:
+        server = Server(host="127.0.0.1", port=0)
+        clients = attach_clients(server, size)
+
+        legacy = measure(server, clients, rounds, legacy_broadcast)
+        once = measure(server, clients, rounds, encode_once_broadcast)
+        results.append({
+            "recipients": size,
+            "legacy_us": legacy * 1e6,
+            "encode_once_us": once * 1e6,
+            "legacy_us_per_recipient": legacy * 1e6 / size,
+            "encode_once_us_per_recipient": once * 1e6 / size,
+        })
+
+        for client in clients:
+            client.close()
+        for key in list(server.sel.get_map().values()):
+            key.fileobj.close()
+        server.sel.close()
+
+    print(f"{'N':>6} {'legacy us':>12} {'once us':>12} {'legacy/N':>10} {'once/N':>10}")
+    for r in results:
+        print(f"{r['recipients']:>6} {r['legacy_us']:>12.1f} {r['encode_once_us']:>12.1f} "
+              f"{r['legacy_us_per_recipient']:>10.2f} {r['encode_once_us_per_recipient']:>10.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    main(args.rounds, args.sizes)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Load generator for the multi-process chat server.
+                  Starts server.py with 1, 2, 4, ... workers and measures
+                  delivered messages per second from several client processes.
+
+ Usage: python3 -m benchmarks.cluster_scaling [--workers 1 2 4] [--procs 4]
+            [--conns 50] [--channels 20] [--duration 5]
+ '''
+
+import argparse
+import json
+import multiprocessing
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from src.protocol import CDProto, HEADER_SIZE
+from src.transport import OutboundQueue
+
+BURST = 10 # messages queued per connection when its queue is low
+LOW_WATER = 16 * 1024
+
+
+class FrameCounter:
+    """Counts CDProto frames in a byte stream without decoding them."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+
+    def feed(self, data):
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= HEADER_SIZE:
+            size = int.from_bytes(self.buffer[offset:offset + HEADER_SIZE], "big")
+            if len(self.buffer) - offset - HEADER_SIZE < size:
+                break
+            offset += HEADER_SIZE + size
+            self.frames += 1
+        del self.buffer[:offset]
+
+
+def load_worker(port, conns, channels, duration, offset, results):
+    """Client process: conns connections publishing as fast as they can."""
+    sel = selectors.DefaultSelector()
+    burst = {}
+    for i in range(conns):
+        sock = socket.create_connection(("127.0.0.1", port))
+        channel = f"#{(offset + i) % channels}"
+        sock.sendall(CDProto.encode(CDProto.register(f"load{offset + i}"))
+                     + CDProto.encode(CDProto.join(channel)))
+        sock.setblocking(False)
+        burst[sock] = CDProto.encode(CDProto.message("x" * 64, channel)) * BURST
+        sel.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                     (OutboundQueue(), FrameCounter()))
+
+    sent = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for key, mask in sel.select(timeout=0.1):
+            queue, counter = key.data
+            if mask & selectors.EVENT_READ:
+                counter.feed(key.fileobj.recv(1 << 16))
+            if mask & selectors.EVENT_WRITE:
+                if queue.size < LOW_WATER:
+                    queue.push(burst[key.fileobj])
+                    sent += BURST
+                queue.flush(key.fileobj)
+
+    received = sum(key.data[1].frames for key in sel.get_map().values())
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    results.put((sent, received))
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def run(workers, procs, conns, channels, duration, port):
+    server = subprocess.Popen([sys.executable, "server.py", "--workers", str(workers),
+                               "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=load_worker,
+                                           args=(port, conns, channels, duration, i * conns, results))
+                   for i in range(procs)]
+        for client in clients:
+            client.start()
+        totals = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    sent = sum(t[0] for t in totals)
+    received = sum(t[1] for t in totals)
+    return {"workers": workers, "sent": sent, "delivered": received,
+            "delivered_per_s": received / duration}
+
+
+def main(args):
+    results = []
+    for workers in args.workers:
+        results.append(run(workers, args.procs, args.conns, args.channels,
+                           args.duration, args.port))
+        base = results[0]["delivered_per_s"] or 1
+        r = results[-1]
+        print(f"workers={workers:<3} delivered/s={r['delivered_per_s']:>10.0f} "
+              f"speedup={r['delivered_per_s'] / base:.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--procs", type=int, default=4, help="load generator processes")
+    parser.add_argument("--conns", type=int, default=50, help="connections per process")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--port", type=int, default=8899)
+
+    main(parser.parse_args())
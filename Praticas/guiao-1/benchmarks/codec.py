@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: CDProto codec microbenchmark: encode/decode ns per message
+                  and bytes per message, JSON vs binary.
+
+ Usage: python3 -m benchmarks.codec [--number 100000]
+ '''
+
+import argparse
+import json
+import timeit
+
+from src.protocol import CDProto, CODECS
+
+MESSAGES = {
+    "register": CDProto.register("student"),
+    "join": CDProto.join("#cd"),
+    "message": CDProto.message("Hello World, how are you doing today?", "#cd"),
+}
+
+
+def main(number):
+    results = []
+    for name, message in MESSAGES.items():
+        for codec in CODECS:
+            frame = CDProto.encode(message, codec)
+            payload = frame[2:]
+            encode = timeit.timeit(lambda: CDProto.encode(message, codec), number=number)
+            decode = timeit.timeit(lambda: CDProto.decode(payload, codec), number=number)
+            results.append({
+                "message": name, "codec": codec, "bytes": len(frame),
+                "encode_ns": encode / number * 1e9, "decode_ns": decode / number * 1e9,
+            })
+
+    print(f"{'message':<10} {'codec':<7} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+    for r in results:
+        print(f"{r['message']:<10} {r['codec']:<7} {r['bytes']:>6} "
+              f"{r['encode_ns']:>10.0f} {r['decode_ns']:>10.0f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    main(parser.parse_args().number)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Large messages with the varint framing (FRAMING_V2).
+                  A sender broadcasts messages of 1 KiB, 64 KiB and 10 MiB
+                  to a few receivers, one at a time, while two bystanders
+                  chat in another channel. Reports the time to deliver each
+                  message to every receiver, the payload throughput and the
+                  bystanders' latency, with the server writing at most
+                  --write-budget bytes per client per wake-up (0: as much as
+                  the kernel takes).
+
+ Usage: python3 -m benchmarks.large_payload [--sizes 1024 65536 10485760]
+            [--receivers 4] [--codec json|binary] [--write-budget 1048576 0]
+ '''
+
+import argparse
+import json
+import multiprocessing
+import selectors
+import socket
+import time
+
+from benchmarks.cluster_scaling import wait_for_port
+from benchmarks.loadgen import percentile
+from src.protocol import CDProto, CDProtoReader, CODECS, FRAMING_V2
+from src.server import Server
+from src.transport import OutboundQueue, TcpPolicy, set_tcp_policy
+
+TOTAL_BYTES = 64 * 1024 * 1024 # payload bytes sent per size (3 to 1000 messages)
+CHAT_INTERVAL = 0.001 # seconds between bystander messages
+
+
+class FrameCounter:
+    """Counts FRAMING_V2 frames in a byte stream without decoding them."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+
+    def feed(self, data):
+        self.buffer += data
+        offset = 0
+        while True:
+            size = shift = 0
+            start = offset
+            while start < len(self.buffer):
+                byte = self.buffer[start]
+                start += 1
+                size |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            else:
+                break # Incomplete header
+            if len(self.buffer) < start + size:
+                break
+            offset = start + size
+            self.frames += 1
+        del self.buffer[:offset]
+
+
+class Peer:
+    """Benchmark client registered with FRAMING_V2."""
+
+    def __init__(self, port, name, channel, codec, decode=False):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        set_tcp_policy(self.sock, TcpPolicy.NODELAY)
+        self.sock.sendall(CDProto.encode(CDProto.register(name, codec, FRAMING_V2))
+                          + CDProto.encode(CDProto.join(channel), codec, FRAMING_V2))
+        self.sock.setblocking(False)
+        self.codec = codec
+        self.channel = channel
+        self.queue = OutboundQueue()
+        # Only the bystanders decode (timestamps), the others count frames
+        self.reader = CDProtoReader(codec, FRAMING_V2) if decode else FrameCounter()
+
+
+def serve(port, budget):
+    Server(host="127.0.0.1", port=port, max_write_bytes=budget).loop()
+
+
+def run(size, receivers, codec, budget, port):
+    server = multiprocessing.get_context("fork").Process(target=serve, args=(port, budget))
+    server.start()
+    try:
+        wait_for_port(port)
+        return measure(size, receivers, codec, port)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def measure(size, receivers, codec, port):
+    sender = Peer(port, "sender", "#big", codec)
+    targets = [Peer(port, f"receiver{i}", "#big", codec) for i in range(receivers)]
+    chatter = Peer(port, "chatter", "#chat", codec, decode=True)
+    listener = Peer(port, "listener", "#chat", codec, decode=True)
+    time.sleep(0.2) # joins processed
+
+    sel = selectors.DefaultSelector()
+    for peer in [sender, chatter, listener] + targets:
+        sel.register(peer.sock, selectors.EVENT_READ, peer)
+
+    def flush(peer):
+        drained = peer.queue.flush(peer.sock)
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if sel.get_key(peer.sock).events != events:
+            sel.modify(peer.sock, events, peer)
+
+    count = max(3, min(1000, TOTAL_BYTES // size))
+    frame = CDProto.encode(CDProto.message("x" * size, "#big"), codec, FRAMING_V2)
+    transfers = []
+    latencies = []
+    pending = None # receivers still missing the current message
+    start = next_chat = time.monotonic()
+    while len(transfers) < count:
+        now = time.monotonic()
+        if pending is None: # One message at a time: time to reach everyone
+            pending = {peer: peer.reader.frames + 1 for peer in targets}
+            sent_at = now
+            sender.queue.push(frame)
+            flush(sender)
+        if now >= next_chat:
+            chatter.queue.push(CDProto.encode(CDProto.message("hello", "#chat"), codec, FRAMING_V2))
+            flush(chatter)
+            next_chat += CHAT_INTERVAL
+
+        for key, mask in sel.select(max(0.0, next_chat - time.monotonic())):
+            peer = key.data
+            if mask & selectors.EVENT_WRITE:
+                flush(peer)
+            if not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = peer.sock.recv(1 << 20)
+            except BlockingIOError:
+                continue
+            received = time.time()
+            if peer is listener:
+                latencies.extend(received - m.data["ts"] for m in peer.reader.feed(data))
+            elif peer is chatter:
+                for _ in peer.reader.feed(data):
+                    pass # Its own messages
+            else:
+                peer.reader.feed(data)
+                if pending and peer in pending and peer.reader.frames >= pending[peer]:
+                    del pending[peer]
+                    if not pending:
+                        transfers.append(time.monotonic() - sent_at)
+                        pending = None
+    elapsed = time.monotonic() - start
+
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+
+    transfers.sort()
+    latencies.sort()
+    return {
+        "size": size,
+        "messages": count,
+        "transfer_ms_p50": percentile(transfers, 0.50) * 1000,
+        "transfer_ms_max": transfers[-1] * 1000,
+        "throughput_MBps": size * count * receivers / elapsed / 1e6,
+        "bystander_ms_p50": percentile(latencies, 0.50) * 1000,
+        "bystander_ms_p99": percentile(latencies, 0.99) * 1000,
+        "bystander_ms_max": latencies[-1] * 1000,
+    }
+
+
+def main(args):
+    results = []
+    print(f"{'budget':>8} {'size':>9} {'msgs':>5} {'xfer p50':>9} {'MB/s':>8} "
+          f"{'chat p50':>9} {'chat p99':>9} {'chat max':>9}")
+    for budget in args.write_budget:
+        for size in args.sizes:
+            r = run(size, args.receivers, args.codec, budget, args.port)
+            r.update(codec=args.codec, receivers=args.receivers, write_budget=budget)
+            results.append(r)
+            print(f"{budget:>8} {size:>9} {r['messages']:>5} {r['transfer_ms_p50']:>9.2f} "
+                  f"{r['throughput_MBps']:>8.1f} {r['bystander_ms_p50']:>9.2f} "
+                  f"{r['bystander_ms_p99']:>9.2f} {r['bystander_ms_max']:>9.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 64 * 1024, 10 * 1024 * 1024])
+    parser.add_argument("--receivers", type=int, default=4)
+    parser.add_argument("--codec", choices=list(CODECS), default="json")
+    parser.add_argument("--write-budget", type=int, nargs="+", default=[1024 * 1024, 0],
+                        help="max_write_bytes of the server (0: unbounded)")
+    parser.add_argument("--port", type=int, default=8897)
+
+    main(parser.parse_args())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Chat server load generator and latency benchmark.
+                  Starts server.py (or targets a running server), opens many
+                  CDProto connections spread over channels, publishes at a
+                  target rate and reports throughput and end-to-end latency
+                  (from the ts field of every delivered TextMessage) as JSON.
+
+ Usage: python3 -m benchmarks.loadgen [--clients 2000] [--channels 100]
+            [--rate 2000] [--duration 10] [--warmup 2] [--procs 2]
+            [--codec json|binary] [--engine selectors|asyncio] [--workers 1]
+            [--target host:port] [--output results.json]
+ '''
+
+import argparse
+import json
+import multiprocessing
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from src.protocol import CDProto, CDProtoBadFormat, CDProtoReader, PingMessage, TextMessage, CODECS
+from src.transport import OutboundQueue, TcpPolicy, set_tcp_policy
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+class LoadClient:
+    """One simulated chat client (non-blocking, pipelined writes)."""
+
+    def __init__(self, host, port, name, channel, codec):
+        self.channel = channel
+        self.codec = codec
+        self.sock = socket.create_connection((host, port))
+        set_tcp_policy(self.sock, TcpPolicy.NODELAY)
+        self.sock.sendall(CDProto.encode(CDProto.register(name, codec))
+                          + CDProto.encode(CDProto.join(channel), codec))
+        self.sock.setblocking(False)
+        self.reader = CDProtoReader(codec)
+        self.queue = OutboundQueue()
+        self.closed = False
+
+
+def load_process(host, port, first, count, channels, codec, rate, payload,
+                 duration, warmup, results):
+    """Body of a load generator process: count clients, rate msgs/s."""
+    sel = selectors.DefaultSelector()
+    clients = []
+    for i in range(first, first + count):
+        client = LoadClient(host, port, f"load{i}", f"#{i % channels}", codec)
+        sel.register(client.sock, selectors.EVENT_READ, client)
+        clients.append(client)
+
+    text = "x" * payload
+    latencies = []
+    published = delivered = errors = 0
+    start = time.time()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    turn = 0
+
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+
+        # Publish what is due so far (open loop: independent of replies)
+        due = int((now - start) * rate) - published
+        touched = {}
+        for _ in range(due):
+            client = clients[turn % len(clients)]
+            turn += 1
+            client.queue.push(CDProto.encode(TextMessage(text, client.channel), client.codec))
+            touched[client] = None
+            published += 1
+        for client in touched:
+            if client.closed:
+                continue
+            try:
+                if not client.queue.flush(client.sock):
+                    sel.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            except OSError:
+                errors += 1
+                client.closed = True
+                sel.unregister(client.sock)
+
+        for key, mask in sel.select(timeout=0.001):
+            client = key.data
+            try:
+                if mask & selectors.EVENT_WRITE and client.queue.flush(client.sock):
+                    sel.modify(client.sock, selectors.EVENT_READ, client)
+                data = client.sock.recv(1 << 16) if mask & selectors.EVENT_READ else None
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b""
+
+            if data == b"": # Disconnected by the server
+                errors += 1
+                client.closed = True
+                sel.unregister(client.sock)
+                continue
+            if not data:
+                continue
+
+            received = time.time()
+            try:
+                for message in client.reader.feed(data):
+                    if isinstance(message, TextMessage) and received >= measure_from:
+                        latencies.append(received - message.data["ts"])
+                        delivered += 1
+                    elif isinstance(message, PingMessage): # Idle long enough to be pinged
+                        client.queue.push(CDProto.encode(CDProto.pong(), client.codec))
+                        if not client.queue.flush(client.sock):
+                            sel.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            except CDProtoBadFormat:
+                errors += 1
+            except OSError:
+                pass # Reported by the next recv
+
+    for client in clients:
+        client.sock.close()
+    results.put({"published": published, "delivered": delivered,
+                 "errors": errors, "latencies": latencies})
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def run(args):
+    # Each client needs a descriptor (two when the server runs here)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = None
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", args.port
+        server = subprocess.Popen(
+            [sys.executable, "server.py", "--engine", args.engine,
+             "--workers", str(args.workers), "--port", str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(host, port)
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        per_proc = args.clients // args.procs
+        procs = [ctx.Process(target=load_process, args=(
+                    host, port, i * per_proc, per_proc, args.channels, args.codec,
+                    args.rate / args.procs, args.payload, args.duration,
+                    args.warmup, results))
+                 for i in range(args.procs)]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(l for t in totals for l in t["latencies"])
+    elapsed = args.warmup + args.duration
+    ms = lambda value: None if value is None else value * 1000
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "published_per_s": sum(t["published"] for t in totals) / elapsed,
+        "delivered_per_s": sum(t["delivered"] for t in totals) / args.duration,
+        "errors": sum(t["errors"] for t in totals),
+        "latency_ms": {
+            "samples": len(latencies),
+            "p50": ms(percentile(latencies, 0.50)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=2000, help="published messages/s (total)")
+    parser.add_argument("--payload", type=int, default=64, help="message text length")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--procs", type=int, default=2, help="load generator processes")
+    parser.add_argument("--codec", choices=list(CODECS), default="json")
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8898)
+    parser.add_argument("--target", help="host:port of a running server (not started here)")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result)
+    print(result)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Cost of logging in the server message loop.
+                  Feeds text messages to a Server with a few channel members
+                  and reports microseconds per message with logging off, with
+                  the former synchronous DEBUG file log, with the queue-based
+                  log (formatted in a background thread) and with sampling.
+
+ Usage: python3 -m benchmarks.logging_overhead [--messages 20000] [--members 10]
+            [--sample 100]
+ '''
+
+import argparse
+import json
+import logging
+import os
+import selectors
+import tempfile
+import time
+
+from benchmarks.broadcast import attach_clients, drain
+from src.logs import setup_logging, stop_logging
+from src.protocol import CDProto
+from src.server import Server, DEFAULT_CHANNEL
+
+BATCH = 50 # messages read per wake-up
+
+
+def run(messages, members, sample):
+    """Seconds the server spends handling messages (one wake-up per BATCH)."""
+    server = Server(host="127.0.0.1", port=0, log_sample=sample)
+    clients = attach_clients(server, members + 1)
+    sender, conn = clients[0], list(server.channels.members(DEFAULT_CHANNEL))[0]
+    frames = CDProto.encode(CDProto.message("Hello World " * 8, DEFAULT_CHANNEL)) * BATCH
+
+    elapsed = 0.0
+    for _ in range(messages // BATCH):
+        sender.sendall(frames)
+        start = time.perf_counter()
+        server.handle_client(conn, selectors.EVENT_READ)
+        server.flush_pending()
+        elapsed += time.perf_counter() - start
+        drain(clients)
+
+    for client in clients:
+        client.close()
+    for key in list(server.sel.get_map().values()):
+        key.fileobj.close()
+    server.sel.close()
+    return elapsed
+
+
+def measure(name, messages, members, sample=1, handler=None):
+    root = logging.getLogger()
+    start = time.perf_counter()
+    elapsed = run(messages, members, sample)
+    stop_logging() # the queued records are written here
+    total = time.perf_counter() - start
+    if handler is not None:
+        root.removeHandler(handler)
+        handler.close()
+    return {"config": name, "us_per_message": elapsed / messages * 1e6,
+            "total_s": total}
+
+
+def main(messages, members, sample):
+    root = logging.getLogger()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "server.log")
+    results = []
+
+    root.setLevel(logging.INFO) # Message events are DEBUG
+    results.append(measure("off", messages, members))
+
+    root.setLevel(logging.DEBUG) # Former logging.basicConfig(level=DEBUG)
+    handler = logging.FileHandler(path)
+    root.addHandler(handler)
+    results.append(measure("sync", messages, members, handler=handler))
+
+    handler = setup_logging(path, logging.DEBUG)
+    results.append(measure("queue", messages, members, handler=handler))
+
+    handler = setup_logging(path, logging.DEBUG)
+    results.append(measure(f"queue 1/{sample}", messages, members, sample, handler))
+
+    os.remove(path)
+    os.rmdir(directory)
+
+    base = results[0]["us_per_message"]
+    print(f"{'config':>12} {'us/msg':>10} {'vs off':>8} {'total s':>9}")
+    for r in results:
+        print(f"{r['config']:>12} {r['us_per_message']:>10.2f} "
+              f"{r['us_per_message'] / base:>7.2f}x {r['total_s']:>9.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--members", type=int, default=10, help="channel members besides the sender")
+    parser.add_argument("--sample", type=int, default=100)
+    args = parser.parse_args()
+
+    main(args.messages, args.members, args.sample)
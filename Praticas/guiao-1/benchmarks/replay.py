@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Replays a recording of chat traffic (server.py --record)
+                  against a running server: one connection per recorded
+                  connection, at the recorded pace (--speed 1), N times
+                  faster or as fast as possible (--speed max). Reports the
+                  achieved throughput, how late messages went out compared
+                  to the recording and the end-to-end latency, as JSON.
+
+ Usage: python3 -m benchmarks.replay traffic.rec [--speed 1|N|max]
+            [--target host:port] [--procs 1] [--linger 1] [--output results.json]
+ '''
+
+import argparse
+import json
+import multiprocessing
+import resource
+import selectors
+import socket
+import time
+
+from benchmarks.loadgen import percentile
+from src.protocol import (CDProto, CDProtoBadFormat, CDProtoReader, PingMessage,
+                          RegisterMessage, TextMessage, JSON, FRAMING_V1)
+from src.recording import DATA, CLOSE, read_recording
+from src.transport import OutboundQueue, TcpPolicy, set_tcp_policy
+
+
+class ReplayConnection:
+    """One recorded client, played back."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        set_tcp_policy(self.sock, TcpPolicy.NODELAY)
+        self.sock.setblocking(False)
+        self.upstream = CDProtoReader()   # recorded bytes (client -> server)
+        self.downstream = CDProtoReader() # what the server sends back
+        self.codec = JSON
+        self.framing = FRAMING_V1
+        self.queue = OutboundQueue()
+        self.closing = False # recorded close: half-close once drained
+        self.shut = False
+
+
+def replay_process(host, port, records, speed, start_at, linger, results):
+    """Body of a replay process: plays records (one slice of the connections)."""
+    sel = selectors.DefaultSelector()
+    conns = {} # recorded connection id -> ReplayConnection
+    lags = []
+    latencies = []
+    sent = delivered = errors = 0
+
+    def flush(conn):
+        nonlocal errors
+        try:
+            drained = conn.queue.flush(conn.sock)
+            if drained and conn.closing and not conn.shut:
+                conn.sock.shutdown(socket.SHUT_WR) # the server closes in turn
+                conn.shut = True
+        except OSError:
+            errors += 1
+            drop(conn)
+            return
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if sel.get_key(conn.sock).events != events:
+            sel.modify(conn.sock, events, conn)
+
+    def drop(conn):
+        sel.unregister(conn.sock)
+        conn.sock.close()
+        for conn_id, other in list(conns.items()):
+            if other is conn:
+                del conns[conn_id]
+
+    # Same start for every process, whatever the time it took to fork
+    start = time.monotonic() + (start_at - time.time())
+    while time.monotonic() < start:
+        time.sleep(start - time.monotonic())
+
+    index = 0
+    finished = None
+    while True:
+        now = time.monotonic()
+
+        # Send what is due (open loop: independent of the server replies)
+        touched = {}
+        while index < len(records):
+            record = records[index]
+            due = start + record.offset / speed if speed else now
+            if due > now:
+                break
+            index += 1
+            lags.append(now - due)
+
+            conn = conns.get(record.conn)
+            if record.kind == DATA:
+                if conn is None:
+                    try:
+                        conn = conns[record.conn] = ReplayConnection(host, port)
+                    except OSError:
+                        errors += 1
+                        continue
+                    sel.register(conn.sock, selectors.EVENT_READ, conn)
+                try:
+                    for message in conn.upstream.feed(record.data):
+                        if isinstance(message, TextMessage):
+                            message.data["ts"] = round(time.time(), 6) # latency of this run
+                        conn.queue.push(CDProto.encode(message, conn.codec, conn.framing))
+                        sent += 1
+                        if isinstance(message, RegisterMessage):
+                            conn.codec = conn.upstream.codec = conn.downstream.codec = message.codec
+                            conn.framing = conn.upstream.framing = conn.downstream.framing = message.framing
+                except CDProtoBadFormat:
+                    errors += 1 # Recorded as is, the server disconnected it too
+                    conn.closing = True
+                touched[conn] = None
+            elif record.kind == CLOSE and conn is not None:
+                conn.closing = True
+                touched[conn] = None
+
+        for conn in touched:
+            if conn.sock.fileno() != -1:
+                flush(conn)
+
+        if index == len(records):
+            if finished is None:
+                finished = time.monotonic()
+            if not conns or time.monotonic() >= finished + linger:
+                break
+            timeout = 0.01
+        else:
+            timeout = max(0.0, start + records[index].offset / speed - now) if speed else 0
+
+        for key, mask in sel.select(timeout):
+            conn = key.data
+            if mask & selectors.EVENT_WRITE:
+                flush(conn)
+                if conn.sock.fileno() == -1:
+                    continue
+            if not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = conn.sock.recv(1 << 16)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b""
+            if not data: # Closed by the server
+                drop(conn)
+                continue
+
+            received = time.time()
+            try:
+                for message in conn.downstream.feed(data):
+                    if isinstance(message, TextMessage):
+                        latencies.append(received - message.data["ts"])
+                        delivered += 1
+                    elif isinstance(message, PingMessage):
+                        conn.queue.push(CDProto.encode(CDProto.pong(), conn.codec, conn.framing))
+                        flush(conn)
+            except CDProtoBadFormat:
+                errors += 1
+
+    for conn in list(conns.values()):
+        drop(conn)
+    results.put({"sent": sent, "delivered": delivered, "errors": errors,
+                 "elapsed": (finished or time.monotonic()) - start,
+                 "lags": lags, "latencies": latencies})
+
+
+def run(args):
+    records = list(read_recording(args.recording))
+    if not records:
+        raise SystemExit(f"{args.recording} is empty")
+    speed = 0 if args.speed == "max" else float(args.speed)
+    host, port = args.target.rsplit(":", 1)
+
+    # Each recorded connection needs a descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    start_at = time.time() + 0.5
+    procs = [ctx.Process(target=replay_process, args=(
+                host, int(port), [r for r in records if r.conn % args.procs == i],
+                speed, start_at, args.linger, results))
+             for i in range(args.procs)]
+    for proc in procs:
+        proc.start()
+    totals = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    duration = records[-1].offset
+    elapsed = max(t["elapsed"] for t in totals)
+    sent = sum(t["sent"] for t in totals)
+    lags = sorted(l for t in totals for l in t["lags"])
+    latencies = sorted(l for t in totals for l in t["latencies"])
+    ms = lambda value: None if value is None else value * 1000
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "recording": {
+            "connections": len({r.conn for r in records}),
+            "records": len(records),
+            "duration_s": duration,
+        },
+        "replay": {
+            "messages": sent,
+            "elapsed_s": elapsed,
+            "messages_per_s": sent / elapsed if elapsed else None,
+            # Recorded duration over replay duration (speed if the pace is kept)
+            "speedup": duration / elapsed if elapsed else None,
+            "delivered": sum(t["delivered"] for t in totals),
+            "errors": sum(t["errors"] for t in totals),
+        },
+        # How late records went out compared to the (scaled) recording
+        "lag_ms": {
+            "p50": ms(percentile(lags, 0.50)),
+            "p99": ms(percentile(lags, 0.99)),
+            "max": ms(lags[-1] if lags else None),
+        },
+        "latency_ms": {
+            "samples": len(latencies),
+            "p50": ms(percentile(latencies, 0.50)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="file written by server.py --record")
+    parser.add_argument("--speed", default="1", help="pace multiplier, or max")
+    parser.add_argument("--target", default="127.0.0.1:8888", help="host:port of a running server")
+    parser.add_argument("--procs", type=int, default=1, help="replay processes (connections are split)")
+    parser.add_argument("--linger", type=float, default=1.0,
+                        help="seconds to keep receiving after the last record")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result)
+    print(result)
@@ -1,6 +1,52 @@
-from src.server import Server
+import argparse
+
+from src.logs import LOG_LEVEL, LOG_SAMPLE, setup_logging
+from src.server import Server, PORT, HEARTBEAT_INTERVAL, IDLE_TIMEOUT
 
 if __name__ == "__main__":
-    s = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--uvloop", default=False, action="store_true")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (selectors engine)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL,
+                        help="idle seconds before a client is pinged (0 disables)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a pinged client has to answer")
+    parser.add_argument("--log-level", default=LOG_LEVEL,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-sample", type=int, default=LOG_SAMPLE,
+                        help="log one message event out of every N (at DEBUG)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over HTTP (worker i of a cluster: port + i)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record the received traffic (worker i of a cluster: PATH.i)")
+    args = parser.parse_args()
+    options = dict(port=args.port, heartbeat_interval=args.heartbeat,
+                   idle_timeout=args.idle_timeout, log_sample=args.log_sample)
+    if args.uvloop and args.engine != "asyncio":
+        parser.error("--uvloop needs the asyncio engine")
+    if args.workers != 1 and args.engine != "selectors":
+        parser.error("--workers needs the selectors engine")
+    if args.metrics_port is not None:
+        if args.engine == "asyncio":
+            parser.error("--metrics-port needs the selectors engine")
+        options["metrics_port"] = args.metrics_port
+    if args.record is not None:
+        if args.engine == "asyncio":
+            parser.error("--record needs the selectors engine")
+        options["record"] = args.record
+
+    # Set up before forking workers (each one restarts the writer thread)
+    setup_logging("server.log", args.log_level)
+
+    if args.engine == "asyncio":
+        from src.async_server import AsyncServer
+        s = AsyncServer(use_uvloop=args.uvloop, **options)
+    elif args.workers > 1:
+        from src.cluster import Cluster
+        s = Cluster(args.workers, **options)
+    else:
+        s = Server(**options)
 
     s.loop()
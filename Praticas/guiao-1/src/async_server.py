@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: CD Chat server program built on asyncio streams.
+                  Speaks the same CDProto wire format as Server.
+ '''
+
+import asyncio
+import logging
+from collections import deque
+
+from .channels import ChannelIndex, ChannelHistory, HISTORY_SIZE, HISTORY_BYTES
+from .logs import EventLog, LOG_SAMPLE
+from .protocol import CDProtoBadFormat, CDProtoReader, CDProtoTooLarge, FrameCache, CODECS, JSON, \
+    FRAMING_V1, MAX_FRAME_SIZE
+from .server import HOST, PORT, DEFAULT_CHANNEL, RECV_SIZE, MAX_QUEUE_BYTES, REGISTER_TIMEOUT, \
+    HEARTBEAT_INTERVAL, IDLE_TIMEOUT, PING, PONG, SlowConsumer
+
+try:
+    import uvloop
+except ImportError: # optional, the default event loop is used
+    uvloop = None
+
+
+class AsyncConnection:
+    """Client connection: outbound frames waiting for its writer task."""
+
+    def __init__(self, writer: asyncio.StreamWriter, max_frame_bytes: int = MAX_FRAME_SIZE):
+        self.writer = writer
+        self.codec = JSON # negotiated at register
+        self.framing = FRAMING_V1
+        self.reader = CDProtoReader(max_size=max_frame_bytes)
+        self.frames = deque()
+        self.size = 0 # bytes queued, not yet handed to the transport
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.registered = False
+        self.timer = None # registration timeout, then heartbeat
+        self.last_seen = 0.0 # loop time of the last read
+        self.pinged = False
+
+    def push(self, frame: memoryview):
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        self.ready.set() # wake the writer task so it exits
+
+
+class AsyncServer:
+    """Chat Server process (asyncio engine)."""
+
+    def __init__(self, host: str = HOST, port: int = PORT,
+                 max_queue_bytes: int = MAX_QUEUE_BYTES,
+                 slow_consumer: SlowConsumer = SlowConsumer.DISCONNECT,
+                 multi_channel: bool = False, use_uvloop: bool = False,
+                 history_size: int = HISTORY_SIZE, history_bytes: int = HISTORY_BYTES,
+                 history_sizes: dict = None,
+                 register_timeout: float = REGISTER_TIMEOUT,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 log_sample: int = LOG_SAMPLE,
+                 max_frame_bytes: int = MAX_FRAME_SIZE):
+        """Initializes chat server."""
+        self.host = host
+        self.port = port
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_consumer = slow_consumer
+        self.multi_channel = multi_channel
+        self.use_uvloop = use_uvloop
+        self.register_timeout = register_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.max_frame_bytes = max_frame_bytes
+        self.events = EventLog(sample=log_sample)
+
+        # Channels data structure (channel <-> connections)
+        self.history = ChannelHistory(history_size, history_bytes, history_sizes)
+        self.channels = ChannelIndex(on_empty=self.history.forget)
+        self.server = None
+
+    def loop(self):
+        """Loop indefinitely."""
+        if self.use_uvloop:
+            if uvloop is None:
+                raise RuntimeError("uvloop is not installed")
+            uvloop.install()
+        asyncio.run(self.serve())
+
+    async def start(self):
+        """Start listening (the port is in self.server.sockets)."""
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            reuse_address=True, backlog=100)
+
+    async def serve(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    ############## Handlers ##############
+
+    async def handle_connection(self, reader, writer):
+        """Per-connection task: decode frames until the client leaves."""
+        logging.debug('accepted from "%s', writer.get_extra_info("peername"))
+        conn = AsyncConnection(writer, self.max_frame_bytes)
+        loop = asyncio.get_running_loop()
+        # Not in any channel until it registers (in time)
+        conn.timer = loop.call_later(self.register_timeout, self.disconnect, conn)
+        sender = asyncio.create_task(self.write_loop(conn))
+
+        try:
+            while not conn.closed:
+                data = await reader.read(RECV_SIZE)
+                if not data: # Client disconnect
+                    break
+                # Checked lazily by heartbeat(), no timer churn per read
+                conn.last_seen = loop.time()
+                conn.pinged = False
+                for message in conn.reader.feed(data):
+                    self.handle_message(conn, message)
+                    if conn.closed:
+                        break
+        except CDProtoBadFormat as e:
+            logging.debug('bad format "%s', e._original)
+        except ConnectionError:
+            pass
+        finally:
+            self.disconnect(conn)
+            sender.cancel()
+
+    async def write_loop(self, conn):
+        """Per-connection task: hand queued frames to the transport."""
+        try:
+            while not conn.closed:
+                await conn.ready.wait()
+                conn.ready.clear()
+
+                while conn.frames and not conn.closed:
+                    frame = conn.frames.popleft()
+                    conn.size -= len(frame)
+                    conn.writer.write(frame)
+                # Backpressure: wait until the transport buffer drains
+                await conn.writer.drain()
+        except ConnectionError:
+            self.disconnect(conn)
+
+    def handle_message(self, conn, message):
+        """Handle a decoded message."""
+        if self.events.enabled:
+            self.events('received "%s', message)
+
+        if not conn.registered:
+            # Handshake: the first message must be a valid RegisterMessage
+            if message.data["command"] != "register" or message.codec not in CODECS:
+                self.disconnect(conn)
+                return
+            conn.reader.codec = conn.codec = message.codec
+            conn.reader.framing = conn.framing = message.framing
+            conn.registered = True
+            conn.timer.cancel()
+            if self.heartbeat_interval:
+                conn.timer = asyncio.get_running_loop().call_later(
+                    self.heartbeat_interval, self.heartbeat, conn)
+            self.channels.join(conn, DEFAULT_CHANNEL)
+        elif message.data["command"] == "register":
+            pass # Already registered
+        elif message.data["command"] == "ping":
+            self.send(conn, PONG[conn.codec, conn.framing])
+        elif message.data["command"] == "pong":
+            pass # Liveness is recorded for any received data
+        elif message.data["command"] == "join":
+            if not self.multi_channel:
+                self.channels.remove(conn)
+            self.channels.join(conn, message.data["channel"])
+            for frame in self.history.replay(message.data["channel"], conn.codec, conn.framing):
+                self.send(conn, frame)
+        else:
+            self.broadcast(message.data.get("channel", DEFAULT_CHANNEL), message)
+
+    def heartbeat(self, conn):
+        """Ping a client silent for heartbeat_interval, disconnect it if still silent."""
+        if conn.closed:
+            return
+        loop = asyncio.get_running_loop()
+        idle = loop.time() - conn.last_seen
+        if conn.pinged:
+            logging.debug('idle timeout "%s', conn.writer.get_extra_info("peername"))
+            self.disconnect(conn)
+        elif idle < self.heartbeat_interval:
+            conn.timer = loop.call_later(self.heartbeat_interval - idle, self.heartbeat, conn)
+        else:
+            conn.pinged = True
+            conn.timer = loop.call_later(self.idle_timeout, self.heartbeat, conn)
+            self.send(conn, PING[conn.codec, conn.framing])
+
+    ############## Auxiliary ##############
+
+    def broadcast(self, channel, message):
+        """Send a message to every member of a channel, encoding it only once."""
+        members = self.channels.members(channel)
+        frames = FrameCache(message)
+        if self.events.enabled:
+            self.events('sended "%s to %d clients', message, len(members))
+
+        for conn in tuple(members):
+            try:
+                frame = frames.frame(conn.codec, conn.framing)
+            except CDProtoTooLarge:
+                continue # Registered with FRAMING_V1
+            self.send(conn, frame)
+        if channel in self.channels:
+            self.history.append(channel, frames)
+
+    def send(self, conn, frame):
+        """Queue a framed message to a client."""
+        # An empty queue takes a frame of any size (up to max_frame_bytes)
+        if conn.size and conn.size + len(frame) > self.max_queue_bytes:
+            logging.debug('slow consumer "%s', conn.writer.get_extra_info("peername"))
+            if self.slow_consumer == SlowConsumer.DISCONNECT:
+                self.disconnect(conn)
+            return
+        conn.push(frame)
+
+    def disconnect(self, conn):
+        """Remove a client from the server and close its connection."""
+        if conn.closed:
+            return
+        self.channels.remove(conn)
+        conn.timer.cancel()
+        conn.close()
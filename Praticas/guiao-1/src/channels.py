@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Channel membership index and history for the chat server.
+ '''
+
+from collections import deque
+
+from .protocol import CDProtoTooLarge, FRAMING_V1, FRAMING_V2, JSON
+
+
+class ChannelIndex:
+    """Bidirectional channel membership index.
+
+    Keeps channel -> clients and client -> channels in insertion-ordered
+    dicts (used as ordered sets), so join, leave and disconnect are O(1) per
+    membership and broadcasts iterate members in join order.
+    """
+
+    def __init__(self, on_empty=None):
+        """on_empty(channel) is called when the last member leaves a channel."""
+        self._members = {}  # channel -> {client: None}
+        self._channels = {} # client -> {channel: None}
+        self.on_empty = on_empty
+
+    def __contains__(self, channel) -> bool:
+        return channel in self._members
+
+    def __iter__(self):
+        """Iterate over non-empty channels."""
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def members(self, channel):
+        """Clients of a channel (live view, copy before mutating the index)."""
+        members = self._members.get(channel)
+        return members.keys() if members is not None else ()
+
+    def channels_of(self, client):
+        """Channels a client is a member of."""
+        channels = self._channels.get(client)
+        return channels.keys() if channels is not None else ()
+
+    def join(self, client, channel):
+        """Add client to channel (a client may be in several channels)."""
+        self._members.setdefault(channel, {})[client] = None
+        self._channels.setdefault(client, {})[channel] = None
+
+    def leave(self, client, channel):
+        """Remove client from channel."""
+        members = self._members.get(channel)
+        if members is None or client not in members:
+            return
+
+        del members[client]
+        if not members:
+            del self._members[channel] # Empty channels are forgotten
+            if self.on_empty is not None:
+                self.on_empty(channel)
+
+        channels = self._channels[client]
+        del channels[channel]
+        if not channels:
+            del self._channels[client]
+
+    def remove(self, client):
+        """Remove client from every channel it is a member of."""
+        for channel in tuple(self.channels_of(client)):
+            self.leave(client, channel)
+
+
+HISTORY_SIZE = 20 # messages kept per channel
+HISTORY_BYTES = 64 * 1024 # bytes of encoded frames kept per channel
+
+
+class ChannelHistory:
+    """Bounded ring buffers of recent messages, one per channel.
+
+    Entries are FrameCache objects, so the frames encoded for the original
+    broadcast are reused when a joining client catches up. Every ring is
+    bounded both in messages and in bytes; nbytes accounts for all of them.
+    Rings are only kept for channels with members (see forget).
+    """
+
+    def __init__(self, size: int = HISTORY_SIZE, max_bytes: int = HISTORY_BYTES,
+                 sizes: dict = None):
+        """sizes: per channel overrides of size (0 disables that channel)."""
+        self.size = size
+        self.max_bytes = max_bytes
+        self.sizes = sizes or {}
+        self._rings = {} # channel -> deque of FrameCache
+        self._bytes = {} # channel -> bytes held by its ring
+        self.nbytes = 0  # bytes held by all rings
+
+    def size_of(self, channel) -> int:
+        return self.sizes.get(channel, self.size)
+
+    def append(self, channel, frames):
+        """Record a broadcast FrameCache, evicting the oldest entries."""
+        size = self.size_of(channel)
+        if size <= 0:
+            return
+
+        if not frames.nbytes:
+            frames.frame(JSON, FRAMING_V2) # Every entry is accounted for, encoded at least once
+
+        ring = self._rings.get(channel)
+        if ring is None:
+            ring = self._rings[channel] = deque()
+            self._bytes[channel] = 0
+        ring.append(frames)
+        self._grow(channel, frames.nbytes)
+        self._evict(channel)
+
+    def replay(self, channel, codec, framing=FRAMING_V1) -> list:
+        """Frames of the recent messages of a channel, oldest first.
+
+        Messages too large for the framing of the client are left out.
+        """
+        ring = self._rings.get(channel)
+        if not ring:
+            return []
+
+        frames = []
+        for entry in ring:
+            before = entry.nbytes
+            try:
+                frames.append(entry.frame(codec, framing)) # may encode a new codec
+            except CDProtoTooLarge:
+                pass
+            self._grow(channel, entry.nbytes - before)
+        self._evict(channel)
+        return frames
+
+    def forget(self, channel):
+        """Drop the ring of a channel (e.g. its last member left)."""
+        if self._rings.pop(channel, None) is not None:
+            self.nbytes -= self._bytes.pop(channel)
+
+    def _evict(self, channel):
+        """Drop the oldest entries while the ring is over its bounds."""
+        ring = self._rings[channel]
+        size = self.size_of(channel)
+        while ring and (len(ring) > size or self._bytes[channel] > self.max_bytes):
+            self._grow(channel, -ring.popleft().nbytes)
+
+        if not ring: # A single message larger than max_bytes
+            del self._rings[channel]
+            del self._bytes[channel]
+
+    def _grow(self, channel, delta):
+        self._bytes[channel] += delta
+        self.nbytes += delta
@@ -12,9 +12,11 @@ import os
 import socket
 import selectors
 
-from .protocol import CDProto, CDProtoBadFormat
+from .logs import EventLog, setup_logging
+from .protocol import CDProto, CDProtoBadFormat, CDProtoReader, CDProtoTooLarge, JSON, FRAMING_V2
+from .transport import OutboundQueue, TcpPolicy, set_tcp_policy
 
-logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
+setup_logging(f"{sys.argv[0]}.log") # level: CD_LOG_LEVEL environment variable
 
 
 # set sys.stdin non-blocking
@@ -24,13 +26,40 @@ fcntl.fcntl(sys.stdin, fcntl.F_SETFL, orig_fl | os.O_NONBLOCK)
 SERVER = "127.0.0.1" # localhost
 PORT = 8888 # server port
 
+READ_SIZE = 64 * 1024 # bytes read from stdin or the socket per event
+MAX_QUEUE_BYTES = 1024 * 1024 # stop reading stdin above this many unsent bytes
+
 class Client:
     """Chat Client process."""
 
-    def __init__(self, name: str = "Foo"):
-        """Initializes chat client."""
+    def __init__(self, name: str = "Foo", codec: str = JSON,
+                 tcp_policy: TcpPolicy = TcpPolicy.NODELAY,
+                 max_queue_bytes: int = MAX_QUEUE_BYTES,
+                 framing: int = FRAMING_V2):
+        """Initializes chat client.
+
+        framing: requested at register; FRAMING_V2 lifts the 64 KiB limit
+        of a message (both ways).
+
+        max_queue_bytes: input is paused while more than this is waiting to
+        be sent (stdin may be a file or a pipe filled much faster).
+        """
         self.username = name
         self.channel = "main"
+        self.codec = codec # payload codec requested at register
+        self.framing = framing
+        self.tcp_policy = tcp_policy
+        self.max_queue_bytes = max_queue_bytes
+        self.events = EventLog()
+
+        # Partial line read from stdin
+        self.input = bytearray()
+        # Frames decoded from the server and frames waiting to be sent to it
+        self.reader = CDProtoReader(codec, framing)
+        self.queue = OutboundQueue()
+        self.paused = False # stdin unregistered while the queue is full
+        self.closing = False # leaving once the queue is drained
+        self.shut = False # nothing else is sent (waiting for the server to close)
 
         # Start the selector
         self.sel = selectors.DefaultSelector()
@@ -41,12 +70,14 @@ class Client:
         # Setup socket with server
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((SERVER,PORT)) # connect to server (block until accepted)
+        set_tcp_policy(self.sock, self.tcp_policy)
 
         # Register Message
-        CDProto.send_msg(self.sock,CDProto.register(self.username))
+        CDProto.send_msg(self.sock,CDProto.register(self.username,self.codec,self.framing))
+        self.sock.setblocking(False)
 
         # Handler to Receive Message from Server
-        self.sel.register(self.sock, selectors.EVENT_READ, self.handle_receive_message)
+        self.sel.register(self.sock, selectors.EVENT_READ, self.handle_socket)
         
         # Handler for Input
         self.sel.register(sys.stdin, selectors.EVENT_READ, self.handle_input_message)
@@ -66,28 +97,140 @@ class Client:
     ############## Handlers ##############    
 
     def handle_input_message(self, stdin, mask):
-        # Blocked until input is done        
-        str_send = input(">").strip()
-
-        if str_send[0:5] == "/join":
-            # Join message
-            self.channel = str_send[6:].strip()
-            message = CDProto.join(self.channel)
-        elif str_send == "exit":
-            # Exit message
-            socket.close()
-            sys.exit(1)
-        else:
-            # Text message
-            message = CDProto.message(str_send,self.channel)
-
-        logging.debug('sended "%s', message)
-        CDProto.send_msg(self.sock, message) 
+        """Send every complete line available on stdin (one write for all)."""
+        try:
+            data = os.read(stdin.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return # Spurious wake-up
+
+        if not data: # End of input (e.g. a piped script): the rest and leave
+            lines, self.input = [bytes(self.input)], bytearray()
+            self.send_lines(lines)
+            self.exit()
+            return
+
+        if b"\n" not in data:
+            self.input += data # Long line: no copy of what was read before
+            return
+        *lines, rest = (self.input + data).split(b"\n")
+        self.input = bytearray(rest)
+        self.send_lines(lines)
+        self.flush()
+
+        sys.stdout.write(">")
+        sys.stdout.flush()
+
+    def handle_socket(self, sock, mask):
+        """Dispatch readiness events of the server socket."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ:
+            self.handle_receive_message(sock, mask)
 
     def handle_receive_message(self, sock, mask):
-        message = CDProto.recv_msg(sock)
-        if (message != None) and (message.data["command"]) == "message":
-            logging.debug('received "%s', message)
+        try:
+            data = sock.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b""
+        if not data: # Server closed the connection
+            if not self.closing:
+                print("\nDisconnected")
+            self.close()
+
+        try:
+            for message in self.reader.feed(data):
+                self.handle_message(message)
+        except CDProtoBadFormat as e:
+            logging.debug('bad format "%s', e._original)
+        self.flush()
+
+    def handle_message(self, message):
+        if message.data["command"] == "message":
+            if self.events.enabled:
+                self.events('received "%s', message)
             print("\n< "+message.data["message"]+"\n>",end="")
-            
-            
+        elif message.data["command"] == "ping":
+            # Heartbeat: idle clients are disconnected if they do not answer
+            self.send(CDProto.pong())
+        sys.stdout.flush()
+
+    ############## Auxiliary ##############
+
+    def send_lines(self, lines):
+        """Queue the messages typed in lines (bytes, without the newline)."""
+        for line in lines:
+            str_send = line.decode("utf-8", errors="replace").strip()
+            if not str_send:
+                continue
+
+            if str_send[0:5] == "/join":
+                # Join message
+                self.channel = str_send[6:].strip()
+                message = CDProto.join(self.channel)
+            elif str_send == "exit":
+                # Exit message (after what was typed before it)
+                self.exit()
+                return
+            else:
+                # Text message
+                message = CDProto.message(str_send,self.channel)
+
+            if self.events.enabled:
+                self.events('sended "%s', message)
+            self.send(message)
+
+    def send(self, message):
+        """Queue a message, written by the next flush."""
+        if self.shut:
+            return
+        try:
+            frame = CDProto.encode(message, self.codec, self.framing)
+        except CDProtoTooLarge:
+            print("\nMessage too large\n>", end="")
+            return
+        self.queue.push(frame)
+
+    def flush(self):
+        """Write queued frames, (un)subscribing EVENT_WRITE and pausing input."""
+        try:
+            drained = self.queue.flush(self.sock)
+        except OSError:
+            print("\nDisconnected")
+            self.close()
+
+        if drained and self.closing and not self.shut:
+            # Half-close: closing with unread data would reset the connection
+            # and the server would lose the last messages. It closes in turn.
+            self.sock.shutdown(socket.SHUT_WR)
+            self.shut = True
+
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if self.sel.get_key(self.sock).events != events:
+            self.sel.modify(self.sock, events, self.handle_socket)
+
+        # Backpressure: stop reading input the server cannot take yet
+        full = self.queue.size > self.max_queue_bytes
+        if full and not self.paused:
+            self.sel.unregister(sys.stdin)
+            self.paused = True
+        elif not full and self.paused and not self.closing:
+            self.sel.register(sys.stdin, selectors.EVENT_READ, self.handle_input_message)
+            self.paused = False
+
+    def exit(self):
+        """Stop reading input and leave once the queued frames are sent.
+
+        The loop keeps reading from the server until it closes the connection,
+        so the client is not taken for a slow consumer while it drains a long
+        script.
+        """
+        if not self.paused:
+            self.sel.unregister(sys.stdin)
+        self.paused = self.closing = True
+        self.flush()
+
+    def close(self):
+        self.sock.close()
+        sys.exit(0)
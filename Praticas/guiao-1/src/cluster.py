@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Multi-process chat server. N Server workers share the
+                  listening port (SO_REUSEPORT) and relay channel messages
+                  to each other over a full mesh of Unix domain sockets.
+ '''
+
+import logging
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from .logs import stop_logging
+from .server import Server
+
+
+class Cluster:
+    """Pool of Server worker processes."""
+
+    def __init__(self, workers: int = os.cpu_count(), **options):
+        """Initializes the pool; options are passed to every Server."""
+        self.workers = workers
+        self.options = options
+        self.pids = []
+
+    def loop(self):
+        """Fork the workers and wait for them."""
+        # Bus: one socketpair per pair of workers (created before forking)
+        links = {(i, j): socket.socketpair()
+                 for i in range(self.workers) for j in range(i + 1, self.workers)}
+
+        for worker in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker(worker, links)
+            self.pids.append(pid)
+
+        # The parent only supervises
+        for pair in links.values():
+            for sock in pair:
+                sock.close()
+
+        # Take the workers down with the parent
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for _ in self.pids:
+                pid, status = os.wait() # In the order they exit
+                code = os.waitstatus_to_exitcode(status)
+                if code != 0:
+                    worker = self.pids.index(pid)
+                    logging.error("worker %d (pid %d) exited with status %d", worker, pid, code)
+                    print(f"worker {worker} (pid {pid}) exited with status {code}", file=sys.stderr)
+        finally:
+            self.stop()
+
+    def run_worker(self, worker, links):
+        """Body of a worker process (never returns)."""
+        peers = []
+        for (i, j), (a, b) in links.items():
+            if i == worker:
+                peers.append(a)
+                b.close()
+            elif j == worker:
+                peers.append(b)
+                a.close()
+            else:
+                a.close()
+                b.close()
+
+        options = dict(self.options)
+        if options.get("metrics_port") is not None:
+            options["metrics_port"] += worker # Scraped per worker
+        if options.get("record") is not None:
+            options["record"] += f".{worker}" # One recording per worker
+        # Stopped by the parent (or Ctrl-C): unwind, to close the recording
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        server = None
+        status = 0
+        try:
+            server = Server(reuse_port=True, **options)
+            server.attach_bus(peers)
+            server.loop()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            traceback.print_exc()
+            logging.exception("worker %d failed", worker)
+            status = 1
+        finally:
+            # _exit skips atexit: close what the server registered there
+            if server is not None and server.recorder is not None:
+                server.recorder.close()
+            stop_logging()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop(self):
+        """Terminate every worker still running."""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Low-overhead logging for the chat server and client.
+ '''
+
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get("CD_LOG_LEVEL", "INFO") # e.g. CD_LOG_LEVEL=DEBUG
+LOG_SAMPLE = 1 # one message event logged out of every LOG_SAMPLE
+
+_listener = None # background writer thread of this process
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueues records as they are, formatting happens in the writer thread.
+
+    QueueHandler formats the message before enqueueing it; deferring it keeps
+    Message.__repr__ (a json.dumps) out of the hot loop. Logged arguments
+    must not change afterwards (messages never do once sent).
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(filename: str, level=LOG_LEVEL):
+    """Log to filename from a background thread (callers only enqueue)."""
+    target = logging.FileHandler(filename)
+    target.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    handler = DeferredQueueHandler(queue.SimpleQueue())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    def start():
+        global _listener
+        # A forked worker (see cluster.py) has no writer thread: start its own
+        handler.queue = queue.SimpleQueue()
+        _listener = QueueListener(handler.queue, target)
+        _listener.start()
+
+    start()
+    os.register_at_fork(after_in_child=start)
+    atexit.register(stop_logging)
+    return handler
+
+
+def stop_logging():
+    """Write the records still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class EventLog:
+    """Sampled DEBUG log of per-message events.
+
+    Whether DEBUG is enabled is resolved once, so a disabled log costs the
+    hot loop a single attribute test:
+
+        if self.events.enabled:
+            self.events('received "%s', message)
+    """
+
+    def __init__(self, logger: logging.Logger = None, sample: int = LOG_SAMPLE):
+        self.logger = logger or logging.getLogger()
+        self.sample = max(1, sample)
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+        self._count = 0
+
+    def __call__(self, msg: str, *args):
+        self._count += 1
+        if self._count >= self.sample:
+            self._count = 0
+            self.logger.debug(msg, *args)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Server metrics in the Prometheus text format, served over
+                  HTTP from the server selector loop.
+ '''
+
+import selectors
+import socket
+from bisect import bisect_left
+
+from .timers import TimerWheel
+from .transport import OutboundQueue
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MAX_REQUEST = 8 * 1024 # bytes of an HTTP request head
+SCRAPE_TIMEOUT = 5.0 # seconds a scrape connection may stay open
+
+
+def _labels(labels: dict, extra: str = "") -> str:
+    pairs = [f'{k}="{v}"' for k, v in labels.items()]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter. The server loop is single-threaded, no locks."""
+    kind = "counter"
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name):
+        yield f"{name}{_labels(self.labels)} {self.value}"
+
+
+class Gauge:
+    """Value read from the server (callback) when scraped."""
+    kind = "gauge"
+
+    def __init__(self, labels: dict, read):
+        self.labels = labels
+        self.read = read
+
+    def samples(self, name):
+        yield f"{name}{_labels(self.labels)} {self.read()}"
+
+
+class Histogram:
+    """Observations counted in fixed buckets (upper bounds, ascending)."""
+    kind = "histogram"
+
+    def __init__(self, labels: dict, buckets):
+        self.labels = labels
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1) # last one: +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            yield f"{name}_bucket{_labels(self.labels, le)} {cumulative}"
+        yield f"{name}_sum{_labels(self.labels)} {self.sum}"
+        yield f"{name}_count{_labels(self.labels)} {self.count}"
+
+
+class Registry:
+    """Named metric families, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.families = {} # name -> (help, kind, [metric])
+
+    def _add(self, name, help, metric):
+        family = self.families.setdefault(name, (help, metric.kind, []))
+        family[2].append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._add(name, help, Counter(labels))
+
+    def gauge(self, name: str, help: str, read, **labels) -> Gauge:
+        return self._add(name, help, Gauge(labels, read))
+
+    def histogram(self, name: str, help: str, buckets, **labels) -> Histogram:
+        return self._add(name, help, Histogram(labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for name, (help, kind, metrics) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in metrics:
+                lines.extend(metric.samples(name))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    """Minimal HTTP server of a Registry, sharing the caller's selector.
+
+    Every request (whatever the path) gets the metrics and the connection is
+    closed once the response is written, so a scrape costs the chat loop a
+    few non-blocking calls and never blocks it. A connection still open after
+    timeout seconds (request or response stuck) is closed by the owner of
+    timers calling expire() for its expired keys.
+    """
+
+    def __init__(self, registry: Registry, sel: selectors.BaseSelector,
+                 host: str, port: int, timers: TimerWheel,
+                 timeout: float = SCRAPE_TIMEOUT):
+        self.registry = registry
+        self.sel = sel
+        self.timers = timers
+        self.timeout = timeout
+        self.requests = {}  # socket -> bytes of the request head read so far
+        self.responses = {} # socket -> OutboundQueue of the response
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(16)
+        sock.setblocking(False)
+        self.sock = sock
+        sel.register(sock, selectors.EVENT_READ, self.handle_accept)
+
+    def handle_accept(self, sock, mask):
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.requests[conn] = b""
+        self.timers.schedule(conn, self.timeout)
+        self.sel.register(conn, selectors.EVENT_READ, self.handle_request)
+
+    def handle_request(self, conn, mask):
+        try:
+            data = conn.recv(MAX_REQUEST)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b""
+        if not data:
+            self.close(conn)
+            return
+
+        request = self.requests[conn] + data
+        if b"\r\n\r\n" not in request:
+            if len(request) >= MAX_REQUEST:
+                self.close(conn)
+            else:
+                self.requests[conn] = request # Wait for the rest of the head
+            return
+
+        body = self.registry.render().encode("utf-8")
+        queue = OutboundQueue()
+        queue.push(b"HTTP/1.0 200 OK\r\n"
+                   + f"Content-Type: {CONTENT_TYPE}\r\n".encode()
+                   + f"Content-Length: {len(body)}\r\n".encode()
+                   + b"Connection: close\r\n\r\n" + body)
+        del self.requests[conn]
+        self.responses[conn] = queue
+        self.sel.modify(conn, selectors.EVENT_WRITE, self.handle_write)
+        self.handle_write(conn, selectors.EVENT_WRITE)
+
+    def handle_write(self, conn, mask):
+        try:
+            drained = self.responses[conn].flush(conn)
+        except OSError:
+            drained = True
+        if drained:
+            self.close(conn)
+
+    def expire(self, conn):
+        """Close conn if it is a scrape connection (its timer expired)."""
+        if conn in self.requests or conn in self.responses:
+            self.close(conn)
+
+    def close(self, conn):
+        self.timers.cancel(conn)
+        self.requests.pop(conn, None)
+        self.responses.pop(conn, None)
+        self.sel.unregister(conn)
+        conn.close()
+
+
+# Broadcast fan-out: recipients and seconds spent queueing the frames
+RECIPIENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+SECONDS_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1)
+DISCONNECT_REASONS = ("closed", "bad_format", "protocol", "register_timeout",
+                      "idle_timeout", "slow_consumer", "error")
+
+
+class ChatMetrics:
+    """Metrics of a chat Server.
+
+    Counters and histograms are updated by the server loop; gauges read the
+    server state (queues, channels, history) only when scraped.
+    """
+
+    def __init__(self, server, states):
+        """states: the enum of the connection handshake states."""
+        self.registry = registry = Registry()
+
+        self.accepted = registry.counter(
+            "cd_connections_accepted_total", "Client connections accepted.")
+        self.disconnects = {reason: registry.counter(
+            "cd_disconnects_total", "Client connections closed, by reason.", reason=reason)
+            for reason in DISCONNECT_REASONS}
+        self.messages_received = registry.counter(
+            "cd_messages_received_total", "Messages decoded from clients and workers.")
+        self.bytes_received = registry.counter(
+            "cd_bytes_received_total", "Bytes read from clients and workers.")
+        self.frames_queued = registry.counter(
+            "cd_frames_queued_total", "Frames queued to clients (broadcasts, replays, heartbeats).")
+        self.frames_dropped = registry.counter(
+            "cd_frames_dropped_total", "Frames dropped at the high-water mark of a queue.")
+        self.bytes_sent = registry.counter(
+            "cd_bytes_sent_total", "Bytes written to clients and workers.")
+        self.broadcast_recipients = registry.histogram(
+            "cd_broadcast_recipients", "Local recipients of a broadcast.", RECIPIENT_BUCKETS)
+        self.broadcast_seconds = registry.histogram(
+            "cd_broadcast_seconds", "Time spent queueing a broadcast.", SECONDS_BUCKETS)
+
+        # Read when scraped: O(clients) per scrape, nothing per message
+        for state in states:
+            registry.gauge("cd_connections", "Client connections, by handshake state.",
+                           lambda state=state: sum(1 for sock, s in server.states.items()
+                                                   if s == state and sock not in server.bus),
+                           state=state.name.lower())
+        registry.gauge("cd_channels", "Channels with members.", lambda: len(server.channels))
+        registry.gauge("cd_channel_members_max", "Members of the largest channel.",
+                       lambda: max((len(server.channels.members(channel))
+                                    for channel in server.channels), default=0))
+        registry.gauge("cd_queue_bytes", "Bytes queued to clients, not yet written.",
+                       lambda: sum(queue.size for queue in server.queues.values()))
+        registry.gauge("cd_queue_bytes_max", "Bytes queued to the most backlogged client.",
+                       lambda: max((queue.size for queue in server.queues.values()), default=0))
+        registry.gauge("cd_queues_backlogged", "Clients with bytes the kernel did not take yet.",
+                       lambda: sum(1 for queue in server.queues.values() if queue.size))
+        registry.gauge("cd_history_bytes", "Bytes held by the channel histories.",
+                       lambda: server.history.nbytes)
+        registry.gauge("cd_timers", "Pending register, heartbeat and idle timers.",
+                       lambda: len(server.timers))
@@ -9,6 +9,26 @@
 import json
 from datetime import datetime
 from socket import socket
+from typing import Iterator
+
+HEADER_SIZE = 2 # Big-endian length of the payload (framing version 1)
+
+# Framing versions (negotiated in the RegisterMessage, which is always
+# framed with version 1)
+FRAMING_V1 = 1 # 2-byte big-endian length: payloads up to 65535 bytes
+FRAMING_V2 = 2 # varint (LEB128) length: payloads up to the receiver's limit
+FRAMINGS = (FRAMING_V1, FRAMING_V2)
+
+MAX_V1_SIZE = 0xFFFF
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # default limit of a FRAMING_V2 payload
+VARINT_HEADER_SIZE = 5 # longest varint length accepted (32 bits)
+
+MAX_TS = 2**63 / 1_000_000 # seconds: the binary codec carries ts as microseconds below 2**63
+MAX_VARINT = 2**64 # larger varints in a binary payload are rejected
+
+# Payload codecs (negotiated in the RegisterMessage, JSON by default)
+JSON = "json"
+BINARY = "binary"
 
 class Message:
     """Message Type."""
@@ -27,29 +47,60 @@ class JoinMessage(Message):
         self.data["channel"] = channel
 
 class RegisterMessage(Message):
-    """Message to register username in the server."""
+    """Message to register username in the server.
 
-    def __init__(self, username: str):
+    The optional codec and framing are used for every frame after this one
+    (both ways).
+    """
+
+    def __init__(self, username: str, codec: str = JSON, framing: int = FRAMING_V1):
         super().__init__("register")
         self.data["user"] = username
+        if codec != JSON:
+            self.data["codec"] = codec
+        if framing != FRAMING_V1:
+            self.data["framing"] = framing
+
+    @property
+    def codec(self) -> str:
+        return self.data.get("codec", JSON)
+
+    @property
+    def framing(self) -> int:
+        return self.data.get("framing", FRAMING_V1)
     
 class TextMessage(Message):
     """Message to chat with other clients."""
 
-    def __init__(self, message: str, channel: str):
+    def __init__(self, message: str, channel: str, ts: float = None):
         super().__init__("message")
         self.data["message"] = message
         if channel != None:
             self.data["channel"] = channel
-        self.data["ts"] = int(round(datetime.now().timestamp())) # Integer timestamp of current datetime
+        if ts is None:
+            ts = round(datetime.now().timestamp(), 6) # Timestamp of current datetime (microseconds)
+        self.data["ts"] = ts
+
+class PingMessage(Message):
+    """Heartbeat request, answered with a PongMessage."""
+
+    def __init__(self):
+        super().__init__("ping")
+
+class PongMessage(Message):
+    """Heartbeat reply."""
+
+    def __init__(self):
+        super().__init__("pong")
 
 class CDProto:
     """Computação Distribuida Protocol."""
 
     @classmethod
-    def register(cls, username: str) -> RegisterMessage:
+    def register(cls, username: str, codec: str = JSON,
+                 framing: int = FRAMING_V1) -> RegisterMessage:
         """Creates a RegisterMessage object."""
-        return RegisterMessage(username)
+        return RegisterMessage(username, codec, framing)
 
     @classmethod
     def join(cls, channel: str) -> JoinMessage:
@@ -62,45 +113,337 @@ class CDProto:
         return TextMessage(message, channel)
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
-        """Sends through a connection a Message object."""
-        
-        # Object message -> Json -> Bytes
-        message = repr(msg).encode('utf-8')
+    def ping(cls) -> PingMessage:
+        """Creates a PingMessage object."""
+        return PingMessage()
+
+    @classmethod
+    def pong(cls) -> PongMessage:
+        """Creates a PongMessage object."""
+        return PongMessage()
+
+    @classmethod
+    def encode(cls, msg: Message, codec: str = JSON, framing: int = FRAMING_V1) -> bytes:
+        """Serializes a Message object into a framed (header + payload) byte string.
+
+        Raises CDProtoTooLarge if the payload does not fit the framing.
+        """
+
+        # Object message -> Bytes
+        message = CODECS[codec][0](msg)
 
         # Create a header with the length
-        header = len(message).to_bytes(2, byteorder='big')
+        return _header(len(message), framing) + message
 
-        # Send through the connection
-        connection.send(header + message)
+    @classmethod
+    def send_msg(cls, connection: socket, msg: Message, codec: str = JSON,
+                 framing: int = FRAMING_V1):
+        """Sends through a connection a Message object."""
+        
+        # Send through the connection (blocking sockets only)
+        connection.sendall(cls.encode(msg, codec, framing))
 
     @classmethod
-    def recv_msg(cls, connection: socket) -> Message:
-        """Receives through a connection a Message object."""
+    def recv_msg(cls, connection: socket, codec: str = JSON, framing: int = FRAMING_V1,
+                 max_size: int = MAX_FRAME_SIZE) -> Message:
+        """Receives through a (blocking) connection a Message object."""
         
         # Receive message size
-        size = int.from_bytes(connection.recv(2),'big')
+        if framing == FRAMING_V1:
+            size = int.from_bytes(connection.recv(HEADER_SIZE),'big')
+        else:
+            header = b""
+            while True:
+                byte = connection.recv(1)
+                if not byte: return None # Client disconnect
+                header += byte
+                frame_header = _read_header(header, max_size)
+                if frame_header is not None:
+                    break
+            size = frame_header[1]
 
         if (size == 0): return None # Client disconnect
         
-        received = connection.recv(size).decode('utf-8')
-        
-        try:
-            # decoding JSON to Message
-            data = json.loads(received) 
-        except Exception:
-            raise CDProtoBadFormat(received) 
+        # A single recv may return less than requested
+        received = b""
+        while len(received) < size:
+            chunk = connection.recv(size - len(received))
+            if not chunk: return None # Client disconnect
+            received += chunk
+
+        return cls.decode(received, codec)
+
+    @classmethod
+    def decode(cls, received: bytes, codec: str = JSON) -> Message:
+        """Builds a Message object from a (unframed) payload."""
+        return CODECS[codec][1](received)
+
+
+def _header(size: int, framing: int = FRAMING_V1) -> bytes:
+    """Frame header of a payload of size bytes."""
+    if framing == FRAMING_V1:
+        if size > MAX_V1_SIZE:
+            raise CDProtoTooLarge(size)
+        return size.to_bytes(HEADER_SIZE, byteorder='big')
+    return _varint(size)
+
+def _read_header(buffer, max_size: int = MAX_FRAME_SIZE):
+    """(header size, payload size) of a FRAMING_V2 frame, None if incomplete."""
+    size = shift = 0
+    for offset in range(min(len(buffer), VARINT_HEADER_SIZE)):
+        byte = buffer[offset]
+        size |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            if size > max_size:
+                raise CDProtoBadFormat(bytes(buffer[:offset + 1])) # Too large
+            return offset + 1, size
+        shift += 7
+    if len(buffer) >= VARINT_HEADER_SIZE:
+        raise CDProtoBadFormat(bytes(buffer[:VARINT_HEADER_SIZE])) # Overlong length
+    return None
+
+
+############## Codecs ##############
 
-        command = data.get("command") 
+STR_FIELDS = ("user", "codec", "channel", "message")
 
+def encode_json(msg: Message) -> bytes:
+    return repr(msg).encode('utf-8')
+
+def decode_json(received: bytes) -> Message:
+    try:
+        # decoding JSON to Message
+        data = json.loads(received.decode('utf-8'))
+    except Exception:
+        raise CDProtoBadFormat(received) 
+
+    if not isinstance(data, dict):
+        raise CDProtoBadFormat(received)
+
+    # Fields end up as dict keys (channels) and re-encoded for other clients
+    for field in STR_FIELDS:
+        if field in data and not isinstance(data[field], str):
+            raise CDProtoBadFormat(received)
+    framing = data.get("framing", FRAMING_V1)
+    if isinstance(framing, bool) or not isinstance(framing, int) or framing not in FRAMINGS:
+        raise CDProtoBadFormat(received)
+    # The binary codec carries it as unsigned microseconds (the comparisons of
+    # a huge int with a float are exact: no conversion, no overflow)
+    ts = data.get("ts")
+    if ts is not None and (isinstance(ts, bool) or not isinstance(ts, (int, float))
+                           or not 0 <= ts < MAX_TS):
+        raise CDProtoBadFormat(received)
+
+    command = data.get("command") 
+
+    try:
         if command == "join":
             return JoinMessage(data["channel"])
         elif command == "register":
-            return RegisterMessage(data["user"])
+            return RegisterMessage(data["user"], data.get("codec", JSON), framing)
         elif command == "message":
-            return TextMessage(data["message"],data.get("channel"))
+            return TextMessage(data["message"],data.get("channel"),data.get("ts"))
+        elif command == "ping":
+            return PingMessage()
+        elif command == "pong":
+            return PongMessage()
+    except KeyError:
+        pass # Missing mandatory field
+    
+    raise CDProtoBadFormat(received)  
+
+
+# Binary codec: command byte followed by the fields of the command.
+#   register: str user, str codec, optional varint framing (1 if absent)
+#   join:     str channel
+#   message:  str message, optional str channel, varint ts (microseconds)
+#   ping, pong: no fields
+# str = varint length + UTF-8 bytes; optional str = varint (length + 1), 0 if absent
+def _varint(value: int) -> bytes:
+    """Unsigned LEB128."""
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _read_varint(data: bytes, offset: int):
+    """Returns (value, next offset). Raises CDProtoBadFormat past MAX_VARINT."""
+    byte = data[offset]
+    if byte < 0x80: # Fast path: lengths below 128
+        return byte, offset + 1
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if value >= MAX_VARINT:
+            raise CDProtoBadFormat(bytes(data))
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def _str(text: str) -> bytes:
+    data = text.encode('utf-8')
+    return _varint(len(data)) + data
+
+def _read_str(data: bytes, offset: int, length: int):
+    end = offset + length
+    if end > len(data):
+        raise IndexError(end)
+    return data[offset:end].decode('utf-8'), end
+
+def encode_binary(msg: Message) -> bytes:
+    data = msg.data
+    command = data["command"]
+    if command == "message":
+        channel = data.get("channel")
+        if channel is None:
+            channel = b"\x00"
+        else:
+            channel = channel.encode('utf-8')
+            channel = _varint(len(channel) + 1) + channel
+        return b"\x03" + _str(data["message"]) + channel + _varint(round(data["ts"] * 1_000_000))
+    elif command == "join":
+        return b"\x02" + _str(data["channel"])
+    elif command == "ping":
+        return b"\x04"
+    elif command == "pong":
+        return b"\x05"
+    framing = data.get("framing", FRAMING_V1)
+    return (b"\x01" + _str(data["user"]) + _str(data.get("codec", JSON))
+            + (_varint(framing) if framing != FRAMING_V1 else b""))
+
+def decode_binary(received: bytes) -> Message:
+    data = bytes(received)
+    try:
+        command = data[0]
+        if command == 3:
+            length, offset = _read_varint(data, 1)
+            message, offset = _read_str(data, offset, length)
+            length, offset = _read_varint(data, offset)
+            channel = None
+            if length:
+                channel, offset = _read_str(data, offset, length - 1)
+            ts, offset = _read_varint(data, offset)
+            result = TextMessage(message, channel, ts / 1_000_000)
+        elif command == 2:
+            length, offset = _read_varint(data, 1)
+            channel, offset = _read_str(data, offset, length)
+            result = JoinMessage(channel)
+        elif command == 1:
+            length, offset = _read_varint(data, 1)
+            user, offset = _read_str(data, offset, length)
+            length, offset = _read_varint(data, offset)
+            codec, offset = _read_str(data, offset, length)
+            framing = FRAMING_V1
+            if offset < len(data):
+                framing, offset = _read_varint(data, offset)
+                if framing not in FRAMINGS:
+                    raise CDProtoBadFormat(data)
+            result = RegisterMessage(user, codec, framing)
+        elif command == 4:
+            result, offset = PingMessage(), 1
+        elif command == 5:
+            result, offset = PongMessage(), 1
         else:
-            raise CDProtoBadFormat(received)  
+            raise CDProtoBadFormat(data)
+    except (IndexError, UnicodeDecodeError):
+        raise CDProtoBadFormat(data)
+
+    if offset != len(data):
+        raise CDProtoBadFormat(data) # Trailing garbage
+    return result
+
+
+CODECS = {
+    JSON: (encode_json, decode_json),
+    BINARY: (encode_binary, decode_binary),
+}
+
+
+class CDProtoReader:
+    """Incremental CDProto frame decoder for a single connection.
+
+    Bytes are fed as they are read from the socket (one large recv per
+    readiness event); every complete frame is decoded and any trailing
+    partial frame is kept until the next read, so a large frame arrives in
+    as many reads as it takes. Frames are decoded lazily, so changing codec
+    or framing while iterating applies to the following frames.
+    """
+
+    def __init__(self, codec: str = JSON, framing: int = FRAMING_V1,
+                 max_size: int = MAX_FRAME_SIZE):
+        """max_size: larger FRAMING_V2 payloads are rejected (CDProtoBadFormat)
+        as soon as their header is read, before buffering them."""
+        self._buffer = bytearray()
+        self.codec = codec
+        self.framing = framing
+        self.max_size = max_size
+
+    def feed(self, data: bytes) -> Iterator[Message]:
+        """Appends data to the buffer and yields every complete Message."""
+        buffer = self._buffer
+        buffer += data
+
+        while buffer:
+            if self.framing == FRAMING_V1:
+                if len(buffer) < HEADER_SIZE:
+                    break
+                start, size = HEADER_SIZE, int.from_bytes(buffer[:HEADER_SIZE], 'big')
+            else:
+                header = _read_header(buffer, self.max_size)
+                if header is None:
+                    break
+                start, size = header
+            end = start + size
+            if len(buffer) < end:
+                break # Wait for the rest of the frame
+
+            payload = bytes(buffer[start:end])
+            del buffer[:end]
+            yield CDProto.decode(payload, self.codec)
+
+
+class FrameCache:
+    """Frames of one Message, encoded lazily at most once per codec.
+
+    Lets a broadcast share one immutable buffer per codec and framing among
+    all the recipients' write queues. Framings of the same codec share the
+    encoded payload (only the header is different).
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.frames = {}   # (codec, framing) -> frame
+        self.payloads = {} # codec -> payload (a view of one of its frames)
+
+    def frame(self, codec: str = JSON, framing: int = FRAMING_V1) -> memoryview:
+        """Raises CDProtoTooLarge if the payload does not fit the framing."""
+        frame = self.frames.get((codec, framing))
+        if frame is None:
+            payload = self.payloads.get(codec)
+            if payload is None:
+                payload = self.payloads[codec] = memoryview(CODECS[codec][0](self.message))
+            frame = self.frames[codec, framing] = memoryview(_header(len(payload), framing) + payload)
+            # Drop the separate payload copy, keep a view of the frame
+            self.payloads[codec] = frame[len(frame) - len(payload):]
+        return frame
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the encoded frames."""
+        return sum(len(frame) for frame in self.frames.values())
+
+
+class CDProtoTooLarge(Exception):
+    """Exception when a payload does not fit the framing of the receiver."""
+
+    def __init__(self, size: int):
+        self.size = size
 
 
 class CDProtoBadFormat(Exception):
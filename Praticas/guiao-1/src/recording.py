@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Recording of the CDProto byte stream received by the
+                  server (see benchmarks/replay.py to play it back).
+ '''
+
+import struct
+import time
+from typing import Iterator, NamedTuple
+
+MAGIC = b"CDREC\x01"
+HEADER = struct.Struct(">d") # wall clock time of the start of the recording
+# Record: microseconds since the start, connection id, kind, data length
+RECORD = struct.Struct(">QIBI")
+
+# Record kinds
+DATA = 0  # bytes received from the connection (whole recv, any framing)
+CLOSE = 1 # the connection was closed
+
+BUFFER_SIZE = 1024 * 1024 # bytes buffered before writing to the file
+FLUSH_INTERVAL = 1.0 # seconds between forced writes (at most lost if killed)
+
+
+class Record(NamedTuple):
+    offset: float # seconds since the start of the recording
+    conn: int
+    kind: int
+    data: bytes
+
+
+class Recorder:
+    """Appends what the server receives to a binary log file.
+
+    Records are appended to a large write buffer, so recording a recv costs
+    a struct.pack and two buffered writes; the buffer is written when it
+    fills up or FLUSH_INTERVAL after the previous write. The owner calls
+    flush() on a timer too (see Server.record): a server going idle does
+    not keep the last records buffered until the next one.
+    """
+
+    def __init__(self, path: str, buffer_size: int = BUFFER_SIZE, clock=time.monotonic):
+        self.file = open(path, "wb", buffering=buffer_size)
+        self.clock = clock
+        self.start = self.flushed = clock()
+        self.dirty = False # records written to the buffer since the last flush
+        self.ids = {} # connection -> id
+        self.next_id = 0
+        self.file.write(MAGIC + HEADER.pack(time.time()))
+
+    def data(self, conn, data: bytes):
+        """Record bytes received from conn."""
+        self._append(conn, DATA, data)
+
+    def closed(self, conn):
+        """Record the end of conn (if anything was recorded for it)."""
+        if conn in self.ids:
+            self._append(conn, CLOSE, b"")
+            del self.ids[conn]
+
+    def _append(self, conn, kind, data):
+        now = self.clock()
+        conn_id = self.ids.get(conn)
+        if conn_id is None:
+            conn_id = self.ids[conn] = self.next_id
+            self.next_id += 1
+
+        self.file.write(RECORD.pack(round((now - self.start) * 1_000_000), conn_id, kind, len(data)))
+        self.file.write(data)
+        self.dirty = True
+        if now - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+        self.flushed = self.clock()
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path: str) -> Iterator[Record]:
+    """Records of a recording file, in the order they were appended."""
+    with open(path, "rb") as f:
+        content = memoryview(f.read())
+
+    if bytes(content[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a recording")
+    offset = len(MAGIC) + HEADER.size
+
+    while offset + RECORD.size <= len(content):
+        micros, conn, kind, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        data = bytes(content[offset:offset + length])
+        if len(data) < length:
+            break # Truncated (recording interrupted)
+        offset += length
+        yield Record(micros / 1_000_000, conn, kind, data)
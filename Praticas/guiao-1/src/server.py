@@ -5,98 +5,435 @@
  # @ Description: CD Chat server program.
  '''
 
+import atexit
+import enum
 import logging
 import socket
 import selectors
+import time
 
-from .protocol import CDProto, CDProtoBadFormat, RegisterMessage
-
-logging.basicConfig(filename="server.log", level=logging.DEBUG)
+from .channels import ChannelIndex, ChannelHistory, HISTORY_SIZE, HISTORY_BYTES
+from .logs import EventLog, LOG_SAMPLE
+from .metrics import ChatMetrics, MetricsEndpoint
+from .protocol import CDProto, CDProtoBadFormat, CDProtoReader, CDProtoTooLarge, FrameCache, \
+    RegisterMessage, CODECS, JSON, FRAMINGS, FRAMING_V1, FRAMING_V2, MAX_FRAME_SIZE
+from .recording import Recorder, FLUSH_INTERVAL
+from .timers import TimerWheel
+from .transport import OutboundQueue, TcpPolicy, MAX_BATCH_BYTES, set_tcp_policy, cork
 
 HOST = '' # symbolic name meaning all available interfaces
 PORT = 8888 # arbitrary non-privileged port
 
 DEFAULT_CHANNEL = "main"
 
+RECV_SIZE = 64 * 1024 # bytes read per readiness event
+MAX_QUEUE_BYTES = 1024 * 1024 # high-water mark of a client outbound queue
+MAX_WRITE_BYTES = 1024 * 1024 # bytes written to one client per wake-up
+REGISTER_TIMEOUT = 5.0 # seconds a new connection has to register
+HEARTBEAT_INTERVAL = 30.0 # idle seconds before a client is pinged
+IDLE_TIMEOUT = 10.0 # seconds a pinged client has to send anything back
+ACCEPT_BATCH = 64 # connections accepted per readiness event
+
+class SlowConsumer(enum.Enum):
+    """What to do with a client whose outbound queue hits the high-water mark."""
+    DISCONNECT = 0
+    DROP = 1 # drop new messages until the queue drains
+
+class ConnState(enum.Enum):
+    """Client connection handshake state."""
+    ACCEPTED = 0   # waiting for the RegisterMessage
+    REGISTERED = 1 # member of the channels
+
+# Heartbeat frames never change, encode them once per codec and framing
+PING = {(codec, framing): memoryview(CDProto.encode(CDProto.ping(), codec, framing))
+        for codec in CODECS for framing in FRAMINGS}
+PONG = {(codec, framing): memoryview(CDProto.encode(CDProto.pong(), codec, framing))
+        for codec in CODECS for framing in FRAMINGS}
+
 class Server:
     """Chat Server process."""
 
-    def __init__(self):
-        """Initializes chat server."""
+    def __init__(self, host: str = HOST, port: int = PORT,
+                 max_queue_bytes: int = MAX_QUEUE_BYTES,
+                 slow_consumer: SlowConsumer = SlowConsumer.DISCONNECT,
+                 multi_channel: bool = False, reuse_port: bool = False,
+                 max_batch_bytes: int = MAX_BATCH_BYTES,
+                 tcp_policy: TcpPolicy = TcpPolicy.NODELAY,
+                 history_size: int = HISTORY_SIZE, history_bytes: int = HISTORY_BYTES,
+                 history_sizes: dict = None,
+                 register_timeout: float = REGISTER_TIMEOUT,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 log_sample: int = LOG_SAMPLE,
+                 metrics_port: int = None,
+                 record: str = None,
+                 max_frame_bytes: int = MAX_FRAME_SIZE,
+                 max_write_bytes: int = MAX_WRITE_BYTES):
+        """Initializes chat server.
+
+        multi_channel: a join adds the client to the channel instead of
+        moving it there (the client keeps receiving its previous channels).
+        reuse_port: share the port with other worker processes (SO_REUSEPORT).
+        max_batch_bytes: queued bytes coalesced per sendmsg; a queue reaching
+        it is written right away instead of at the end of the wake-up.
+        tcp_policy: Nagle/cork setting of client sockets.
+        history_size, history_bytes: recent messages (and their bytes) kept
+        per channel and sent to clients joining it; history_sizes overrides
+        history_size for some channels.
+        register_timeout: seconds a new connection has to register.
+        heartbeat_interval: a registered client silent for this long is
+        pinged, and disconnected if still silent idle_timeout seconds later
+        (0 disables heartbeats).
+        log_sample: one message event out of every log_sample is logged
+        (at DEBUG level, see logs.py).
+        metrics_port: serve the metrics (Prometheus text format) over HTTP
+        on this port, from the same selector loop (None: not served).
+        record: append what clients send to this file (see recording.py).
+        max_frame_bytes: largest payload accepted from a client registered
+        with FRAMING_V2 (larger ones disconnect it).
+        max_write_bytes: bytes written to one client per wake-up, so a large
+        message is streamed over several loop iterations without holding
+        up the other clients (0: until the kernel buffer is full).
+        """
         
-        # Channels data structure
-        self.channels = {DEFAULT_CHANNEL : []}
+        # Per-message events (received, sended) are sampled
+        self.events = EventLog(sample=log_sample)
+
+        # Recent messages of each channel (history.nbytes: memory used)
+        self.history = ChannelHistory(history_size, history_bytes, history_sizes)
+        # Channels data structure (channel <-> clients), empty ones lose their history
+        self.channels = ChannelIndex(on_empty=self.history.forget)
+        self.multi_channel = multi_channel
+
+        # Frame decoder (receive buffer) of each client socket
+        self.readers = {}
+
+        # Outbound queue (send buffer) of each client socket
+        self.queues = {}
+        # Payload codec and framing of each client socket (negotiated at register)
+        self.codecs = {}
+        self.framings = {}
+        self.max_frame_bytes = max_frame_bytes
+        # Handshake state of each client socket
+        self.states = {}
+
+        # One timer per client socket: register timeout before the handshake,
+        # then heartbeat (ping) and idle timeout (disconnect)
+        self.timers = TimerWheel()
+        self.register_timeout = register_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        # Registered sockets pinged and not heard from since
+        self.pinged = set()
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_consumer = slow_consumer
+
+        # Sockets with frames queued during this wake-up (flushed at its end)
+        self.pending = {}
+        self.max_batch_bytes = max_batch_bytes
+        self.max_write_bytes = max_write_bytes
+        self.tcp_policy = tcp_policy
+
+        # Sockets to the other worker processes (see cluster.py)
+        self.bus = set()
+
+        # Capture of the received byte stream (for benchmarks/replay.py)
+        self.recorder = None
+        if record is not None:
+            self.recorder = Recorder(record)
+            atexit.register(self.recorder.close)
 
         # Create the server Socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1) # Reuse address
-        sock.bind((HOST,PORT)) # bind to port on this machine
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1) # Kernel balances accepts
+        sock.bind((host,port)) # bind to port on this machine
         sock.listen(100)
         sock.setblocking(False)
+        self.sock = sock
 
         # Start the selector
         self.sel = selectors.DefaultSelector()
         # Prepare for clients
         self.sel.register(sock, selectors.EVENT_READ, self.handle_new_connection)
 
+        # Counters are always kept, the endpoint is opt-in
+        self.stats = ChatMetrics(self, ConnState)
+        self.metrics = None
+        if metrics_port is not None:
+            self.metrics = MetricsEndpoint(self.stats.registry, self.sel, host, metrics_port,
+                                           self.timers)
+
     def loop(self):
         """Loop indefinitely."""
         while True:
-            # Wait for events
-            events = self.sel.select()
+            # Wait for events (or the next timer tick)
+            events = self.sel.select(self.timers.timeout())
             # Handle events
             for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+            self.handle_timers()
+            # One batched write per client per wake-up
+            self.flush_pending()
 
     ############## Handlers ##############            
 
     def handle_new_connection(self, sock, mask):
-        """Handle new client connection."""
-        conn, addr = sock.accept()
-        print('accepted from:', addr)
-        # Client socket
-        conn.setblocking(False)
-        # Receive Register Message from client     
-        message = CDProto.recv_msg(conn)
-        logging.debug('received "%s', message)
+        """Handle new client connections (a batch of them per event)."""
+        for _ in range(ACCEPT_BATCH):
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                return # Backlog is empty
+            logging.debug('accepted from "%s', addr)
+            self.stats.accepted.inc()
+            # Client socket
+            conn.setblocking(False)
+            set_tcp_policy(conn, self.tcp_policy)
+            # Register Message (and everything else) is decoded by the reader
+            self.readers[conn] = CDProtoReader(max_size=self.max_frame_bytes)
+            self.queues[conn] = OutboundQueue()
+            self.codecs[conn] = JSON
+            self.framings[conn] = FRAMING_V1
+
+            # Not in any channel until it registers (in time)
+            self.states[conn] = ConnState.ACCEPTED
+            self.timers.schedule(conn, self.register_timeout)
 
-        self.channels[DEFAULT_CHANNEL].append(conn)
+            # Handle future data from this client  
+            self.sel.register(conn, selectors.EVENT_READ, self.handle_client)    
 
-        # Handle future data from this client  
-        self.sel.register(conn, mask, self.handle_receive_message)    
+    def handle_timers(self):
+        """Reap silent connections, ping idle ones and flush the recording."""
+        for sock in self.timers.expire():
+            if sock is self.recorder:
+                self.recorder.flush()
+                continue
+            state = self.states.get(sock)
+            if state == ConnState.ACCEPTED:
+                logging.debug('register timeout "%s', sock)
+                self.disconnect(sock, "register_timeout")
+            elif sock in self.pinged:
+                logging.debug('idle timeout "%s', sock)
+                self.disconnect(sock, "idle_timeout")
+            elif state == ConnState.REGISTERED:
+                self.pinged.add(sock)
+                self.timers.schedule(sock, self.idle_timeout)
+                self.send(sock, PING[self.codecs[sock], self.framings[sock]])
+            elif self.metrics is not None:
+                self.metrics.expire(sock) # Scrape connection left open
+
+    def handle_client(self, sock, mask):
+        """Dispatch readiness events of a client socket."""
+        if sock not in self.queues:
+            return # Disconnected earlier in this loop iteration
+        if mask & selectors.EVENT_WRITE:
+            self.flush(sock)
+        if mask & selectors.EVENT_READ and sock in self.readers:
+            self.handle_receive_message(sock, mask)
 
     def handle_receive_message(self, sock, mask):
-        """Handle new received message."""
-        
+        """Handle new received data (zero or more messages)."""
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return # Spurious wake-up
+        except ConnectionError:
+            data = b""
+
+        if not data: # Client disconnect
+            self.disconnect(sock)
+            return
+        self.stats.bytes_received.inc(len(data))
+        if self.recorder is not None and sock not in self.bus:
+            self.record(sock, data)
+
+        if (self.heartbeat_interval and self.states[sock] == ConnState.REGISTERED
+                and sock not in self.bus):
+            # Any data proves the client alive: restart its heartbeat
+            self.pinged.discard(sock)
+            self.timers.schedule(sock, self.heartbeat_interval)
 
-        message = CDProto.recv_msg(sock)
-        logging.debug('received "%s', message)
+        try:
+            for message in self.readers[sock].feed(data):
+                self.stats.messages_received.inc()
+                self.handle_message(sock, message)
+                if sock not in self.readers:
+                    break # Disconnected while handling (e.g. slow consumer)
+        except CDProtoBadFormat as e:
+            logging.debug('bad format "%s', e._original)
+            self.disconnect(sock, "bad_format")
+
+    def handle_message(self, sock, message):
+        """Handle a decoded message."""
+        if self.events.enabled:
+            self.events('received "%s', message)
         # Decide to whom we should send the message...
 
-        if message == None : # Client disconnect
-            # Remove from channels
-            self.remove_client_from_channels(sock)
-            
-            # End connections
-            self.sel.unregister(sock)
-            sock.close()
+        if self.states[sock] == ConnState.ACCEPTED:
+            # Handshake: the first message must be a valid RegisterMessage
+            if message.data["command"] != "register" or message.codec not in CODECS:
+                self.disconnect(sock, "protocol")
+                return
+            self.readers[sock].codec = self.codecs[sock] = message.codec
+            self.readers[sock].framing = self.framings[sock] = message.framing
+            self.states[sock] = ConnState.REGISTERED
+            self.timers.cancel(sock)
+            if self.heartbeat_interval:
+                self.timers.schedule(sock, self.heartbeat_interval)
+            self.channels.join(sock, DEFAULT_CHANNEL)
+        elif message.data["command"] == "register":
+            pass # Already registered
+        elif message.data["command"] == "ping":
+            self.send(sock, PONG[self.codecs[sock], self.framings[sock]])
+        elif message.data["command"] == "pong":
+            pass # Liveness is recorded for any received data
         elif message.data["command"] == "join":
-            # Remove from channels
-            self.remove_client_from_channels(sock)   
+            if not self.multi_channel:
+                # Remove from channels
+                self.channels.remove(sock)
 
             # Add socket to the channel
-            self.channels.setdefault(message.data["channel"], []).append(sock)
+            self.channels.join(sock, message.data["channel"])
+
+            # Catch up: recent messages go out in the same batched write
+            for frame in self.history.replay(message.data["channel"], self.codecs[sock],
+                                             self.framings[sock]):
+                self.send(sock, frame)
         else:
-            for client_socket in self.channels[message.data["channel"]]:
-                logging.debug('sended "%s', message)
-                CDProto.send_msg(client_socket, message)
+            # Messages relayed by other workers are only delivered locally
+            self.broadcast(message.data.get("channel", DEFAULT_CHANNEL), message,
+                           relay=sock not in self.bus)
 
 
     ############## Auxiliary ##############
 
-    def remove_client_from_channels(self, sock):
-        for values in self.channels.values():
-            if sock in values:
-                values.remove(sock)
\ No newline at end of file
+    def record(self, sock, data: bytes = None):
+        """Record data received from sock (None: its end). The recorder has a
+        timer of its own: what it buffers is written FLUSH_INTERVAL later at
+        most, even if nothing else is received."""
+        if not self.recorder.dirty:
+            self.timers.schedule(self.recorder, FLUSH_INTERVAL)
+        if data is None:
+            self.recorder.closed(sock)
+        else:
+            self.recorder.data(sock, data)
+
+    def attach_bus(self, peers):
+        """Connect this worker to the other workers (one socket per worker)."""
+        for peer in peers:
+            peer.setblocking(False)
+            # Any message a client may send has to fit: varint framing
+            self.readers[peer] = CDProtoReader(framing=FRAMING_V2, max_size=self.max_frame_bytes)
+            self.queues[peer] = OutboundQueue()
+            self.codecs[peer] = JSON
+            self.framings[peer] = FRAMING_V2
+            self.states[peer] = ConnState.REGISTERED
+            self.bus.add(peer)
+            self.sel.register(peer, selectors.EVENT_READ, self.handle_client)
+
+    def broadcast(self, channel, message, relay=True):
+        """Send a message to every member of a channel, encoding it only once."""
+        members = self.channels.members(channel)
+
+        # One immutable buffer per codec shared by the write queues of all recipients
+        start = time.perf_counter()
+        frames = FrameCache(message)
+        if self.events.enabled:
+            self.events('sended "%s to %d clients', message, len(members))
+
+        # Copy: slow consumers may be disconnected while broadcasting
+        for client_socket in tuple(members):
+            try:
+                frame = frames.frame(self.codecs[client_socket], self.framings[client_socket])
+            except CDProtoTooLarge:
+                self.stats.frames_dropped.inc() # Registered with FRAMING_V1
+                continue
+            self.send(client_socket, frame)
+
+        if relay:
+            # Members of this channel may be connected to other workers
+            for peer in self.bus:
+                self.queues[peer].push(frames.frame(JSON, FRAMING_V2)) # never dropped
+                self.pending[peer] = None
+
+        # Recorded once every frame it needed is encoded (if anyone is left to join)
+        if channel in self.channels:
+            self.history.append(channel, frames)
+        self.stats.broadcast_recipients.observe(len(members))
+        self.stats.broadcast_seconds.observe(time.perf_counter() - start)
+
+    def send(self, sock, frame):
+        """Queue a framed message to a client, written at the end of the wake-up."""
+        queue = self.queues[sock]
+
+        # An empty queue takes a frame of any size (up to max_frame_bytes)
+        if queue.size and queue.size + len(frame) > self.max_queue_bytes:
+            # Slow consumer: never let it stall the other clients
+            logging.debug('slow consumer "%s', sock)
+            if self.slow_consumer == SlowConsumer.DISCONNECT:
+                self.disconnect(sock, "slow_consumer")
+            else:
+                self.stats.frames_dropped.inc()
+            return
+
+        queue.push(frame)
+        self.stats.frames_queued.inc()
+        if queue.size >= self.max_batch_bytes:
+            self.flush(sock) # Batch is full, do not wait
+        else:
+            self.pending[sock] = None
+
+    def flush_pending(self):
+        """Write the frames queued during this wake-up, one batch per socket."""
+        pending, self.pending = self.pending, {}
+        for sock in pending:
+            if sock in self.queues: # May have been disconnected meanwhile
+                self.flush(sock)
+
+    def flush(self, sock):
+        """Write pending data of a client and (un)subscribe EVENT_WRITE."""
+        queue = self.queues[sock]
+        corked = self.tcp_policy == TcpPolicy.CORK
+        try:
+            if corked:
+                cork(sock, True)
+            queued = queue.size
+            drained = queue.flush(sock, self.max_batch_bytes, self.max_write_bytes)
+            self.stats.bytes_sent.inc(queued - queue.size)
+            if corked:
+                cork(sock, False) # Push out the last partial segment
+        except OSError:
+            self.disconnect(sock, "error")
+            return
+
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if self.sel.get_key(sock).events != events:
+            self.sel.modify(sock, events, self.handle_client)
+
+    def disconnect(self, sock, reason: str = "closed"):
+        """Remove a client from the server and close its socket."""
+        if sock not in self.readers:
+            return # Already disconnected
+        self.stats.disconnects[reason].inc()
+        if self.recorder is not None:
+            self.record(sock)
+
+        # Remove from channels
+        self.channels.remove(sock)
+        self.bus.discard(sock)
+        self.readers.pop(sock)
+        self.queues.pop(sock)
+        self.codecs.pop(sock)
+        self.framings.pop(sock)
+        self.states.pop(sock)
+        self.pending.pop(sock, None)
+        self.timers.cancel(sock)
+        self.pinged.discard(sock)
+
+        # End connections
+        self.sel.unregister(sock)
+        sock.close()
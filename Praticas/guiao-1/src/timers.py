@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Timing wheel for the chat server selector loop.
+ '''
+
+import math
+import time
+
+
+class TimerWheel:
+    """Hierarchical timing wheel.
+
+    Timers are identified by a key (e.g. a socket) and rounded up to the
+    wheel resolution (tick). Level 0 has one slot per tick, every slot of
+    level n spans a whole turn of level n-1; timers far in the future sit in
+    a coarse level and cascade down as their deadline gets closer. Scheduling
+    and cancelling are O(1) and expiring only visits the slots of the ticks
+    that elapsed, whatever the number of timers.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 256, levels: int = 4,
+                 clock=time.monotonic):
+        """Timers up to tick * slots ** levels seconds away are exact;
+        further ones are parked in the last level and rescheduled."""
+        self.tick = tick
+        self.clock = clock
+        self.size = slots
+        self.spans = [slots ** level for level in range(levels)] # ticks per slot
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)] # key -> deadline tick
+        self.where = {} # key -> slot dict
+        self.current = self._ticks(clock()) # last expired tick
+
+    def __len__(self):
+        return len(self.where)
+
+    def _ticks(self, when: float) -> int:
+        return math.floor(when / self.tick)
+
+    def _place(self, key, deadline: int):
+        delta = deadline - self.current
+        level = 0
+        while level + 1 < len(self.spans) and delta >= self.spans[level + 1]:
+            level += 1
+        slot = self.wheels[level][(deadline // self.spans[level]) % self.size]
+        slot[key] = deadline
+        self.where[key] = slot
+
+    def schedule(self, key, delay: float):
+        """(Re)start the timer of key, expiring after delay seconds."""
+        self.cancel(key)
+        deadline = max(math.ceil((self.clock() + delay) / self.tick), self.current + 1)
+        self._place(key, deadline)
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def expire(self) -> list:
+        """Remove and return the keys whose deadline has passed."""
+        now = self._ticks(self.clock())
+        expired = []
+        while self.current < now:
+            if not self.where:
+                self.current = now # Nothing to cascade or expire
+                break
+            self.current += 1
+            tick = self.current
+
+            # Cascade the coarse slots that start at this tick (outermost first)
+            for level in range(len(self.spans) - 1, 0, -1):
+                span = self.spans[level]
+                if tick % span == 0:
+                    wheel = self.wheels[level]
+                    index = (tick // span) % self.size
+                    slot, wheel[index] = wheel[index], {}
+                    for key, deadline in slot.items():
+                        self._place(key, deadline)
+
+            slot = self.wheels[0][tick % self.size]
+            if slot:
+                for key, deadline in list(slot.items()):
+                    if deadline <= tick:
+                        del slot[key]
+                        del self.where[key]
+                        expired.append(key)
+        return expired
+
+    def timeout(self):
+        """Seconds until the next tick (for select), None without timers."""
+        if not self.where:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - self.clock())
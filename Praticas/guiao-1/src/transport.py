@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+ # @ Author: Pedro Pinto (pmap@ua.pt)
+ # @ Create Time: 2024-02-26
+ # @ Description: Non-blocking socket helpers for the chat server.
+ '''
+
+import enum
+import os
+import socket
+from collections import deque
+
+MAX_BATCH_BYTES = 256 * 1024 # bytes coalesced in a single sendmsg
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX") # buffers per sendmsg
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class TcpPolicy(enum.Enum):
+    """How the kernel should packetize our (already batched) writes."""
+    DEFAULT = 0 # leave Nagle's algorithm on
+    NODELAY = 1 # TCP_NODELAY: each batch leaves immediately
+    CORK = 2    # TCP_CORK while a batch is written, full segments only
+
+
+def set_tcp_policy(sock: socket.socket, policy: TcpPolicy):
+    """Apply a TcpPolicy to a connected socket (no-op for non-TCP sockets)."""
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    if policy == TcpPolicy.NODELAY:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def cork(sock: socket.socket, corked: bool):
+    """Hold (or release) partial TCP segments; only where TCP_CORK exists."""
+    if hasattr(socket, "TCP_CORK") and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+
+
+class OutboundQueue:
+    """Pending outbound frames of a non-blocking socket.
+
+    Frames are kept as memoryviews so a short write only re-slices the
+    head frame (no copies) and the next flush resumes where it stopped.
+    A flush coalesces queued frames into a single sendmsg (writev) call.
+    """
+
+    def __init__(self):
+        self.frames = deque()
+        self.size = 0 # bytes waiting to be written
+
+    @property
+    def empty(self) -> bool:
+        return not self.frames
+
+    def push(self, frame: memoryview):
+        """Queues a framed message (a shared memoryview is queued as is)."""
+        if not isinstance(frame, memoryview):
+            frame = memoryview(frame)
+        self.frames.append(frame)
+        self.size += len(frame)
+
+    def flush(self, sock: socket.socket, max_batch_bytes: int = MAX_BATCH_BYTES,
+              max_bytes: int = 0) -> bool:
+        """Writes as much as the socket accepts. Returns True once drained.
+
+        max_bytes: stop after writing this many bytes (0: no limit); the
+        caller resumes on the next EVENT_WRITE, as after a short write.
+        """
+        frames = self.frames
+        budget = max_bytes or -1
+        while frames:
+            if not budget:
+                return False # Yield to the other sockets
+            # Gather a batch of frames for one system call
+            limit = min(max_batch_bytes, budget) if budget > 0 else max_batch_bytes
+            batch = []
+            size = 0
+            for frame in frames:
+                if len(frame) > limit - size:
+                    frame = frame[:limit - size] # Large frame: a piece per batch
+                batch.append(frame)
+                size += len(frame)
+                if size >= limit or len(batch) >= IOV_MAX:
+                    break
+
+            try:
+                sent = sock.sendmsg(batch) if len(batch) > 1 else sock.send(batch[0])
+            except BlockingIOError:
+                return False # Kernel buffer is full
+
+            self.size -= sent
+            short = sent < size
+            if max_bytes:
+                budget = max(budget - sent, 0)
+
+            # Drop what was written, resume mid-frame on next EVENT_WRITE
+            while sent:
+                frame = frames[0]
+                if sent < len(frame):
+                    frames[0] = frame[sent:]
+                    break
+                sent -= len(frame)
+                frames.popleft()
+
+            if short:
+                return False
+
+        return True
@@ -0,0 +1,52 @@
+"""Tests for the asyncio chat server engine."""
+import asyncio
+
+from src.async_server import AsyncServer
+from src.protocol import CDProto, CDProtoReader, TextMessage
+
+
+async def connect(port, name):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(CDProto.encode(CDProto.register(name)))
+    return reader, writer
+
+
+async def expect(reader, frames):
+    """Read the next TextMessage from the server."""
+    while True:
+        for message in frames.feed(await asyncio.wait_for(reader.read(4096), 2)):
+            if isinstance(message, TextMessage):
+                return message.data["message"]
+
+
+def test_async_server():
+    async def scenario():
+        server = AsyncServer(host="127.0.0.1", port=0)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+
+        foo, foo_w = await connect(port, "foo")
+        bar, bar_w = await connect(port, "bar")
+        foo_frames, bar_frames = CDProtoReader(), CDProtoReader()
+        await asyncio.sleep(0.1)
+
+        foo_w.write(CDProto.encode(CDProto.message("Olá Mundo", "main")))
+        assert await expect(bar, bar_frames) == "Olá Mundo"
+        assert await expect(foo, foo_frames) == "Olá Mundo"
+
+        # foo moves to #cd: bar no longer receives its messages
+        foo_w.write(CDProto.encode(CDProto.join("#cd")))
+        foo_w.write(CDProto.encode(CDProto.message("no one is here...", "#cd")))
+        bar_w.write(CDProto.encode(CDProto.message("Hello World", "main")))
+        assert await expect(foo, foo_frames) == "no one is here..."
+        assert await expect(bar, bar_frames) == "Hello World"
+
+        foo_w.close()
+        await asyncio.sleep(0.1)
+        assert list(server.channels.members("#cd")) == []
+
+        bar_w.close()
+        server.server.close()
+        await server.server.wait_closed()
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+"""Tests for the channel membership index."""
+import random
+import time
+
+from src.channels import ChannelIndex, ChannelHistory
+
+
+def test_channel_index_on_empty():
+    emptied = []
+    index = ChannelIndex(on_empty=emptied.append)
+    index.join("a", "#cd")
+    index.join("b", "#cd")
+    index.join("a", "main")
+    index.leave("a", "#cd")
+    assert emptied == []
+    index.remove("b")
+    index.remove("a")
+    assert emptied == ["#cd", "main"]
+
+
+def test_channel_index():
+    index = ChannelIndex()
+
+    index.join("foo", "main")
+    index.join("bar", "main")
+    index.join("foo", "#cd")
+
+    assert list(index.members("main")) == ["foo", "bar"]
+    assert list(index.channels_of("foo")) == ["main", "#cd"]
+
+    index.leave("foo", "main")
+    assert list(index.members("main")) == ["bar"]
+    assert "foo" in index.members("#cd")
+
+    # Leaving twice (or a channel never joined) is harmless
+    index.leave("foo", "main")
+    index.leave("foo", "#nowhere")
+
+    index.remove("foo")
+    assert "#cd" not in index
+    assert list(index.channels_of("foo")) == []
+    assert list(index.members("#cd")) == []
+    assert list(index) == ["main"]
+
+
+def test_channel_index_churn():
+    """10k clients churning across 1k channels."""
+    rng = random.Random(42)
+    index = ChannelIndex()
+    clients = range(10_000)
+    channels = [f"#{i}" for i in range(1_000)]
+    expected = {client: set() for client in clients}
+
+    start = time.perf_counter()
+    for _ in range(200_000):
+        client = rng.choice(clients)
+        channel = rng.choice(channels)
+        op = rng.random()
+        if op < 0.6:
+            index.join(client, channel)
+            expected[client].add(channel)
+        elif op < 0.95:
+            index.leave(client, channel)
+            expected[client].discard(channel)
+        else:
+            index.remove(client)
+            expected[client].clear()
+    elapsed = time.perf_counter() - start
+
+    # Both directions agree with the reference model
+    members = {channel: set() for channel in channels}
+    for client, joined in expected.items():
+        assert set(index.channels_of(client)) == joined
+        for channel in joined:
+            members[channel].add(client)
+    for channel in channels:
+        assert set(index.members(channel)) == members[channel]
+
+    # Constant time per operation (the old list scan needed minutes here)
+    assert elapsed < 5
+
+
+class Frames:
+    """FrameCache stand-in with fixed size frames."""
+
+    def __init__(self, name, size=10):
+        self.name = name
+        self.size = size
+        self.frames = {}
+
+    def frame(self, codec="json", framing=1):
+        self.frames[codec, framing] = f"{self.name}:{codec}" + (f":v{framing}" if framing != 1 else "")
+        return self.frames[codec, framing]
+
+    @property
+    def nbytes(self):
+        return self.size * len(self.frames)
+
+
+def test_channel_history():
+    history = ChannelHistory(size=3, max_bytes=100, sizes={"#quiet": 0})
+
+    for i in range(5):
+        entry = Frames(f"m{i}")
+        entry.frame("json")
+        history.append("main", entry)
+    history.append("#quiet", Frames("ignored"))
+
+    # Only the most recent messages are kept
+    assert history.replay("main", "json") == ["m2:json", "m3:json", "m4:json"]
+    assert history.replay("#quiet", "json") == []
+    assert history.nbytes == 30
+
+    # Catching up in another codec encodes (and accounts) new frames
+    assert history.replay("main", "binary") == ["m2:binary", "m3:binary", "m4:binary"]
+    assert history.nbytes == 60
+
+    # Byte bound
+    big = Frames("big", size=85)
+    big.frame("json")
+    history.append("main", big)
+    assert history.replay("main", "json") == ["big:json"]
+    assert history.nbytes == 85
+
+    # Entries never encoded are encoded when recorded, so they are accounted for
+    history.append("#cd", Frames("lazy"))
+    assert history.nbytes == 95
+
+    # Catching up in a new codec may go over the byte bound: the oldest go
+    history.append("main", Frames("small", size=10))
+    assert history.replay("main", "binary") == ["big:binary", "small:binary"]
+    assert history.replay("main", "json") == ["small:json"]
+    # small: recorded as json:v2, then binary and json; lazy: json:v2
+    assert history.nbytes == 30 + 10
+
+    # Empty channels lose their history
+    history.forget("main")
+    history.forget("#unknown")
+    assert history.replay("main", "json") == []
+    assert history.nbytes == 10
@@ -0,0 +1,138 @@
+import importlib
+import os
+import selectors
+import socket
+import sys
+from unittest.mock import patch
+
+import pytest
+
+from src.protocol import CDProtoReader, FRAMING_V1
+
+
+@pytest.fixture
+def stdin(monkeypatch):
+    """The client module reads sys.stdin: a pipe, written through the fd returned."""
+    r, w = os.pipe()
+    monkeypatch.setattr(sys, "stdin", os.fdopen(r))
+    yield w
+    sys.stdin.close()
+    try:
+        os.close(w)
+    except OSError:
+        pass # Closed by the test (end of input)
+
+
+@pytest.fixture
+def client_module(stdin):
+    # Imported with the pipe as stdin (made non-blocking at import) and
+    # without touching the logging of the test session
+    with patch("src.logs.setup_logging"):
+        sys.modules.pop("src.client", None)
+        yield importlib.import_module("src.client")
+    sys.modules.pop("src.client", None)
+
+
+def make_client(client_module, **options):
+    """Client connected to a socketpair, returning it and the server end."""
+    c = client_module.Client("student", framing=FRAMING_V1, **options)
+    c.sock, server = socket.socketpair()
+    c.sock.setblocking(False)
+    c.sel.register(c.sock, selectors.EVENT_READ, c.handle_socket)
+    c.sel.register(sys.stdin, selectors.EVENT_READ, c.handle_input_message)
+    return c, server
+
+
+def received(server, reader=None):
+    """Messages the server end can read without blocking (as dicts)."""
+    reader = reader or CDProtoReader()
+    server.setblocking(False)
+    data = b""
+    while True:
+        try:
+            chunk = server.recv(1 << 20)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        data += chunk
+    return [m.data for m in reader.feed(data)]
+
+
+def test_partial_lines(client_module, stdin):
+    c, server = make_client(client_module)
+
+    os.write(stdin, b"hel")
+    c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert received(server) == []
+
+    os.write(stdin, b"lo\nwor")
+    c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert [m["message"] for m in received(server)] == ["hello"]
+    assert c.input == b"wor"
+
+    os.write(stdin, b"ld\n")
+    c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert [m["message"] for m in received(server)] == ["world"]
+    assert c.input == b""
+
+
+def test_paste(client_module, stdin):
+    c, server = make_client(client_module)
+
+    # Many lines in one read: one write for all of them
+    os.write(stdin, b"one\n\n/join #cd\ntwo\n")
+    with patch.object(c.queue, "flush", wraps=c.queue.flush) as flush:
+        c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert flush.call_count == 1
+    messages = received(server)
+    assert [m["command"] for m in messages] == ["message", "join", "message"]
+    assert messages[0] == {"command": "message", "message": "one", "channel": "main", "ts": messages[0]["ts"]}
+    assert messages[1]["channel"] == "#cd"
+    assert messages[2]["message"] == "two" and messages[2]["channel"] == "#cd"
+
+
+def test_full_queue(client_module, stdin):
+    c, server = make_client(client_module, max_queue_bytes=4096)
+    c.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+    # The server does not read: input is paused once the queue is full
+    os.write(stdin, b"".join(b"line %d\n" % i for i in range(5000)))
+    c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert c.paused
+    assert sys.stdin not in [key.fileobj for key in c.sel.get_map().values()]
+    assert c.sel.get_key(c.sock).events == selectors.EVENT_READ | selectors.EVENT_WRITE
+
+    # It reads: the queue drains and input is read again
+    reader = CDProtoReader()
+    messages = []
+    while c.queue.size:
+        messages += reader.feed(server.recv(1 << 20))
+        c.handle_socket(c.sock, selectors.EVENT_WRITE)
+    assert not c.paused
+    assert c.sel.get_key(sys.stdin).data == c.handle_input_message
+    assert c.sel.get_key(c.sock).events == selectors.EVENT_READ
+    texts = [m.data["message"] for m in messages] + [m["message"] for m in received(server, reader)]
+    assert texts == [f"line {i}" for i in range(5000)]
+
+
+@pytest.mark.parametrize("end", [b"exit\n", None])
+def test_exit_half_closes(client_module, stdin, end):
+    """exit (or the end of input) sends what was typed before, then half-closes."""
+    c, server = make_client(client_module)
+
+    os.write(stdin, b"last words\n" + (end or b"almost"))
+    if end is None:
+        os.close(stdin)
+        c.handle_input_message(sys.stdin, selectors.EVENT_READ) # The lines
+    c.handle_input_message(sys.stdin, selectors.EVENT_READ)
+    assert c.closing and c.shut
+    messages = received(server) # Up to the end of file (SHUT_WR)
+    assert [m["message"] for m in messages] == ["last words"] + ([] if end else ["almost"])
+
+    # Still reading the server, and leaving when it closes in turn
+    server.close()
+    with pytest.raises(SystemExit) as exit:
+        c.handle_socket(c.sock, selectors.EVENT_READ)
+    assert exit.value.code == 0
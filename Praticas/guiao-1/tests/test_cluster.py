@@ -0,0 +1,72 @@
+import os
+import signal
+import socket
+import time
+
+from src.cluster import Cluster
+from src.protocol import CDProto
+from src.recording import read_recording
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def test_worker_failure_reported(capfd):
+    # Both metrics ports taken: every worker fails to start
+    port = free_port()
+    taken = [socket.socket(), socket.socket()]
+    for i, sock in enumerate(taken):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("localhost", port + i))
+        sock.listen()
+
+    Cluster(2, port=free_port(), metrics_port=port).loop()
+    for sock in taken:
+        sock.close()
+
+    err = capfd.readouterr().err
+    assert "Traceback" in err
+    assert "worker 0 (pid" in err and "worker 1 (pid" in err
+    assert err.count("exited with status 1") == 2
+
+
+def test_recording_survives_stop(tmp_path):
+    port = free_port()
+    path = str(tmp_path / "traffic.rec")
+    pid = os.fork()
+    if pid == 0:
+        try:
+            Cluster(2, port=port, record=path).loop()
+        finally:
+            os._exit(0)
+
+    time.sleep(0.5)
+    sent = 0
+    clients = []
+    for i in range(6):
+        client = socket.create_connection(("localhost", port))
+        for message in [CDProto.register(f"student{i}"), CDProto.message("one"), CDProto.message("two")]:
+            frame = CDProto.encode(message)
+            client.sendall(frame)
+            sent += len(frame)
+            time.sleep(0.01)
+        clients.append(client)
+    time.sleep(0.2)
+
+    # Stopped while idle, before any time based flush
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    for client in clients:
+        client.close()
+
+    deadline = time.monotonic() + 5
+    while True:
+        recorded = sum(len(record.data) for worker in range(2) if os.path.exists(f"{path}.{worker}")
+                       for record in read_recording(f"{path}.{worker}"))
+        if recorded == sent or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert recorded == sent
@@ -0,0 +1,44 @@
+"""Tests for the logging facility."""
+import logging
+
+from src.logs import EventLog, setup_logging, stop_logging
+from src.protocol import CDProto
+
+
+class Recorder(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+def test_event_log_sampling():
+    logger = logging.getLogger("test_event_log")
+    recorder = Recorder()
+    logger.addHandler(recorder)
+
+    logger.setLevel(logging.INFO)
+    assert not EventLog(logger).enabled
+
+    logger.setLevel(logging.DEBUG)
+    events = EventLog(logger, sample=3)
+    assert events.enabled
+    for i in range(7):
+        events("event %d", i)
+    assert recorder.records == ["event 2", "event 5"]
+
+
+def test_setup_logging(tmp_path):
+    root = logging.getLogger()
+    level = root.level
+    handler = setup_logging(tmp_path / "test.log", "DEBUG")
+    try:
+        logging.debug('received "%s', CDProto.join("#cd"))
+        stop_logging() # writes what is still queued
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+
+    assert (tmp_path / "test.log").read_text() == 'DEBUG:root:received "{"command": "join", "channel": "#cd"}\n'
@@ -0,0 +1,88 @@
+"""Tests for the metrics registry and its HTTP endpoint."""
+import selectors
+import socket
+import time
+
+from src.metrics import Registry, MetricsEndpoint
+from src.timers import TimerWheel
+
+
+def test_registry():
+    registry = Registry()
+    registry.counter("requests_total", "Requests.", code="200").inc(3)
+    registry.counter("requests_total", "Requests.", code="500").inc()
+    registry.gauge("queue_bytes", "Queued bytes.", lambda: 42)
+    latency = registry.histogram("latency_seconds", "Latency.", (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.observe(value)
+
+    assert registry.render() == """\
+# HELP requests_total Requests.
+# TYPE requests_total counter
+requests_total{code="200"} 3
+requests_total{code="500"} 1
+# HELP queue_bytes Queued bytes.
+# TYPE queue_bytes gauge
+queue_bytes 42
+# HELP latency_seconds Latency.
+# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.1"} 2
+latency_seconds_bucket{le="1"} 3
+latency_seconds_bucket{le="+Inf"} 4
+latency_seconds_sum 2.65
+latency_seconds_count 4
+"""
+
+
+def pump(sel, done, timeout=5):
+    """Run the selector callbacks until done() (or fail after timeout)."""
+    deadline = time.monotonic() + timeout
+    while not done():
+        assert time.monotonic() < deadline
+        for key, mask in sel.select(0.1):
+            key.data(key.fileobj, mask)
+
+
+def test_endpoint():
+    registry = Registry()
+    registry.counter("requests_total", "Requests.").inc()
+    sel = selectors.DefaultSelector()
+    endpoint = MetricsEndpoint(registry, sel, "127.0.0.1", 0, TimerWheel())
+
+    client = socket.create_connection(endpoint.sock.getsockname())
+    client.sendall(b"GET /metrics HTTP/1.1\r\n") # Head split in two reads
+    pump(sel, lambda: endpoint.requests and all(endpoint.requests.values()))
+    client.sendall(b"Host: localhost\r\n\r\n")
+    pump(sel, lambda: not endpoint.requests and not endpoint.responses)
+
+    client.settimeout(5)
+    response = b""
+    while chunk := client.recv(4096):
+        response += chunk
+    head, body = response.split(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.0 200 OK")
+    assert body == registry.render().encode()
+    assert len(sel.get_map()) == 1 # Only the listening socket is left
+    assert len(endpoint.timers) == 0
+    endpoint.sock.close()
+
+
+def test_endpoint_timeout():
+    """Scrape connections that never send a request are closed."""
+    clock = [0.0]
+    timers = TimerWheel(clock=lambda: clock[0])
+    sel = selectors.DefaultSelector()
+    endpoint = MetricsEndpoint(Registry(), sel, "127.0.0.1", 0, timers)
+
+    client = socket.create_connection(endpoint.sock.getsockname())
+    client.sendall(b"GET /metrics") # Never completed
+    pump(sel, lambda: endpoint.requests and all(endpoint.requests.values()))
+
+    clock[0] += endpoint.timeout + 1
+    for sock in timers.expire():
+        endpoint.expire(sock)
+    assert not endpoint.requests
+    assert len(sel.get_map()) == 1
+    client.settimeout(5)
+    assert client.recv(1) == b""
+    endpoint.sock.close()
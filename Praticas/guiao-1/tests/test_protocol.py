@@ -1,11 +1,19 @@
 """Tests for the chat protocol."""
+import json
 import pytest
 from src.protocol import (
+    BINARY,
+    JSON,
     CDProto,
+    CDProtoReader,
     TextMessage,
     JoinMessage,
     RegisterMessage,
     CDProtoBadFormat,
+    CDProtoTooLarge,
+    FrameCache,
+    FRAMING_V1,
+    FRAMING_V2,
 )
 
 from freezegun import freeze_time
@@ -21,7 +29,7 @@ def test_protocol():
 
     assert (
         str(p.message("Hello World"))
-        == '{"command": "message", "message": "Hello World", "ts": 1615852800}'
+        == '{"command": "message", "message": "Hello World", "ts": 1615852800.0}'
     )
 
 
@@ -59,3 +67,150 @@ def test_recv():
 
     with pytest.raises(CDProtoBadFormat):
         CDProto.recv_msg(mock_socket(b"Hello World"))
+
+
+def test_reader():
+    stream = (
+        CDProto.encode(CDProto.register("student"))
+        + CDProto.encode(CDProto.join("#cd"))
+        + CDProto.encode(CDProto.message("Hello World", "#cd"))
+    )
+    reader = CDProtoReader()
+
+    # Partial header and partial payload yield nothing
+    assert list(reader.feed(stream[:1])) == []
+    assert list(reader.feed(stream[1:10])) == []
+
+    # The rest of the burst yields every complete frame at once
+    messages = list(reader.feed(stream[10:-3]))
+    assert [type(m) for m in messages] == [RegisterMessage, JoinMessage]
+
+    messages = list(reader.feed(stream[-3:]))
+    assert isinstance(messages[0], TextMessage)
+    assert messages[0].data["message"] == "Hello World"
+
+    with pytest.raises(CDProtoBadFormat):
+        list(reader.feed(len(b"Hello World").to_bytes(2, "big") + b"Hello World"))
+
+
+@freeze_time("Mar 16th, 2021")
+def test_binary_codec():
+    messages = [
+        CDProto.register("student", BINARY),
+        CDProto.join("#cd"),
+        CDProto.message("Olá Mundo", "#cd"),
+        CDProto.message("Hello World"),
+        CDProto.ping(),
+        CDProto.pong(),
+    ]
+    for message in messages:
+        assert CDProto.decode(CDProto.encode(message)[2:]).data == message.data
+        frame = CDProto.encode(message, BINARY)
+        assert len(frame) < len(CDProto.encode(message))
+        assert CDProto.decode(frame[2:], BINARY).data == message.data
+
+    assert CDProto.encode(CDProto.join("#cd"), BINARY) == b"\x00\x05\x02\x03#cd"
+
+    # Sub-millisecond timestamps survive both codecs
+    message = CDProto.message("Hello World", "#cd")
+    message.data["ts"] = 1615852800.123456
+    for codec in (JSON, BINARY):
+        decoded = CDProto.decode(CDProto.encode(message, codec)[2:], codec)
+        assert decoded.data["ts"] == 1615852800.123456
+
+    for payload in [b"", b"\x09", b"\x02\x05#cd", b"\x02\x03#cd!"]:
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(payload, BINARY)
+
+    # Varints past 64 bits (a ts of 2**1100 microseconds does not fit a float)
+    huge = bytes([0xFF] * 157 + [0x01])
+    for payload in [b"\x03\x01x\x00" + huge, b"\x02" + huge + b"#cd"]:
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(payload, BINARY)
+
+
+def test_reader_codec_switch():
+    reader = CDProtoReader()
+    stream = CDProto.encode(CDProto.register("student", BINARY)) + CDProto.encode(
+        CDProto.message("Hello World", "main"), BINARY
+    )
+
+    messages = []
+    for message in reader.feed(stream):
+        messages.append(message)
+        if isinstance(message, RegisterMessage):
+            reader.codec = message.codec
+
+    assert messages[1].data["message"] == "Hello World"
+
+
+def test_json_field_types():
+    for payload in [
+        b'{"command": "register", "user": 5}',
+        b'{"command": "register", "user": "student", "codec": ["binary"]}',
+        b'{"command": "join", "channel": [1]}',
+        b'{"command": "join", "channel": null}',
+        b'{"command": "message", "message": "x", "channel": [1]}',
+        b'{"command": "message", "message": 5, "channel": "#cd"}',
+    ]:
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(payload)
+
+
+def test_json_ts():
+    assert CDProto.decode(b'{"command": "message", "message": "x", "ts": 7}').data["ts"] == 7
+    for ts in [b'"abc"', b"-1", b"true", b"NaN", b"Infinity", b"[1]", b"1" * 400, b"1e308",
+               str(2**63 // 1_000_000 + 1).encode()]:
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(b'{"command": "message", "message": "x", "ts": ' + ts + b"}")
+
+
+def test_framing_v2():
+    small = CDProto.message("Hello World", "#cd")
+    large = CDProto.message("x" * 100_000, "#cd")
+
+    # The register carries the framing of the frames after it (both codecs)
+    register = CDProto.register("student", BINARY, FRAMING_V2)
+    for codec in (JSON, BINARY):
+        decoded = CDProto.decode(CDProto.encode(register, codec)[2:], codec)
+        assert decoded.framing == FRAMING_V2 and decoded.codec == BINARY
+    assert CDProto.decode(CDProto.encode(CDProto.register("student"))[2:]).framing == FRAMING_V1
+    for framing in (3, True, "2", None):
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(
+                ('{"command": "register", "user": "student", "framing": %s}' % json.dumps(framing)).encode()
+            )
+
+    # Version 1 refuses payloads over 65535 bytes instead of overflowing
+    with pytest.raises(CDProtoTooLarge):
+        CDProto.encode(large)
+    assert CDProto.encode(small, JSON, FRAMING_V2)[1:] == CDProto.encode(small)[2:]
+
+    stream = CDProto.encode(register) + b"".join(
+        CDProto.encode(m, BINARY, FRAMING_V2) for m in (small, large, small)
+    )
+    reader = CDProtoReader()
+    messages = []
+    for i in range(0, len(stream), 4096): # Arrives over many reads
+        for message in reader.feed(stream[i:i + 4096]):
+            messages.append(message)
+            if isinstance(message, RegisterMessage):
+                reader.codec, reader.framing = message.codec, message.framing
+    assert [m.data.get("message") for m in messages[1:]] == ["Hello World", "x" * 100_000, "Hello World"]
+
+    # Too large for the reader (rejected from the header) and overlong headers
+    with pytest.raises(CDProtoBadFormat):
+        list(CDProtoReader(framing=FRAMING_V2, max_size=1000).feed(CDProto.encode(large, JSON, FRAMING_V2)[:3]))
+    with pytest.raises(CDProtoBadFormat):
+        list(CDProtoReader(framing=FRAMING_V2).feed(b"\xff" * 5))
+
+
+def test_frame_cache_framings():
+    frames = FrameCache(CDProto.message("x" * 100_000, "#cd"))
+    v2 = frames.frame(BINARY, FRAMING_V2)
+    with pytest.raises(CDProtoTooLarge):
+        frames.frame(BINARY, FRAMING_V1)
+    assert frames.frame(BINARY, FRAMING_V2) is v2
+    assert frames.nbytes == len(v2)
+    assert CDProto.decode(bytes(frames.frame(JSON, FRAMING_V2)[3:])).data["message"] == "x" * 100_000
+
@@ -0,0 +1,53 @@
+from src.recording import Recorder, Record, read_recording, DATA, CLOSE
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_recording(tmp_path):
+    path = tmp_path / "traffic.rec"
+    clock = Clock()
+    recorder = Recorder(path, clock=clock)
+    a, b = object(), object()
+    recorder.data(a, b"\x00\x05hello")
+    clock.now += 0.25
+    recorder.data(b, b"\x00\x01x")
+    recorder.closed(a)
+    recorder.closed(a) # Already closed: nothing recorded
+    recorder.closed(object()) # Never recorded: nothing recorded
+    recorder.close()
+
+    assert list(read_recording(path)) == [
+        Record(0.0, 0, DATA, b"\x00\x05hello"),
+        Record(0.25, 1, DATA, b"\x00\x01x"),
+        Record(0.25, 0, CLOSE, b""),
+    ]
+
+
+def test_recording_truncated(tmp_path):
+    path = tmp_path / "traffic.rec"
+    recorder = Recorder(path)
+    recorder.data("a", b"first")
+    recorder.data("a", b"second")
+    recorder.close()
+
+    # Killed in the middle of a write: the records before it are kept
+    path.write_bytes(path.read_bytes()[:-3])
+    assert [r.data for r in read_recording(path)] == [b"first"]
+
+
+def test_recording_flush(tmp_path):
+    path = tmp_path / "traffic.rec"
+    recorder = Recorder(path)
+    recorder.data("a", b"first")
+    assert recorder.dirty
+    assert path.read_bytes() == b"" # Still buffered, header included
+    recorder.flush()
+    assert not recorder.dirty
+    assert [r.data for r in read_recording(path)] == [b"first"]
+    recorder.close()
@@ -1,8 +1,13 @@
 import pytest
+import selectors
+import socket
 from unittest.mock import patch
 from mock import MagicMock
 
-from src.server import Server
+from src.protocol import CDProto, CDProtoReader, BINARY, JSON, FRAMING_V1, FRAMING_V2
+from src.recording import read_recording, DATA, CLOSE, FLUSH_INTERVAL
+from src.server import Server, ConnState
+from src.timers import TimerWheel
 
 
 class CDProtoException(Exception):
@@ -26,3 +31,393 @@ def test_server():
         assert mock_socket.call_count == 1
         assert mock_selector.call_count == 1
         assert mock_register.call_count == 1
+
+
+class FakeListener:
+    """Listening socket whose accept() hands over a prepared connection."""
+
+    def __init__(self, conn):
+        self.conns = [conn]
+
+    def accept(self):
+        if not self.conns:
+            raise BlockingIOError()
+        return self.conns.pop(), ("127.0.0.1", 0)
+
+
+def make_server(**options):
+    """Server with a real selector but without the listening socket."""
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(**options)
+    s.sel = selectors.DefaultSelector()
+    return s
+
+
+@pytest.fixture
+def server():
+    s = make_server(max_queue_bytes=64 * 1024)
+    yield s
+    s.sel.close()
+
+
+def event(server, sock, mask=selectors.EVENT_READ):
+    """One loop iteration of the server with a single ready socket."""
+    server.handle_client(sock, mask)
+    server.flush_pending()
+
+
+def connect(server, codec=JSON, framing=FRAMING_V1):
+    """Attach a new client to the server, returning the client end."""
+    client, conn = socket.socketpair()
+    server.handle_new_connection(FakeListener(conn), selectors.EVENT_READ)
+    client.sendall(CDProto.encode(CDProto.register("student", codec, framing)))
+    event(server, conn)
+    return client, conn
+
+
+def test_slow_consumer(server):
+    healthy, healthy_conn = connect(server)
+    slow, slow_conn = connect(server)
+    healthy.setblocking(False)
+
+    message = CDProto.message("x" * 1000, "main")
+    frame = CDProto.encode(message)
+    received = 0
+    for _ in range(1000):
+        server.handle_message(healthy_conn, message)
+        server.flush_pending()
+        # The healthy client keeps reading...
+        try:
+            while True:
+                received += len(healthy.recv(1 << 20))
+        except BlockingIOError:
+            pass
+        event(server, healthy_conn, selectors.EVENT_WRITE)
+
+    # ... and got everything, while the slow one was dropped at the high-water mark
+    assert received == 1000 * len(frame)
+    assert slow_conn not in server.queues
+    assert slow_conn not in server.channels.members("main")
+    assert healthy_conn in server.channels.members("main")
+
+
+def test_partial_write(server):
+    client, conn = connect(server)
+
+    message = CDProto.message("x" * 1000, "main")
+    frame = CDProto.encode(message)
+    count = 0
+    while server.queues[conn].empty:
+        server.handle_message(conn, message)
+        server.flush_pending()
+        count += 1
+
+    # Kernel buffer is full: rest is queued and EVENT_WRITE requested
+    assert server.sel.get_key(conn).events & selectors.EVENT_WRITE
+
+    received = b""
+    while len(received) < count * len(frame):
+        received += client.recv(1 << 20)
+        event(server, conn, selectors.EVENT_WRITE)
+
+    assert received == frame * count
+    assert server.queues[conn].empty
+    assert server.sel.get_key(conn).events == selectors.EVENT_READ
+
+
+def test_bus():
+    """Channel members connected to different workers get each other's messages."""
+    worker1, worker2 = make_server(), make_server()
+    link1, link2 = socket.socketpair()
+    worker1.attach_bus([link1])
+    worker2.attach_bus([link2])
+
+    foo, foo_conn = connect(worker1)
+    bar, bar_conn = connect(worker2)
+
+    foo.sendall(CDProto.encode(CDProto.message("Olá Mundo", "main")))
+    event(worker1, foo_conn)
+    event(worker2, link2)
+
+    assert CDProto.recv_msg(bar).data["message"] == "Olá Mundo"
+    assert CDProto.recv_msg(foo).data["message"] == "Olá Mundo"
+
+    # Relayed messages are not relayed back
+    link1.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        link1.recv(1)
+
+
+def test_codecs(server):
+    """Each client receives broadcasts in the codec it registered with."""
+    foo, foo_conn = connect(server)
+    bar, bar_conn = connect(server, BINARY)
+
+    bar.sendall(CDProto.encode(CDProto.message("Olá Mundo", "main"), BINARY))
+    event(server, bar_conn)
+
+    assert CDProto.recv_msg(foo).data["message"] == "Olá Mundo"
+    assert CDProto.recv_msg(bar, BINARY).data["message"] == "Olá Mundo"
+
+
+class CountingSocket(socket.socket):
+    """Socket counting its write system calls."""
+
+    writes = 0
+
+    def send(self, *args):
+        self.writes += 1
+        return super().send(*args)
+
+    def sendmsg(self, *args):
+        self.writes += 1
+        return super().sendmsg(*args)
+
+
+def test_batching(server):
+    """Messages handled in one wake-up reach a client in a single write."""
+    client, conn = socket.socketpair()
+    conn = CountingSocket(conn.family, conn.type, fileno=conn.detach())
+    server.handle_new_connection(FakeListener(conn), selectors.EVENT_READ)
+
+    client.sendall(CDProto.encode(CDProto.register("student")) + b"".join(
+        CDProto.encode(CDProto.message(f"m{i}", "main")) for i in range(50)))
+    event(server, conn)
+
+    assert conn.writes == 1
+    received = list(CDProtoReader().feed(client.recv(1 << 20)))
+    assert [m.data["message"] for m in received] == [f"m{i}" for i in range(50)]
+
+
+def test_history(server):
+    """A client joining a channel catches up in a single write."""
+    foo, foo_conn = connect(server)
+    foo.sendall(CDProto.encode(CDProto.join("#cd")))
+    event(server, foo_conn)
+    for i in range(5):
+        server.broadcast("#cd", CDProto.message(f"m{i}", "#cd"))
+
+    client, conn = socket.socketpair()
+    conn = CountingSocket(conn.family, conn.type, fileno=conn.detach())
+    server.handle_new_connection(FakeListener(conn), selectors.EVENT_READ)
+    client.sendall(CDProto.encode(CDProto.register("bar", BINARY))
+                   + CDProto.encode(CDProto.join("#cd"), BINARY))
+    event(server, conn)
+
+    assert conn.writes == 1
+    received = list(CDProtoReader(BINARY).feed(client.recv(1 << 20)))
+    assert [m.data["message"] for m in received] == [f"m{i}" for i in range(5)]
+    assert server.history.nbytes > 0
+
+
+def test_handshake(server):
+    """Connections join channels only once registered, and must do it in time."""
+    clock = [0.0]
+    server.timers = TimerWheel(clock=lambda: clock[0])
+
+    slow, slow_conn = socket.socketpair()
+    bad, bad_conn = socket.socketpair()
+    server.handle_new_connection(FakeListener(slow_conn), selectors.EVENT_READ)
+    server.handle_new_connection(FakeListener(bad_conn), selectors.EVENT_READ)
+    assert server.states[slow_conn] == ConnState.ACCEPTED
+    assert list(server.channels.members("main")) == []
+
+    # Anything but a RegisterMessage first is a protocol violation
+    bad.sendall(CDProto.encode(CDProto.join("#cd")))
+    event(server, bad_conn)
+    assert bad_conn not in server.states
+
+    # A registered client is not reaped
+    foo, foo_conn = connect(server)
+    assert server.states[foo_conn] == ConnState.REGISTERED
+    assert list(server.channels.members("main")) == [foo_conn]
+
+    clock[0] += server.register_timeout + 1
+    server.handle_timers()
+    assert slow_conn not in server.states
+    assert foo_conn in server.states
+    assert slow.recv(1) == b"" # closed by the server
+
+
+def test_heartbeat(server):
+    """Silent clients are pinged, and disconnected if they do not answer."""
+    clock = [0.0]
+    server.timers = TimerWheel(clock=lambda: clock[0])
+
+    foo, foo_conn = connect(server)
+    bar, bar_conn = connect(server, BINARY)
+
+    clock[0] += server.heartbeat_interval + 1
+    server.handle_timers()
+    server.flush_pending()
+    assert CDProto.recv_msg(foo).data == {"command": "ping"}
+    assert CDProto.recv_msg(bar, BINARY).data == {"command": "ping"}
+
+    # Only foo answers (and can ping the server as well)
+    foo.sendall(CDProto.encode(CDProto.pong()) + CDProto.encode(CDProto.ping()))
+    event(server, foo_conn)
+    assert CDProto.recv_msg(foo).data == {"command": "pong"}
+
+    clock[0] += server.idle_timeout + 1
+    server.handle_timers()
+    assert foo_conn in server.states
+    assert bar_conn not in server.states
+    assert list(server.channels.members("main")) == [foo_conn]
+
+
+def test_metrics(server):
+    foo, foo_conn = connect(server)
+    bar, bar_conn = connect(server, BINARY)
+
+    message = CDProto.message("Hello World", "main")
+    foo.sendall(CDProto.encode(message))
+    event(server, foo_conn)
+    bar.sendall(b"\x00\x01\xff") # Not a binary CDProto message
+    event(server, bar_conn)
+
+    stats = server.stats
+    assert stats.accepted.value == 2
+    assert stats.messages_received.value == 3 # 2 registers and 1 message
+    assert stats.frames_queued.value == 2 # foo and bar are in main
+    assert stats.bytes_sent.value == len(CDProto.encode(message)) + len(CDProto.encode(message, BINARY))
+    assert stats.disconnects["bad_format"].value == 1
+    assert stats.broadcast_recipients.count == 1
+
+    text = stats.registry.render()
+    assert 'cd_connections{state="registered"} 1' in text
+    assert "cd_channels 1" in text
+    assert 'cd_broadcast_recipients_bucket{le="2"} 1' in text
+
+
+def test_bad_field_types(server):
+    """A wrongly typed field disconnects its sender, not the whole server."""
+    foo, foo_conn = connect(server)
+    bar, bar_conn = connect(server)
+
+    for payload in [b'{"command": "join", "channel": [1]}',
+                    b'{"command": "message", "message": "x", "channel": [1]}']:
+        client, conn = connect(server)
+        client.sendall(len(payload).to_bytes(2, "big") + payload)
+        event(server, conn)
+        assert conn not in server.states
+        assert client.recv(1) == b""
+
+    assert list(server.channels.members("main")) == [foo_conn, bar_conn]
+    assert server.stats.disconnects["bad_format"].value == 2
+
+
+def test_bad_fields_binary_recipient(server):
+    """JSON messages the binary codec cannot encode never reach broadcast."""
+    foo, foo_conn = connect(server)
+    bar, bar_conn = connect(server, BINARY)
+
+    for payload in [b'{"command": "message", "message": "x", "channel": "main", "ts": "abc"}',
+                    b'{"command": "message", "message": "x", "channel": "main", "ts": -1}',
+                    b'{"command": "message", "message": 5, "channel": "main"}']:
+        client, conn = connect(server)
+        client.sendall(len(payload).to_bytes(2, "big") + payload)
+        event(server, conn)
+        assert conn not in server.states
+
+    assert server.stats.disconnects["bad_format"].value == 3
+    assert server.stats.broadcast_recipients.count == 0
+    assert bar_conn in server.states
+
+
+def test_history_bounded(server):
+    """Only channels with members keep a history."""
+    foo, foo_conn = connect(server)
+    for i in range(1000):
+        server.broadcast(f"#unused{i}", CDProto.message("x" * 1000, f"#unused{i}"))
+    assert server.history.nbytes == 0
+    assert server.history.replay("#unused0", JSON) == []
+
+    server.broadcast("main", CDProto.message("Hello World", "main"))
+    assert server.history.nbytes > 0
+    server.disconnect(foo_conn) # main is empty now
+    assert server.history.nbytes == 0
+    assert server.history.replay("main", JSON) == []
+
+
+def test_record(tmp_path):
+    path = tmp_path / "traffic.rec"
+    s = make_server(record=str(path))
+    client, conn = connect(s)
+    client.sendall(CDProto.encode(CDProto.message("hello")))
+    event(s, conn)
+    client.close()
+    event(s, conn)
+    s.recorder.close()
+    s.sel.close()
+
+    records = list(read_recording(path))
+    assert [r.kind for r in records] == [DATA, DATA, CLOSE]
+    assert {r.conn for r in records} == {0}
+    reader = CDProtoReader()
+    messages = list(reader.feed(b"".join(r.data for r in records)))
+    assert [m.data["command"] for m in messages] == ["register", "message"]
+
+
+def test_record_flushed_when_idle(tmp_path):
+    """The recording is written on a timer, not only by the next recv."""
+    path = tmp_path / "traffic.rec"
+    clock = [0.0]
+    s = make_server(record=str(path), heartbeat_interval=0)
+    s.timers = TimerWheel(clock=lambda: clock[0])
+    client, conn = connect(s)
+    client.sendall(CDProto.encode(CDProto.message("hello")))
+    event(s, conn)
+    assert path.read_bytes() == b"" # Still buffered
+
+    clock[0] += FLUSH_INTERVAL + 0.1
+    s.handle_timers()
+    assert [r.kind for r in read_recording(path)] == [DATA, DATA]
+    assert len(s.timers) == 0 # Nothing left to flush
+    s.recorder.close()
+    s.sel.close()
+
+
+def test_large_messages():
+    """Varint framing carries large messages, written a piece per wake-up."""
+    s = make_server(max_write_bytes=64 * 1024, max_frame_bytes=2_000_000)
+    sender, sender_conn = connect(s, JSON, FRAMING_V2)
+    v2, v2_conn = connect(s, BINARY, FRAMING_V2)
+    v1, v1_conn = connect(s)
+
+    payload = "x" * 1_000_000
+    data = memoryview(CDProto.encode(CDProto.message(payload, "main"), JSON, FRAMING_V2))
+    sender.setblocking(False)
+    received = s.stats.messages_received.value
+    while s.stats.messages_received.value == received: # Arrives over many reads
+        try:
+            data = data[sender.send(data):]
+        except BlockingIOError:
+            pass
+        event(s, sender_conn)
+
+    # Streamed: most of it is still queued after the broadcast wake-up
+    assert s.queues[v2_conn].size > 900_000
+    reader = CDProtoReader(BINARY, FRAMING_V2)
+    messages = []
+    wakeups = 0
+    while not messages:
+        messages += reader.feed(v2.recv(1 << 20))
+        event(s, v2_conn, selectors.EVENT_WRITE)
+        wakeups += 1
+    assert messages[0].data["message"] == payload
+    assert wakeups > 10
+
+    # Too large for the 2-byte header: not sent, the client stays
+    v1.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        v1.recv(1)
+    assert v1_conn in s.queues
+    assert s.stats.frames_dropped.value == 1
+
+    # Over max_frame_bytes: rejected from the header
+    sender.sendall(b"\xc0\x8d\xb7\x01") # varint 3_000_000
+    event(s, sender_conn)
+    assert sender_conn not in s.queues
+    assert s.stats.disconnects["bad_format"].value == 1
+    s.sel.close()
+
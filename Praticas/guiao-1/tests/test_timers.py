@@ -0,0 +1,56 @@
+"""Tests for the timing wheel."""
+from src.timers import TimerWheel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_timer_wheel():
+    clock = Clock()
+    wheel = TimerWheel(tick=0.125, slots=8, clock=clock)
+
+    wheel.schedule("a", 0.25)
+    wheel.schedule("b", 1.5) # more than one round of the wheel
+    wheel.schedule("c", 0.25)
+    wheel.cancel("c")
+    assert len(wheel) == 2
+    assert 0 < wheel.timeout() <= 0.125
+
+    clock.now += 0.2
+    assert wheel.expire() == []
+    clock.now += 0.1
+    assert wheel.expire() == ["a"]
+
+    # Rescheduling moves the deadline
+    wheel.schedule("b", 2.0)
+    clock.now += 1.5
+    assert wheel.expire() == []
+
+    # A long pause expires everything due at once
+    clock.now += 60
+    assert wheel.expire() == ["b"]
+    assert len(wheel) == 0
+    assert wheel.timeout() is None
+
+
+def test_timer_wheel_levels():
+    """Far timers cascade through the levels and expire on their tick."""
+    clock = Clock()
+    wheel = TimerWheel(tick=1, slots=4, levels=2, clock=clock) # exact up to 16 ticks
+
+    delays = [1, 3, 4, 5, 15, 16, 17, 40, 100]
+    for delay in delays:
+        wheel.schedule(delay, delay)
+
+    expired = {}
+    for _ in range(120):
+        clock.now += 1
+        for key in wheel.expire():
+            expired[key] = clock.now - 1000
+    assert expired == {delay: delay for delay in delays}
+    assert len(wheel) == 0
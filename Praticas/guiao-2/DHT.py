@@ -3,9 +3,10 @@ import time
 import sys
 import argparse
 from DHTNode import DHTNode
+from utils import M_BITS
 
 
-def main(number_nodes, timeout):
+def main(number_nodes, timeout, m_bits=M_BITS):
     """ Script to launch several DHT nodes. """
 
     # logger for the main
@@ -13,7 +14,7 @@ def main(number_nodes, timeout):
     # list with all the nodes
     dht = []
     # initial node on DHT
-    node = DHTNode(("localhost", 5000))
+    node = DHTNode(("localhost", 5000), m_bits=m_bits)
     node.start() # start function run()
     dht.append(node)
     logger.info(f"Join Request: {node.identification}")
@@ -22,7 +23,7 @@ def main(number_nodes, timeout):
         time.sleep(0.2)
         # Create DHT_Node threads on ports 5001++ 
         # DHT_Node on port 5000 is the initial node !!
-        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout)
+        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout, m_bits)
         node.start() # thread start
         dht.append(node)
         logger.info(f"Join Request: {node.identification}")
@@ -43,6 +44,7 @@ if __name__ == "__main__":
     parser.add_argument("--savelog", default=False, action="store_true")
     parser.add_argument("--nodes", type=int, default=5)
     parser.add_argument("--timeout", type=int, default=3)
+    parser.add_argument("--bits", type=int, default=M_BITS, help="identifier space: 2**bits ids")
     args = parser.parse_args()
 
     logfile = {}
@@ -57,4 +59,4 @@ if __name__ == "__main__":
         )
 
 
-    main(args.nodes, timeout=args.timeout)
+    main(args.nodes, timeout=args.timeout, m_bits=args.bits)
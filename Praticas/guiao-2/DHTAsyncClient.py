@@ -0,0 +1,312 @@
+""" Asyncio DHT client: many requests in flight, matched to replies by request id. """
+import asyncio
+import hashlib
+import itertools
+import logging
+import random
+import socket
+
+from codec import encode, encode_value, decode, CodecError
+from utils import MAX_DATAGRAM
+
+TIMEOUT = 0.5 # seconds to wait for the first reply, doubled (backoff) on every retry
+RETRIES = 5
+BACKOFF = 2
+# Outstanding requests (more wait their turn). Far more overflow the receive buffer
+# of the nodes (~200 KiB by default): replies are lost and requests sent again.
+MAX_IN_FLIGHT = 256
+# put_many/get_many send MPUT/MGET batches of about BATCH_BYTES (encoded keys and
+# values), at most BATCHES_IN_FLIGHT at a time, for the same reason.
+BATCH_BYTES = 8192
+BATCHES_IN_FLIGHT = 16
+# put_blob/get_blob store values larger than a datagram in chunks of CHUNK_SIZE
+# bytes, each under a key of its own (spread over the ring), at most
+# CHUNKS_IN_FLIGHT at a time: the receive buffers of the nodes again.
+CHUNK_SIZE = 32768
+CHUNKS_IN_FLIGHT = 4
+
+
+class DHTAsyncClient:
+    def __init__(self, address, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 max_in_flight=MAX_IN_FLIGHT, batch_bytes=BATCH_BYTES,
+                 batches_in_flight=BATCHES_IN_FLIGHT, chunk_size=CHUNK_SIZE,
+                 chunks_in_flight=CHUNKS_IN_FLIGHT):
+        """ Initialize client (connect() before use).
+
+        Parameters:
+            address: address of a node in the DHT
+            timeout: seconds to wait for a reply before sending the request again
+            retries: times a request is sent again before giving up
+            backoff: factor applied to the timeout on every retry
+            max_in_flight: maximum number of outstanding requests
+            batch_bytes: size of the batches of put_many/get_many (0: a request per key)
+            batches_in_flight: maximum number of outstanding batches
+            chunk_size: size of the chunks of put_blob (less than a datagram)
+            chunks_in_flight: maximum number of outstanding chunks
+        """
+        self.dht_addr = address
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_bytes = batch_bytes
+        self.chunk_size = chunk_size
+        self.logger = logging.getLogger("DHTAsyncClient")
+        self.socket = None
+        self.pending = {} # request id -> handler of its replies
+        self.ids = itertools.count()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.batches_in_flight = asyncio.Semaphore(batches_in_flight)
+        self.chunks_in_flight = asyncio.Semaphore(chunks_in_flight)
+        self.retransmissions = 0
+        self.datagrams = 0 # sent and received
+
+    async def connect(self):
+        """ Open the socket. """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.socket, self.receive)
+
+    def close(self):
+        if self.socket is not None:
+            asyncio.get_running_loop().remove_reader(self.socket)
+            self.socket.close()
+            self.socket = None
+
+    def receive(self):
+        """ Hand each reply to the request with the same id.
+            Drains the socket: one wake-up of the loop for a burst of replies.
+        """
+        while True:
+            try:
+                payload, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError: # e.g. port unreachable (ICMP) from an earlier send
+                continue
+            self.datagrams += 1
+            try:
+                out = decode(payload)
+            except CodecError: # not a message
+                continue
+            handler = self.pending.get(out.get("req"))
+            if handler is not None:
+                handler(out)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def submit(self, msg, feed=None, slots=None):
+        """ Send msg (tagged with a new request id) until it is answered, without waiting.
+            Returns a future of the reply (None if every retry timed out).
+
+        Parameters:
+            msg: request
+            feed: for requests answered in pieces (batches), called with each reply;
+                returns the result once every piece is in, None until then. It may
+                change msg, to send again only what is still unanswered.
+            slots: semaphore of which a slot is held (default in_flight), released
+                once the future is done
+        """
+        req = next(self.ids)
+        msg["args"]["req"] = req
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        timer = None
+
+        def on_reply(out):
+            result = out if feed is None else feed(out)
+            if result is not None and not future.done():
+                future.set_result(result)
+
+        def send(attempt, timeout):
+            nonlocal timer
+            if future.done():
+                return
+            if attempt > self.retries:
+                future.set_result(None)
+                return
+            if attempt:
+                self.retransmissions += 1
+            # Same id: a late reply to an earlier attempt completes the request
+            try:
+                self.socket.sendto(encode(msg), self.dht_addr)
+                self.datagrams += 1
+            except (BlockingIOError, InterruptedError):
+                pass # Full send buffer: as if lost, sent again on timeout
+            except (OSError, CodecError) as error: # e.g. too large for a datagram, or not encodable
+                self.logger.error("Request %s: %s", req, error)
+                future.set_result(None)
+                return
+            # Jitter, not to retry a whole lost burst at once
+            timer = loop.call_later(timeout, send, attempt + 1,
+                                    timeout * self.backoff * random.uniform(1, 1.25))
+
+        def done(future):
+            if timer is not None:
+                timer.cancel()
+            del self.pending[req]
+            (slots or self.in_flight).release()
+
+        self.pending[req] = on_reply
+        send(0, self.timeout)
+        future.add_done_callback(done)
+        return future
+
+    async def request(self, msg):
+        """ Send msg until it is answered. Returns the reply, None on timeout. """
+        await self.in_flight.acquire()
+        return await self.submit(msg)
+
+    async def request_many(self, msgs, slots=None):
+        """ Send many requests, at most max_in_flight (or slots) outstanding. Replies in order. """
+        slots = slots or self.in_flight
+        futures = []
+        for msg in msgs:
+            await slots.acquire()
+            futures.append(self.submit(msg, slots=slots))
+        # Futures, not coroutines: no task per request
+        return await asyncio.gather(*futures)
+
+    async def batch_many(self, batches):
+        """ Send (msg, feed) batches, at most batches_in_flight outstanding. """
+        futures = []
+        for msg, feed in batches:
+            await self.batches_in_flight.acquire()
+            futures.append(self.submit(msg, feed, self.batches_in_flight))
+        return await asyncio.gather(*futures)
+
+    def split(self, entries):
+        """ Split entries (keys or items) in batches of about batch_bytes encoded. """
+        batch, size = [], 0
+        for entry in entries:
+            entry_size = len(encode_value(entry))
+            if batch and size + entry_size > self.batch_bytes:
+                yield batch
+                batch, size = [], 0
+            batch.append(entry)
+            size += entry_size
+        if batch:
+            yield batch
+
+    @staticmethod
+    def acked(out):
+        return out is not None and out["method"] == "ACK"
+
+    async def put(self, key, value):
+        """ Store value to key in the DHT."""
+        out = await self.request({"method": "PUT", "args": {"key": key, "value": value}})
+        if not self.acked(out):
+            self.logger.error("Invalid msg: %s", out)
+            return False
+        return True
+
+    async def get(self, key):
+        """ Retrieve key from DHT."""
+        out = await self.request({"method": "GET", "args": {"key": key}})
+        if not self.acked(out):
+            self.logger.error("Invalid msg: %s", out)
+            return None
+        return out["args"]
+
+    async def put_many(self, items):
+        """ Store many (key, value) pairs (or a dict) concurrently; list of put results. """
+        items = list(items.items() if isinstance(items, dict) else items)
+        if not self.batch_bytes:
+            outs = await self.request_many(
+                {"method": "PUT", "args": {"key": key, "value": value}} for key, value in items)
+            return [self.acked(out) for out in outs]
+
+        results = {}
+
+        def mput(batch):
+            # Each node owning some of the keys replies for them
+            remaining = dict(batch)
+            msg = {"method": "MPUT", "args": {"items": batch}}
+
+            def feed(out):
+                for key in out["args"]["stored"]:
+                    results[key] = True
+                    remaining.pop(key, None)
+                for key in out["args"]["failed"]:
+                    results[key] = False
+                    remaining.pop(key, None)
+                msg["args"]["items"] = list(remaining.items())
+                return None if remaining else True
+            return msg, feed
+
+        await self.batch_many(mput(batch) for batch in self.split(items))
+        return [results.get(key, False) for key, _ in items]
+
+    async def get_many(self, keys):
+        """ Retrieve many keys concurrently; list of get results, in the same order. """
+        keys = list(keys)
+        if not self.batch_bytes:
+            outs = await self.request_many({"method": "GET", "args": {"key": key}} for key in keys)
+            return [out["args"] if self.acked(out) else None for out in outs]
+
+        found = {}
+
+        def mget(batch):
+            # Each node owning some of the keys replies for them, in pieces if large
+            remaining = set(batch)
+            msg = {"method": "MGET", "args": {"keys": batch}}
+
+            def feed(out):
+                found.update(out["args"]["found"])
+                remaining.difference_update(out["args"]["found"], out["args"]["missing"])
+                msg["args"]["keys"] = list(remaining)
+                return None if remaining else True
+            return msg, feed
+
+        await self.batch_many(mget(batch) for batch in self.split(keys))
+        return [found.get(key) for key in keys]
+
+    @staticmethod
+    def chunk_key(key, digest, index):
+        """ Key of a chunk of a blob: the digest keeps chunks of different contents apart. """
+        return f"{key}#{digest[:16]}#{index}"
+
+    async def put_blob(self, key, data):
+        """ Store bytes of any size to key: in chunks, then a manifest of them under key.
+            A reader finding the manifest finds every chunk (stored first).
+        """
+        data = memoryview(data)
+        digest = hashlib.sha256(data).hexdigest()
+        count = -(-len(data) // self.chunk_size)
+        outs = await self.request_many(
+            ({"method": "PUT", "args": {"key": self.chunk_key(key, digest, i),
+                                        "value": data[i * self.chunk_size:(i + 1) * self.chunk_size]}}
+             for i in range(count)), self.chunks_in_flight)
+        if not all(self.acked(out) for out in outs):
+            self.logger.error("Blob %s: %d of %d chunks not stored", key,
+                              sum(not self.acked(out) for out in outs), count)
+            return False
+        return await self.put(key, {"size": len(data), "chunks": count, "sha256": digest})
+
+    async def get_blob(self, key):
+        """ Retrieve bytes stored with put_blob. None if missing, incomplete or corrupted. """
+        manifest = await self.get(key)
+        try:
+            size, count, digest = manifest["size"], manifest["chunks"], manifest["sha256"]
+        except (TypeError, KeyError):
+            self.logger.error("Blob %s: no manifest", key)
+            return None
+
+        outs = await self.request_many(
+            ({"method": "GET", "args": {"key": self.chunk_key(key, digest, i)}} for i in range(count)),
+            self.chunks_in_flight)
+        if not all(self.acked(out) for out in outs):
+            self.logger.error("Blob %s: chunks missing", key)
+            return None
+        try:
+            data = b"".join(out["args"] for out in outs)
+        except TypeError: # not a chunk
+            data = b""
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            self.logger.error("Blob %s: corrupted", key)
+            return None
+        return data
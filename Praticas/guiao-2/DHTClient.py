@@ -1,25 +1,104 @@
 import socket
-import pickle
+import itertools
 import logging
-from utils import dht_hash, contains
+from utils import dht_hash, M_BITS, MAX_DATAGRAM
+from codec import encode, decode, CodecError
+from routing import RoutingCache, CACHE_TTL, CACHE_SIZE
 import time
 
 
 class DHTClient:
-    def __init__(self, address):
-        """ Initialize client."""
+    def __init__(self, address, iterative=False, timeout=None, cache_ttl=CACHE_TTL,
+                 cache_size=CACHE_SIZE, m_bits=M_BITS):
+        """ Initialize client.
+
+        Parameters:
+            address: address of a node in the DHT (bootstrap node)
+            iterative: look up the node owning a key (asking nodes for their closest
+                preceding finger) and send requests to it directly, instead of
+                letting the bootstrap node forward them hop by hop. The segments of
+                the ring learned are cached, so repeat lookups take no hop at all.
+            timeout: seconds to wait for a reply (None: forever). In iterative mode,
+                a node that does not answer is forgotten and the request is sent
+                again through the bootstrap node.
+            cache_ttl, cache_size: routing cache bounds (iterative mode)
+            m_bits: identifier space of the DHT
+        """
         self.dht_addr = address
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
         self.logger = logging.getLogger("DHTClient")
+        self.iterative = iterative
+        self.maximum = 2 ** m_bits
+        self.max_hops = 2 * m_bits # a lookup takes O(log N) hops, N <= 2**m_bits
+        self.cache = RoutingCache(cache_ttl, cache_size)
+        self.ids = itertools.count() # request ids, echoed by the nodes in their replies
+
+    def request(self, address, msg):
+        """ Send msg to address and return the reply, None on timeout.
+            Replies are matched to it by request id (by id for a lookup): a late
+            reply to a request that timed out is not taken for this one's.
+        """
+        lookup = msg["method"] == "LOOKUP"
+        if not lookup:
+            req = msg["args"]["req"] = next(self.ids)
+        self.socket.sendto(encode(msg), address)
+        while True:
+            try:
+                payload, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                return None
+            try:
+                out = decode(payload)
+            except CodecError as error:
+                self.logger.warning("Dropped datagram from %s: %s", addr, error)
+                continue
+            if lookup:
+                if out["method"] == "LOOKUP_REP" and out["args"]["id"] == msg["args"]["id"]:
+                    return out
+            elif out.get("req") == req:
+                return out
+            # Late reply to a request that timed out
+
+    def lookup(self, key_hash):
+        """ Address of the node owning key_hash (iterative lookup). """
+        address = self.cache.get(key_hash)
+        if address is not None:
+            return address
+
+        address = self.dht_addr
+        for _ in range(self.max_hops):
+            out = self.request(address, {"method": "LOOKUP", "args": {"id": key_hash}})
+            if out is None:
+                self.cache.invalidate(address)
+                break
+            args = out["args"]
+            if args["owner"]:
+                self.cache.add(args["start"], args["node_id"], args["node_addr"])
+                return args["node_addr"]
+            address = args["node_addr"]
+
+        self.logger.error("Lookup of %s failed", key_hash)
+        return self.dht_addr # The nodes forward the request themselves
+
+    def send(self, key, msg):
+        """ Send a request about key, to the node owning it in iterative mode. """
+        if not self.iterative:
+            return self.request(self.dht_addr, msg)
+
+        address = self.lookup(dht_hash(key, maximum=self.maximum))
+        out = self.request(address, msg)
+        if out is None and address != self.dht_addr:
+            # Gone: forget it, the bootstrap node forwards the request
+            self.cache.invalidate(address)
+            out = self.request(self.dht_addr, msg)
+        return out
 
     def put(self, key, value):
         """ Store value to key in the DHT."""
         msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        out = self.send(key, msg)
+        if out is None or out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return False
         return True
@@ -27,11 +106,8 @@ class DHTClient:
     def get(self, key):
         """ Retrieve key from DHT."""
         msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        out = self.send(key, msg)
+        if out is None or out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return None
         return out["args"]
@@ -2,67 +2,96 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
-import math
+from bisect import bisect_left
+from utils import dht_hash, dht_hash_many, contains, M_BITS, MAX_DATAGRAM
+from codec import encode, decode, CodecError
 
 
 class FingerTable:
     """Finger Table."""
 
-    def __init__(self, node_id, node_addr, m_bits=10):
+    def __init__(self, node_id, node_addr, m_bits=M_BITS):
         """ Initialize Finger Table."""
 
         self.node_id = node_id
         self.node_addr = node_addr
         self.m_bits = m_bits
+        self.maximum = 2 ** m_bits
+
+        # Start of each finger interval, (node_id + 2**i) mod 2**m_bits, computed once.
+        self.starts = [(node_id + (1 << i)) % self.maximum for i in range(m_bits)]
 
         # Initialize the finger table with m_bits entries.
         # Each entry is a tuple (node_id, node_addr) initially pointing to the node itself.
         self.table = [(node_id, node_addr) for _ in range(m_bits)]
 
+        # Distinct fingers sorted by clockwise distance from node_id (the ring rotated
+        # so that node_id is 0), rebuilt on the first find after a change.
+        self._distances = []
+        self._addresses = []
+        self._dirty = True
+
 
     def fill(self, node_id, node_addr):
         """ Fill all entries of the finger table with node_id, node_addr."""
 
         for i in range(self.m_bits):
             self.table[i] = (node_id, node_addr)
+        self._dirty = True
 
     def update(self, index, node_id, node_addr):
         """Update index of table with node_id and node_addr."""
 
-        self.table[index-1] = (node_id, node_addr) # Adjust for 0-based indexing in Python lists
-
+        if not 1 <= index <= self.m_bits:
+            raise ValueError(f"no finger {index}")
+        if self.table[index-1] != (node_id, node_addr): # Adjust for 0-based indexing in Python lists
+            self.table[index-1] = (node_id, node_addr)
+            self._dirty = True
+
+    def _rebuild(self):
+        """ Sort the distinct fingers by distance from node_id. """
+
+        # Consecutive fingers mostly point at the same node (all but ~log2(N) of them
+        # once m_bits is large), so runs are collapsed before sorting. On equal ids the
+        # highest index wins, as with the scan from the top.
+        fingers = {}
+        previous = None
+        for entry in self.table:
+            if entry != previous and entry[0] != self.node_id: # the node itself never precedes
+                fingers[(entry[0] - self.node_id) % self.maximum] = entry[1]
+            previous = entry
+
+        self._distances = sorted(fingers)
+        self._addresses = [fingers[distance] for distance in self._distances]
+        self._dirty = False
 
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
 
-        # Iterate in reverse through the finger table to find the highest entry that precedes the given identification.
-        for i in range(self.m_bits - 1, -1, -1):
-            node_id, node_addr = self.table[i]
+        if self._dirty:
+            self._rebuild()
 
-            if contains(node_id, self.node_id, identification):
-                return node_addr
-            
-        return self.table[0][1]
+        # Farthest finger in (node_id, identification): binary search on the distances.
+        distance = (identification - self.node_id) % self.maximum
+        if distance == 0:
+            position = len(self._distances)
+        else:
+            position = bisect_left(self._distances, distance)
+
+        if position == 0:
+            return self.table[0][1]
+        return self._addresses[position - 1]
 
     def refresh(self):
         """ Retrieve finger table entries requiring refresh. (ALL)"""
-        refreshList = []
-
-        for i in range(self.m_bits):
-            index = i + 1 
-            node = (self.node_id + 2 ** i) % (2 ** self.m_bits)
-            address = self.table[i][1]
-            refreshList.append((index,node,address))
 
-        return refreshList
+        return [(i + 1, start, self.table[i][1]) for i, start in enumerate(self.starts)]
 
     def getIdxFromId(self, id):
         """Return index in the finger table by id."""
 
-        temp = (id - self.node_id) % (2 ** self.m_bits)          
-        return int(math.log2(temp)) + 1
+        temp = (id - self.node_id) % self.maximum
+        return temp.bit_length() # exact, unlike log2 of a float for large rings
          
 
     def __repr__(self):
@@ -79,17 +108,21 @@ class FingerTable:
 class DHTNode(threading.Thread):
     """ DHT Node Agent. """
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    def __init__(self, address, dht_address=None, timeout=3, m_bits=M_BITS):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
             timeout: impacts how often stabilize algorithm is carried out
+            m_bits: size of the identifier space (2**m_bits ids), the same
+                for every node of the DHT
         """
         threading.Thread.__init__(self) # each node is a new thread
         self.done = False
-        self.identification = dht_hash(address.__str__())
+        self.m_bits = m_bits
+        self.maximum = 2 ** m_bits
+        self.identification = dht_hash(address.__str__(), maximum=self.maximum)
         self.addr = address  # My address
         self.dht_address = dht_address  # Address of the initial Node
         if dht_address is None:
@@ -109,7 +142,7 @@ class DHTNode(threading.Thread):
             self.predecessor_addr = None
 
         # Each node will have his own finger table
-        self.finger_table = FingerTable(self.identification,self.addr)    #TODO create finger_table
+        self.finger_table = FingerTable(self.identification,self.addr,m_bits)    #TODO create finger_table
         self.keystore = {}  # Where node data is stored
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -122,19 +155,23 @@ class DHTNode(threading.Thread):
 
     def send(self, address, msg):
         """ Send msg to address. """
-        payload = pickle.dumps(msg)
+        payload = encode(msg)
         self.socket.sendto(payload, address)
 
     def recv(self):
-        """ Retrieve msg payload and from address."""
+        """ Retrieve msg and from address. Datagrams that are not messages are dropped."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            payload, addr = self.socket.recvfrom(MAX_DATAGRAM)
         except socket.timeout:
             return None, None
 
         if len(payload) == 0:
             return None, addr
-        return payload, addr
+        try:
+            return decode(payload), addr
+        except CodecError as error:
+            self.logger.warning("Dropped datagram from %s: %s", addr, error)
+            return None, addr
 
     def node_join(self, args):
         """Process JOIN_REQ message.
@@ -224,15 +261,14 @@ class DHTNode(threading.Thread):
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
             # REFACTORED - Move data to new predecessor
-            for key, value in list(self.keystore.items()):
-                hash_key = dht_hash(key)
-                if not contains(self.predecessor_id, self.identification, dht_hash(key)):
+            keys = list(self.keystore)
+            for key, hash_key in zip(keys, dht_hash_many(keys, maximum=self.maximum)):
+                if not contains(self.predecessor_id, self.identification, hash_key):
                     self.logger.info("Required - Move data: %s", hash_key)
-                    msg = {"method": "PUT", "args": {"key": key, "value": value}}
+                    msg = {"method": "PUT", "args": {"key": key, "value": self.keystore[key]}}
                     self.send(self.predecessor_addr, msg)
-                    payload, addr = self.recv()
-                    if payload is not None:
-                        out = pickle.loads(payload)
+                    out, addr = self.recv()
+                    if out is not None:
                         if out["method"] == "ACK":
                             self.keystore.pop(key)
                             self.logger.critical("Moved data: %s [%s -> %s]", hash_key, self.identification, self.predecessor_id)
@@ -268,34 +304,82 @@ class DHTNode(threading.Thread):
         for node in refreshed_list:
             self.send(node[2],{"method": "SUCCESSOR", 'args': {"id": node[1], "from": self.addr}})
 
-    def put(self, key, value, address):
+    def owns(self, identification):
+        """ Check identification is mine (a lone node owns the whole ring). """
+        return self.predecessor_id == self.identification or contains(
+            self.predecessor_id, self.identification, identification
+        )
+
+    def partition(self, keys):
+        """ Split a batch of keys by owner.
+            Returns the positions of the keys that are mine and, for the others, their
+            positions grouped by next hop (closest preceding finger).
+        """
+        local = []
+        forward = {}
+        for i, key_hash in enumerate(dht_hash_many(keys, maximum=self.maximum)):
+            if self.owns(key_hash):
+                local.append(i)
+            else:
+                forward.setdefault(self.finger_table.find(key_hash), []).append(i)
+        return local, forward
+
+    def lookup(self, identification, address):
+        """Process LOOKUP message (one step of an iterative lookup).
+            Replies with the node owning identification and the segment of the ring it
+            owns or, if unknown here, with the closest preceding finger to ask next.
+
+        Parameters:
+            identification: id (key hash) being looked up
+            address: address where to send the reply
+        """
+
+        self.logger.debug("Lookup: %s", identification)
+        args = {"id": identification, "owner": True}
+        if self.owns(identification):
+            args.update(start=self.predecessor_id, node_id=self.identification, node_addr=self.addr)
+        elif contains(self.identification, self.successor_id, identification):
+            # My successor's
+            args.update(start=self.identification, node_id=self.successor_id, node_addr=self.successor_addr)
+        else:
+            args.update(owner=False, node_addr=self.finger_table.find(identification))
+        self.send(address, {"method": "LOOKUP_REP", "args": args})
+
+    def reply(self, address, msg, req=None):
+        """ Send a reply to a client, tagged with the id of its request (if any). """
+        if req is not None:
+            msg["req"] = req
+        self.send(address, msg)
+
+    def put(self, key, value, address, req=None):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        req: request id of the client, echoed in the reply
         """
-        key_hash = dht_hash(key)
+        key_hash = dht_hash(key, maximum=self.maximum)
         self.logger.debug("Put: %s %s", key, key_hash)
 
         #TODO Replace next code:
         
         if contains(self.predecessor_id, self.identification , key_hash):
             # key_hash between me and my predecessor (i have responsibility to store)
-            if key in self.keystore:
+            if key in self.keystore and self.keystore[key] != value: # the same value: a retry
                 self.logger.error("Put-Error: %s %s", key, key_hash)
-                self.send(address, {"method": "NACK"})
+                self.reply(address, {"method": "NACK"}, req)
                 self.logger.debug(self)
             else:
                 self.keystore[key] = value
                 self.logger.debug("Put-Done: %s %s", key, key_hash)
-                self.send(address, {"method": "ACK"})
+                self.reply(address, {"method": "ACK"}, req)
                 self.logger.debug(self)
                 
         else:
             # key_hash in one of the next nodes
-            msg = {"method": "PUT", "args": {"key": key, "value": value, "from": address}}
+            msg = {"method": "PUT", "args": {"key": key, "value": value, "from": address, "req": req}}
             self.logger.debug("Put-Redirect: %s", msg["args"]) 
             self.send(self.finger_table.find(key_hash), msg)
             self.logger.debug(self)
@@ -304,14 +388,15 @@ class DHTNode(threading.Thread):
              
         
 
-    def get(self, key, address):
+    def get(self, key, address, req=None):
         """Retrieve value from DHT.
 
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        req: request id of the client, echoed in the reply
         """
-        key_hash = dht_hash(key)
+        key_hash = dht_hash(key, maximum=self.maximum)
         self.logger.debug("Get: %s %s", key, key_hash)
 
         #TODO Replace next code:
@@ -320,32 +405,121 @@ class DHTNode(threading.Thread):
             # key_hash between me and my predecessor (i have responsibility to store)
             if not key in self.keystore:
                 self.logger.error("Get-Error: %s %s", key, key_hash)
-                self.send(address, {"method": "NACK"})
+                self.reply(address, {"method": "NACK"}, req)
                 self.logger.debug(self)
             else:
                 value = self.keystore[key]
                 self.logger.debug("Get-Done: %s %s", key, key_hash)
-                self.send(address, {"method": "ACK", "args": value})
+                self.reply(address, {"method": "ACK", "args": value}, req)
                 self.logger.debug(self)
                 
         else:
             # key_hash in one of the next nodes
-            msg = {"method": "GET", "args": {"key": key, "from": address}}
+            msg = {"method": "GET", "args": {"key": key, "from": address, "req": req}}
             self.logger.debug("Get-Redirect: %s", msg["args"])   
             self.send(self.finger_table.find(key_hash), msg)
             self.logger.debug(self)
 
+    def mput(self, items, address, req=None):
+        """Process MPUT message: store many values.
+            Stores the items this node owns and forwards the others, one datagram per
+            next hop. Each node replies to the client for the items it stored, the
+            client puts the replies together.
+
+        Parameters:
+        items: list of (key, value)
+        address: address where to send the reply
+        req: request id of the client, echoed in the reply
+        """
+        local, forward = self.partition([key for key, _ in items])
+        self.logger.debug("MPut: %d local, %d forwarded", len(local), len(items) - len(local))
+
+        if local:
+            stored, failed = [], []
+            for key, value in (items[i] for i in local):
+                if key in self.keystore and self.keystore[key] != value: # the same value: a retry
+                    failed.append(key)
+                else:
+                    self.keystore[key] = value
+                    stored.append(key)
+            self.reply(address, {"method": "MPUT_REP", "args": {"stored": stored, "failed": failed}}, req)
+
+        for next_hop, positions in forward.items():
+            self.forward(next_hop, "MPUT", [items[i] for i in positions], address, req)
+
+    def mget(self, keys, address, req=None):
+        """Process MGET message: retrieve many values.
+            Replies with the values of the keys this node owns (in as many datagrams
+            as they need) and forwards the others, one datagram per next hop.
+
+        Parameters:
+        keys: list of keys
+        address: address where to send the reply
+        req: request id of the client, echoed in the reply
+        """
+        local, forward = self.partition(keys)
+        self.logger.debug("MGet: %d local, %d forwarded", len(local), len(keys) - len(local))
+
+        if local:
+            found, missing = {}, []
+            for key in (keys[i] for i in local):
+                if key in self.keystore:
+                    found[key] = self.keystore[key]
+                else:
+                    missing.append(key)
+            self.reply_values(address, found, missing, req)
+
+        for next_hop, positions in forward.items():
+            self.forward(next_hop, "MGET", [keys[i] for i in positions], address, req)
+
+    def forward(self, next_hop, method, entries, address, req):
+        """ Forward MPUT items or MGET keys, split in halves until each fits in a
+            datagram: with the from address added, the batch of a client that
+            filled its datagram does not fit in one any more.
+        """
+        field = "items" if method == "MPUT" else "keys"
+        payload = encode({"method": method, "args": {field: entries, "from": address, "req": req}})
+        if len(payload) <= MAX_DATAGRAM:
+            self.socket.sendto(payload, next_hop)
+            return
+        if len(entries) < 2: # an item too large to forward: the client is told
+            key = entries[0][0] if method == "MPUT" else entries[0]
+            self.logger.error("%s-Error: %s too large to forward", method, key)
+            if method == "MPUT":
+                self.reply(address, {"method": "MPUT_REP", "args": {"stored": [], "failed": [key]}}, req)
+            else:
+                self.reply_values(address, {}, [key], req)
+            return
+        half = len(entries) // 2
+        self.forward(next_hop, method, entries[:half], address, req)
+        self.forward(next_hop, method, entries[half:], address, req)
+
+    def reply_values(self, address, found, missing, req):
+        """ Send MGET_REP, split in halves until each fits in a datagram. """
+        msg = {"method": "MGET_REP", "args": {"found": found, "missing": missing}, "req": req}
+        payload = encode(msg)
+        if len(payload) <= MAX_DATAGRAM:
+            self.socket.sendto(payload, address)
+            return
+        if len(found) < 2: # a value too large for a reply of its own
+            self.logger.error("MGet-Error: %s too large", list(found))
+            self.reply_values(address, {}, missing + list(found), req)
+            return
+        values = list(found.items())
+        half = len(values) // 2
+        self.reply_values(address, dict(values[:half]), missing, req)
+        self.reply_values(address, dict(values[half:]), [], req)
+
     def leave(self):
         """Leave the DHT."""
         self.logger.critical("Node leaving")
-        for key, value in list(self.keystore.items()):
-            hash_key = dht_hash(key)
+        keys = list(self.keystore)
+        for key, hash_key in zip(keys, dht_hash_many(keys, maximum=self.maximum)):
             self.logger.info("Required - Move data: %s", hash_key)
-            msg = {"method": "PUT", "args": {"key": key, "value": value}}
+            msg = {"method": "PUT", "args": {"key": key, "value": self.keystore[key]}}
             self.send(self.predecessor_addr, msg)
-            payload, addr = self.recv()
-            if payload is not None:
-                out = pickle.loads(payload)
+            out, addr = self.recv()
+            if out is not None:
                 if out["method"] == "ACK":
                     self.keystore.pop(key)
                     self.logger.critical("Moved data: %s [%s -> %s]", hash_key, self.identification, self.predecessor_id)
@@ -361,9 +535,8 @@ class DHTNode(threading.Thread):
                 "args": {"addr": self.addr, "id": self.identification},
             }
             self.send(self.dht_address, join_msg) # Send to root node
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
+            output, addr = self.recv()
+            if output is not None:
                 self.logger.debug("O: %s", output)
                 if output["method"] == "JOIN_REP": # Joining the DHT
                     args = output["args"]
@@ -381,46 +554,72 @@ class DHTNode(threading.Thread):
 
         # Enter the DHT
         while not self.done:
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(
-                        addr, {"method": "STABILIZE", "args": self.predecessor_id}
-                    )
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    #TODO Implement processing of SUCCESSOR_REP
-                    request_id = output["args"]["req_id"]
-                    successor_id = output["args"]["successor_id"]
-                    successor_addr = output["args"]["successor_addr"]
-
-                    index = self.finger_table.getIdxFromId(request_id)
-                    self.finger_table.update(index, successor_id, successor_addr)
-
-            else:  # timeout occurred, lets run the stabilize algorithm
-                # Ask successor for predecessor, to start the stabilize process
-                self.send(self.successor_addr, {"method": "PREDECESSOR"})
-                self.logger.debug(self)
+            output, addr = self.recv()
+            try:
+                if output is not None:
+                    self.logger.info("O: %s", output)
+                    self.handle(output, addr)
+                else:  # timeout occurred, lets run the stabilize algorithm
+                    # Ask successor for predecessor, to start the stabilize process
+                    self.send(self.successor_addr, {"method": "PREDECESSOR"})
+                    self.logger.debug(self)
+            except (OSError, ValueError) as error:
+                # An address that does not resolve, a bad finger: the message is
+                # dropped, the node keeps serving
+                self.logger.error("Failed to process %s from %s: %s", output and output["method"], addr, error)
+
+    def handle(self, output, addr):
+        """ Process a message received from addr. """
+        if output["method"] == "JOIN_REQ":
+            self.node_join(output["args"])
+        elif output["method"] == "NOTIFY":
+            self.notify(output["args"])
+        elif output["method"] == "PUT":
+            self.put(
+                output["args"]["key"],
+                output["args"]["value"],
+                output["args"].get("from", addr),
+                output["args"].get("req"),
+            )
+        elif output["method"] == "GET":
+            self.get(
+                output["args"]["key"],
+                output["args"].get("from", addr),
+                output["args"].get("req"),
+            )
+        elif output["method"] == "MPUT":
+            self.mput(
+                output["args"]["items"],
+                output["args"].get("from", addr),
+                output["args"].get("req"),
+            )
+        elif output["method"] == "MGET":
+            self.mget(
+                output["args"]["keys"],
+                output["args"].get("from", addr),
+                output["args"].get("req"),
+            )
+        elif output["method"] == "LOOKUP":
+            self.lookup(output["args"]["id"], addr)
+        elif output["method"] == "PREDECESSOR":
+            # Reply with predecessor id
+            self.send(
+                addr, {"method": "STABILIZE", "args": self.predecessor_id}
+            )
+        elif output["method"] == "SUCCESSOR":
+            # Reply with successor of id
+            self.get_successor(output["args"])
+        elif output["method"] == "STABILIZE":
+            # Initiate stabilize protocol
+            self.stabilize(output["args"], addr)
+        elif output["method"] == "SUCCESSOR_REP":
+            #TODO Implement processing of SUCCESSOR_REP
+            request_id = output["args"]["req_id"]
+            successor_id = output["args"]["successor_id"]
+            successor_addr = output["args"]["successor_addr"]
+
+            index = self.finger_table.getIdxFromId(request_id)
+            self.finger_table.update(index, successor_id, successor_addr) # index 0 (req_id is ours): ValueError
 
     def __str__(self): # REFACTORED
         ft = self.finger_table.table
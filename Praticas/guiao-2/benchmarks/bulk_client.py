@@ -0,0 +1,100 @@
+""" Bulk loads: DHTClient, one round trip per key, against DHTAsyncClient.put_many.
+
+Starts a DHT of --nodes nodes, one process each (logging off), stores --keys
+keys and reads them back with the blocking client, then with the asyncio client:
+a request per key at several limits of requests in flight, and MPUT/MGET batches
+of several sizes. Reports operations per second, the datagrams the client sent
+and received and the retransmissions (replies lost, mostly to full socket buffers).
+
+Usage: python3 -m benchmarks.bulk_client [--nodes 5] [--keys 10000]
+           [--in-flight 1 16 64 256 1024 4096] [--batch-bytes 1024 8192 32768]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+
+from DHTAsyncClient import DHTAsyncClient, MAX_IN_FLIGHT
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+
+PORT = 8000
+
+
+def serve(port, bootstrap):
+    """ One node per process, as on separate hosts. """
+    node = DHTNode(("localhost", port), bootstrap)
+    node.logger.setLevel(logging.CRITICAL)
+    node.start()
+    node.join()
+
+
+def start_dht(count):
+    nodes = []
+    for i in range(count):
+        node = multiprocessing.Process(
+            target=serve, args=(PORT + i, ("localhost", PORT) if i else None), daemon=True)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.2)
+    time.sleep(max(4, count)) # stabilize: successors and finger tables
+    return nodes
+
+
+def blocking(keys, prefix):
+    client = DHTClient(("localhost", PORT))
+    start = time.perf_counter()
+    assert all(client.put(f"{prefix}{key}", key) for key in keys)
+    stored = time.perf_counter() - start
+    start = time.perf_counter()
+    assert [client.get(f"{prefix}{key}") for key in keys] == list(keys)
+    return stored, time.perf_counter() - start, 4 * len(keys), 0
+
+
+async def bulk(keys, prefix, in_flight=MAX_IN_FLIGHT, batch_bytes=0):
+    async with DHTAsyncClient(("localhost", PORT), max_in_flight=in_flight,
+                              batch_bytes=batch_bytes) as client:
+        start = time.perf_counter()
+        assert all(await client.put_many((f"{prefix}{key}", key) for key in keys))
+        stored = time.perf_counter() - start
+        start = time.perf_counter()
+        assert await client.get_many(f"{prefix}{key}" for key in keys) == list(keys)
+        return stored, time.perf_counter() - start, client.datagrams, client.retransmissions
+
+
+def main(args):
+    dht = start_dht(args.nodes)
+
+    keys = range(args.keys)
+    runs = [("blocking", lambda: blocking(keys, "sync-"))]
+    for limit in args.in_flight:
+        runs.append((f"async {limit}", lambda limit=limit: asyncio.run(
+            bulk(keys, f"async{limit}-", in_flight=limit))))
+    for size in args.batch_bytes:
+        runs.append((f"batch {size}", lambda size=size: asyncio.run(
+            bulk(keys, f"batch{size}-", batch_bytes=size))))
+
+    results = []
+    print(f"{'client':>12} {'put/s':>8} {'get/s':>8} {'datagrams':>9} {'retransmitted':>13}")
+    for name, run in runs:
+        stored, read, datagrams, retransmissions = run()
+        results.append({"client": name, "nodes": args.nodes, "keys": args.keys,
+                        "put_per_s": args.keys / stored, "get_per_s": args.keys / read,
+                        "datagrams": datagrams, "retransmissions": retransmissions})
+        print(f"{name:>12} {args.keys / stored:>8.0f} {args.keys / read:>8.0f} "
+              f"{datagrams:>9} {retransmissions:>13}")
+    print(json.dumps(results))
+    for node in dht:
+        node.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 16, 64, 256, 1024, 4096])
+    parser.add_argument("--batch-bytes", type=int, nargs="+", default=[1024, 8192, 32768])
+
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+""" Wire format against pickle: encode and decode time, bytes per message.
+
+Messages typical of each part of the protocol: stabilization (small, ids and
+addresses), key requests and replies, and MPUT/MGET batches. --bits sets the size
+of the node ids (the binary format sends them in as many bytes as they need).
+
+Usage: python3 -m benchmarks.codec [--bits 10 160] [--batch 100] [--number 20000]
+"""
+import argparse
+import json
+import pickle
+import timeit
+
+from codec import encode, decode
+
+
+def messages(m_bits, batch):
+    node_id = 2 ** m_bits - 3
+    addr = ("localhost", 5001)
+    client = ("127.0.0.1", 45872)
+    return {
+        "SUCCESSOR": {"method": "SUCCESSOR", "args": {"id": node_id, "from": addr}},
+        "SUCCESSOR_REP": {"method": "SUCCESSOR_REP", "args": {
+            "req_id": node_id, "successor_id": node_id - 7, "successor_addr": addr}},
+        "STABILIZE": {"method": "STABILIZE", "args": node_id},
+        "PUT": {"method": "PUT", "args": {"key": "user:1234", "value": "Aveiro", "from": client, "req": 4242}},
+        "ACK (GET)": {"method": "ACK", "args": [0, 1, 2], "req": 4242},
+        "MPUT": {"method": "MPUT", "args": {
+            "items": [(f"user:{i}", {"name": f"n{i}", "age": i}) for i in range(batch)],
+            "from": client, "req": 7}},
+        "MGET_REP": {"method": "MGET_REP", "args": {
+            "found": {f"user:{i}": f"value {i}" for i in range(batch)}, "missing": []}, "req": 7},
+    }
+
+
+def measure(msg, number):
+    results = {}
+    for name, dumps, loads in [("pickle", pickle.dumps, pickle.loads), ("binary", encode, decode)]:
+        payload = dumps(msg)
+        assert loads(payload) == loads(dumps(msg))
+        results[name] = {
+            "bytes": len(payload),
+            "encode_us": min(timeit.repeat(lambda: dumps(msg), number=number, repeat=3)) / number * 1e6,
+            "decode_us": min(timeit.repeat(lambda: loads(payload), number=number, repeat=3)) / number * 1e6,
+        }
+    return results
+
+
+def main(args):
+    results = []
+    print(f"{'bits':>4} {'message':>14} {'bytes':>13} {'encode us':>15} {'decode us':>15}")
+    print(f"{'':>4} {'':>14} {'pickle binary':>13} {'pickle binary':>15} {'pickle binary':>15}")
+    for m_bits in args.bits:
+        for name, msg in messages(m_bits, args.batch).items():
+            number = args.number // (args.batch if name.startswith("M") else 1)
+            r = measure(msg, max(number, 100))
+            results.append({"bits": m_bits, "message": name, **r})
+            p, b = r["pickle"], r["binary"]
+            print(f"{m_bits:>4} {name:>14} {p['bytes']:>6} {b['bytes']:>6} "
+                  f"{p['encode_us']:>7.2f} {b['encode_us']:>7.2f} {p['decode_us']:>7.2f} {b['decode_us']:>7.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bits", type=int, nargs="+", default=[10, 160])
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--number", type=int, default=20000)
+
+    main(parser.parse_args())
@@ -0,0 +1,60 @@
+""" Throughput of large values: DHTAsyncClient.put_blob/get_blob, 1 KB to 100 MB.
+
+Starts a DHT of --nodes nodes, one process each (logging off), stores a random
+value of each size in chunks and reads it back, for each chunk size. Reports MB
+per second, the datagrams the client sent and received and the retransmissions.
+
+Usage: python3 -m benchmarks.large_values [--nodes 5]
+           [--sizes 1000 10000 100000 1000000 10000000 100000000]
+           [--chunk-size 8192 32768 60000] [--in-flight 4]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from DHTAsyncClient import DHTAsyncClient
+from benchmarks.bulk_client import start_dht, PORT
+
+
+async def transfer(key, data, chunk_size, in_flight):
+    async with DHTAsyncClient(("localhost", PORT), chunk_size=chunk_size,
+                              chunks_in_flight=in_flight) as client:
+        start = time.perf_counter()
+        assert await client.put_blob(key, data)
+        stored = time.perf_counter() - start
+        start = time.perf_counter()
+        assert await client.get_blob(key) == data
+        return stored, time.perf_counter() - start, client.datagrams, client.retransmissions
+
+
+def main(args):
+    dht = start_dht(args.nodes)
+
+    results = []
+    print(f"{'size':>10} {'chunk':>6} {'put MB/s':>9} {'get MB/s':>9} {'datagrams':>9} {'retransmitted':>13}")
+    for size in args.sizes:
+        data = os.urandom(size)
+        for chunk_size in args.chunk_size:
+            stored, read, datagrams, retransmissions = asyncio.run(
+                transfer(f"blob{size}-{chunk_size}", data, chunk_size, args.in_flight))
+            results.append({"size": size, "chunk_size": chunk_size, "nodes": args.nodes,
+                            "put_mb_per_s": size / stored / 1e6, "get_mb_per_s": size / read / 1e6,
+                            "datagrams": datagrams, "retransmissions": retransmissions})
+            print(f"{size:>10} {chunk_size:>6} {size / stored / 1e6:>9.2f} {size / read / 1e6:>9.2f} "
+                  f"{datagrams:>9} {retransmissions:>13}")
+    print(json.dumps(results))
+    for node in dht:
+        node.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000, 10000000, 100000000])
+    parser.add_argument("--chunk-size", type=int, nargs="+", default=[8192, 32768, 60000])
+    parser.add_argument("--in-flight", type=int, default=4)
+
+    main(parser.parse_args())
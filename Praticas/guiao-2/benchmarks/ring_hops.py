@@ -0,0 +1,102 @@
+""" Lookup hops in a simulated Chord ring, by ring size and identifier space.
+
+Builds the finger tables of N nodes (ids hashed from their addresses, as
+DHTNode does, every finger pointing at the successor of its start) and
+routes random keys the way DHTNode.put/get forward them: to the closest
+preceding finger until the node owning the key is reached. Reports node id
+collisions and the mean, p99 and max hops next to log2(N).
+
+Usage: python3 -m benchmarks.ring_hops [--nodes 100 1000 10000]
+           [--bits 10 32 64 160] [--lookups 10000]
+"""
+import argparse
+import json
+import math
+import random
+import time
+from bisect import bisect_left
+
+from DHTNode import FingerTable
+from utils import contains, dht_hash_many
+
+
+def build_ring(count, m_bits):
+    """ Finger tables and predecessors of count nodes (colliding ids are lost). """
+    addresses = [(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 5000) for i in range(count)]
+    nodes = {}
+    for node_id, address in zip(dht_hash_many(map(str, addresses), maximum=2 ** m_bits), addresses):
+        nodes.setdefault(node_id, address)
+    ring = sorted(nodes)
+
+    def successor(identification):
+        return ring[bisect_left(ring, identification) % len(ring)]
+
+    tables = {}
+    for node_id in ring:
+        table = FingerTable(node_id, nodes[node_id], m_bits)
+        for index, start, _ in table.refresh():
+            finger = successor(start)
+            table.update(index, finger, nodes[finger])
+        tables[node_id] = table
+    predecessors = {node_id: ring[i - 1] for i, node_id in enumerate(ring)}
+    return tables, predecessors, {address: node_id for node_id, address in nodes.items()}
+
+
+def lookup(tables, predecessors, ids, start, key_hash, limit):
+    """ Hops from node start to the node owning key_hash. """
+    node, hops = start, 0
+    while not contains(predecessors[node], node, key_hash):
+        node = ids[tables[node].find(key_hash)]
+        hops += 1
+        if hops > limit:
+            raise RuntimeError(f"lookup of {key_hash} did not converge")
+    return hops
+
+
+def run(count, m_bits, lookups, rng):
+    start = time.perf_counter()
+    tables, predecessors, ids = build_ring(count, m_bits)
+    built = time.perf_counter() - start
+
+    ring = list(tables)
+    keys = dht_hash_many((f"key-{rng.random()}" for _ in range(lookups)), maximum=2 ** m_bits)
+    start = time.perf_counter()
+    hops = sorted(lookup(tables, predecessors, ids, rng.choice(ring), key, 2 * m_bits + len(ring))
+                  for key in keys)
+    routed = time.perf_counter() - start
+
+    return {
+        "nodes": count, "bits": m_bits, "distinct_ids": len(ring),
+        "collisions": count - len(ring),
+        "hops_mean": sum(hops) / len(hops),
+        "hops_p99": hops[min(len(hops) - 1, int(len(hops) * 0.99))],
+        "hops_max": hops[-1],
+        "log2_n": math.log2(len(ring)),
+        "build_s": built,
+        "lookup_us": routed / lookups * 1e6,
+    }
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'bits':>4} {'nodes':>6} {'ids':>6} {'collide':>7} {'mean':>6} {'p99':>4} "
+          f"{'max':>4} {'log2N':>6} {'mean/log2N':>10} {'lookup us':>9}")
+    for m_bits in args.bits:
+        for count in args.nodes:
+            r = run(count, m_bits, args.lookups, rng)
+            results.append(r)
+            print(f"{m_bits:>4} {count:>6} {r['distinct_ids']:>6} {r['collisions']:>7} "
+                  f"{r['hops_mean']:>6.2f} {r['hops_p99']:>4} {r['hops_max']:>4} "
+                  f"{r['log2_n']:>6.2f} {r['hops_mean'] / r['log2_n']:>10.3f} {r['lookup_us']:>9.1f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--bits", type=int, nargs="+", default=[10, 32, 64, 160])
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+
+    main(parser.parse_args())
@@ -0,0 +1,431 @@
+""" Binary wire format of the DHT messages: compact, and safe to decode from anyone.
+
+A message is a 4 byte header (version, method code, width in bytes of the node ids,
+bitmask of the fields present) followed by the fields present, in the order of the
+schema of its method (SCHEMAS). Lengths and counts are varints (LEB128):
+
+    ID       node id, unsigned big endian, as wide as the header says
+    ADDR     u8 length + host (UTF-8), u16 port
+    KEY      length + UTF-8
+    VALUE    length + tagged value: None, bool, int (zigzag varint, or length +
+             bytes past 64 bits), float (f64), str, bytes, list, tuple or dict
+    REQ      request id (varint)
+    BOOL     u8
+    KEYS     count + KEY...
+    ITEMS    count + (KEY, VALUE)... (a list of pairs)
+    MAPPING  count + (KEY, VALUE)... (a dict)
+
+Optional fields that are None are not sent (nor decoded); a VALUE that is None is
+sent as such, and any other required field missing is an error. An ADDR is a non-empty
+host and a port in 1..65535, both ways. Decoding checks every length against the
+datagram and never builds anything but the plain values above: a bad datagram raises
+CodecError, it cannot run code.
+"""
+import struct
+
+VERSION = 1
+
+ID, ADDR, KEY, VALUE, REQ, BOOL, KEYS, ITEMS, MAPPING = range(9)
+WHOLE = "" # the field is args itself (not a dict)
+TOP = "^req" # the request id echoed in a reply (next to args, not in it)
+
+OPTIONAL = True # third item of a field: it may be absent (None), the others may not
+
+# Method code (index) -> method, fields: codes are part of the format, append only.
+SCHEMAS = [
+    (None, ()),
+    ("JOIN_REQ", (("addr", ADDR), ("id", ID))),
+    ("JOIN_REP", (("successor_id", ID), ("successor_addr", ADDR))),
+    ("NOTIFY", (("predecessor_id", ID), ("predecessor_addr", ADDR))),
+    ("PUT", (("key", KEY), ("value", VALUE), ("from", ADDR, OPTIONAL), ("req", REQ, OPTIONAL))),
+    ("GET", (("key", KEY), ("from", ADDR, OPTIONAL), ("req", REQ, OPTIONAL))),
+    ("ACK", ((WHOLE, VALUE), (TOP, REQ, OPTIONAL))),
+    ("NACK", ((TOP, REQ, OPTIONAL),)),
+    ("PREDECESSOR", ()),
+    ("STABILIZE", ((WHOLE, ID, OPTIONAL),)),
+    ("SUCCESSOR", (("id", ID), ("from", ADDR))),
+    ("SUCCESSOR_REP", (("req_id", ID), ("successor_id", ID), ("successor_addr", ADDR))),
+    ("LOOKUP", (("id", ID),)),
+    ("LOOKUP_REP", (("id", ID), ("owner", BOOL), ("start", ID, OPTIONAL), ("node_id", ID, OPTIONAL),
+                    ("node_addr", ADDR))),
+    ("MPUT", (("items", ITEMS), ("from", ADDR, OPTIONAL), ("req", REQ, OPTIONAL))),
+    ("MGET", (("keys", KEYS), ("from", ADDR, OPTIONAL), ("req", REQ, OPTIONAL))),
+    ("MPUT_REP", (("stored", KEYS), ("failed", KEYS), (TOP, REQ, OPTIONAL))),
+    ("MGET_REP", (("found", MAPPING), ("missing", KEYS), (TOP, REQ, OPTIONAL))),
+]
+METHODS = {method: (code, fields) for code, (method, fields) in enumerate(SCHEMAS) if method}
+# Field names of the methods whose args is a dict
+FIELDS = [{field[0] for field in fields} if any(field[0] not in (WHOLE, TOP) for field in fields) else None
+          for _, fields in SCHEMAS]
+# Bitmask of the fields that must be present
+REQUIRED = [sum(1 << i for i, field in enumerate(fields) if len(field) == 2) for _, fields in SCHEMAS]
+
+HEADER = struct.Struct(">BBBB")
+PORT = struct.Struct(">H")
+FLOAT = struct.Struct(">d")
+
+# Value tags
+T_NONE, T_FALSE, T_TRUE, T_INT, T_BIGINT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_TUPLE, T_DICT = range(11)
+MAX_DEPTH = 32 # nesting of lists, tuples and dicts in a value
+MAX_VARINT = 10 # bytes: 64 bits (larger ints are T_BIGINT, decoded at C speed)
+
+
+class CodecError(ValueError):
+    """ Not a valid message (of this version of the format). """
+
+
+def encode(msg):
+    """ Datagram of a message (dict with method, args and, in replies, req). """
+    try:
+        code, fields = METHODS[msg["method"]]
+    except KeyError:
+        raise CodecError(f"unknown method {msg.get('method')!r}") from None
+
+    args = msg.get("args")
+    names = FIELDS[code]
+    if names is not None:
+        if not isinstance(args, dict):
+            raise CodecError(f"{msg['method']}: args is not a dict")
+        for name, value in args.items():
+            if name not in names and value is not None:
+                raise CodecError(f"{msg['method']}: unknown field {name}")
+
+    present = 0
+    width = 1
+    values = []
+    for i, (name, kind, *_) in enumerate(fields):
+        if name is WHOLE:
+            value = args
+        elif name is TOP:
+            value = msg.get("req")
+        else:
+            value = args.get(name)
+        if value is not None or kind == VALUE:
+            present |= 1 << i
+            values.append((kind, value))
+            if kind == ID and value > 255:
+                width = max(width, (value.bit_length() + 7) // 8)
+
+    if ~present & REQUIRED[code]:
+        raise CodecError(f"{msg['method']}: required fields missing")
+
+    out = bytearray(HEADER.pack(VERSION, code, width, present))
+    try:
+        for kind, value in values:
+            if kind == ID:
+                out += value.to_bytes(width, "big")
+            elif kind == KEY:
+                _encode_str(out, value)
+            elif kind == VALUE:
+                _encode_length_prefixed(out, value)
+            elif kind == ADDR:
+                host, port = value
+                if not isinstance(host, str) or not host or isinstance(port, bool) \
+                        or not isinstance(port, int) or not 0 < port < 1 << 16:
+                    raise CodecError(f"{msg['method']}: invalid address {value!r}")
+                host = host.encode()
+                out.append(len(host)) # ValueError past 255 bytes
+                out += host
+                out += PORT.pack(port)
+            elif kind == REQ:
+                _encode_uvarint(out, value)
+            elif kind == BOOL:
+                out.append(1 if value else 0)
+            elif kind == KEYS:
+                _encode_uvarint(out, len(value))
+                for key in value:
+                    _encode_str(out, key)
+            else: # ITEMS, MAPPING
+                _encode_uvarint(out, len(value))
+                for key, item in value.items() if kind == MAPPING else value:
+                    _encode_str(out, key)
+                    _encode_length_prefixed(out, item)
+    except (struct.error, OverflowError, AttributeError, TypeError, ValueError) as error:
+        raise CodecError(f"{msg['method']}: {error}") from None
+    return bytes(out)
+
+
+def decode(payload):
+    """ Message of a datagram (bytes-like). Raises CodecError if it is not valid. """
+    view = bytes(payload) # indexing and slicing bytes is faster than a memoryview
+    size = len(view)
+    if size < HEADER.size:
+        raise CodecError("truncated header")
+    version, code, width, present = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise CodecError(f"unsupported version {version}")
+    if not 0 < code < len(SCHEMAS):
+        raise CodecError(f"unknown method code {code}")
+    method, fields = SCHEMAS[code]
+    if present >> len(fields):
+        raise CodecError(f"{method}: unknown fields")
+    if ~present & REQUIRED[code]:
+        raise CodecError(f"{method}: required fields missing")
+
+    msg = {"method": method}
+    args = None
+    if FIELDS[code] is not None:
+        args = msg["args"] = {}
+    elif fields and fields[0][0] is WHOLE:
+        msg["args"] = None
+
+    offset = HEADER.size
+    try:
+        for i, (name, kind, *_) in enumerate(fields):
+            if not present >> i & 1:
+                continue
+            if kind == ID:
+                end = offset + width
+                if end > size:
+                    raise CodecError("truncated id")
+                value = int.from_bytes(view[offset:end], "big")
+                offset = end
+            elif kind == KEY:
+                value, offset = _decode_str(view, offset, size)
+            elif kind == VALUE:
+                value, offset = _decode_length_prefixed(view, offset, size)
+            elif kind == ADDR:
+                end = offset + 1 + view[offset]
+                if end + 2 > size:
+                    raise CodecError("truncated address")
+                value = (view[offset + 1:end].decode(), PORT.unpack_from(view, end)[0])
+                if end == offset + 1 or not value[1]:
+                    raise CodecError(f"invalid address {value}")
+                offset = end + 2
+            elif kind == REQ:
+                value, offset = _decode_uvarint(view, offset)
+            elif kind == BOOL:
+                value = view[offset] != 0
+                offset += 1
+            else: # KEYS, ITEMS, MAPPING
+                count, offset = _decode_uvarint(view, offset)
+                if count > size - offset: # every entry takes a byte at least
+                    raise CodecError("count larger than the datagram")
+                value = []
+                append = value.append
+                for _ in range(count):
+                    # Short keys and values inline (the common case in batches)
+                    length = view[offset]
+                    end = offset + 1 + length
+                    if length < 0x80 and end <= size:
+                        key = view[offset + 1:end].decode()
+                        offset = end
+                    else:
+                        key, offset = _decode_str(view, offset, size)
+                    if kind == KEYS:
+                        append(key)
+                        continue
+                    length = view[offset]
+                    end = offset + 1 + length
+                    if length < 0x80 and end <= size:
+                        item, offset = _decode_value(view, offset + 1, end, 0)
+                        if offset != end:
+                            raise CodecError("value and its length differ")
+                    else:
+                        item, offset = _decode_length_prefixed(view, offset, size)
+                    append((key, item))
+                if kind == MAPPING:
+                    value = dict(value)
+                    if kind == MAPPING:
+                        value = dict(value)
+
+            if name is WHOLE:
+                msg["args"] = value
+            elif name is TOP:
+                msg["req"] = value
+            else:
+                args[name] = value
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise CodecError(f"{method}: {error}") from None
+
+    if offset != size:
+        raise CodecError(f"{method}: {size - offset} trailing bytes")
+    return msg
+
+
+def encode_value(obj):
+    """ Tagged encoding of a value (as in a VALUE field, without the length). """
+    out = bytearray()
+    try:
+        _encode_value(out, obj, 0)
+    except (OverflowError, ValueError) as error:
+        raise CodecError(str(error)) from None
+    return out
+
+
+def _encode_uvarint(out, number):
+    if number < 0:
+        raise CodecError("negative length or id")
+    while number > 0x7F:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _decode_uvarint(view, offset):
+    byte = view[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    number = byte & 0x7F
+    shift = 7
+    while True:
+        offset += 1
+        byte = view[offset]
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset + 1
+        shift += 7
+        if shift >= 7 * MAX_VARINT:
+            raise CodecError("varint too long")
+
+
+def _encode_str(out, text):
+    data = text.encode()
+    _encode_uvarint(out, len(data))
+    out += data
+
+
+def _decode_str(view, offset, end):
+    length = view[offset]
+    if length < 0x80:
+        offset += 1
+    else:
+        length, offset = _decode_uvarint(view, offset)
+    stop = offset + length
+    if stop > end:
+        raise CodecError("truncated string")
+    return view[offset:stop].decode(), stop
+
+
+def _encode_length_prefixed(out, obj):
+    data = encode_value(obj)
+    _encode_uvarint(out, len(data))
+    out += data
+
+
+def _decode_length_prefixed(view, offset, size):
+    length, offset = _decode_uvarint(view, offset)
+    end = offset + length
+    if end > size:
+        raise CodecError("truncated value")
+    value, offset = _decode_value(view, offset, end, 0)
+    if offset != end:
+        raise CodecError("value and its length differ")
+    return value, end
+
+
+def _encode_value(out, obj, depth):
+    kind = type(obj)
+    if kind is str:
+        out.append(T_STR)
+        _encode_str(out, obj)
+    elif kind is int:
+        if -2**63 <= obj < 2**63:
+            out.append(T_INT)
+            _encode_uvarint(out, obj << 1 if obj >= 0 else ~obj << 1 | 1) # zigzag
+        else:
+            data = obj.to_bytes((obj.bit_length() + 8) // 8, "big", signed=True)
+            out.append(T_BIGINT)
+            _encode_uvarint(out, len(data))
+            out += data
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        out.append(T_BYTES)
+        _encode_uvarint(out, len(obj))
+        out += obj
+    elif obj is None:
+        out.append(T_NONE)
+    elif kind is bool:
+        out.append(T_TRUE if obj else T_FALSE)
+    elif kind is float:
+        out.append(T_FLOAT)
+        out += FLOAT.pack(obj)
+    elif kind is list or kind is tuple or kind is dict:
+        if depth == MAX_DEPTH:
+            raise CodecError("value nested too deep")
+        out.append(T_LIST if kind is list else T_TUPLE if kind is tuple else T_DICT)
+        _encode_uvarint(out, len(obj))
+        if kind is dict:
+            for key, value in obj.items():
+                _encode_value(out, key, depth + 1)
+                _encode_value(out, value, depth + 1)
+        else:
+            for value in obj:
+                _encode_value(out, value, depth + 1)
+    else:
+        raise CodecError(f"cannot encode {kind.__name__}")
+
+
+def _decode_value(view, offset, end, depth):
+    if offset >= end:
+        raise CodecError("truncated value")
+    tag = view[offset]
+    offset += 1
+    # Strings and small ints inline: most values are (or are made of) them
+    if tag == T_STR:
+        length = view[offset]
+        if length < 0x80:
+            stop = offset + 1 + length
+            if stop > end:
+                raise CodecError("truncated string")
+            return view[offset + 1:stop].decode(), stop
+        return _decode_str(view, offset, end)
+    if tag == T_INT:
+        number = view[offset]
+        if number < 0x80:
+            return (number >> 1) ^ -(number & 1), offset + 1
+        number, offset = _decode_uvarint(view, offset)
+        return (number >> 1) ^ -(number & 1), offset
+    if tag == T_BYTES or tag == T_BIGINT:
+        length, offset = _decode_uvarint(view, offset)
+        stop = offset + length
+        if stop > end:
+            raise CodecError("truncated value")
+        if tag == T_BYTES:
+            return view[offset:stop], stop
+        return int.from_bytes(view[offset:stop], "big", signed=True), stop
+    if tag == T_NONE:
+        return None, offset
+    if tag == T_FALSE or tag == T_TRUE:
+        return tag == T_TRUE, offset
+    if tag == T_FLOAT:
+        if offset + 8 > end:
+            raise CodecError("truncated value")
+        return FLOAT.unpack_from(view, offset)[0], offset + 8
+    if tag == T_LIST or tag == T_TUPLE or tag == T_DICT:
+        if depth == MAX_DEPTH:
+            raise CodecError("value nested too deep")
+        count, offset = _decode_uvarint(view, offset)
+        if tag == T_DICT:
+            count *= 2
+        if count > end - offset: # every element takes a byte at least
+            raise CodecError("count larger than the value")
+        values = []
+        append = values.append
+        for _ in range(count):
+            # Short strings and small ints without a call (nor recursion)
+            if offset + 1 < end:
+                child = view[offset]
+                if child == T_STR:
+                    length = view[offset + 1]
+                    stop = offset + 2 + length
+                    if length < 0x80 and stop <= end:
+                        append(view[offset + 2:stop].decode())
+                        offset = stop
+                        continue
+                elif child == T_INT:
+                    number = view[offset + 1]
+                    if number < 0x80:
+                        append((number >> 1) ^ -(number & 1))
+                        offset += 2
+                        continue
+            value, offset = _decode_value(view, offset, end, depth + 1)
+            append(value)
+        if tag == T_LIST:
+            return values, offset
+        if tag == T_TUPLE:
+            return tuple(values), offset
+        try:
+            return dict(zip(values[::2], values[1::2])), offset
+        except TypeError: # unhashable key
+            raise CodecError("unhashable dict key") from None
+    raise CodecError(f"unknown value tag {tag}")
@@ -0,0 +1,65 @@
+""" FNV-1a hashing of DHT keys, one at a time or in bulk. """
+try:
+    import numpy as np
+except ImportError: # optional, bulk hashing falls back to one key at a time
+    np = None
+
+FNV_PRIME = 16777619
+OFFSET_BASIS = 2166136261
+CACHE_SIZE = 2**16 # keys (and node addresses) remembered by utils.dht_hash
+
+
+def fnv1a(text, seed=0, maximum=2**10):
+    """ FNV-1a hash of the characters (code points) of text, modulo maximum.
+
+    For a power of two maximum only the low bits matter (xor and product
+    never carry into them from above), so the hash is kept to those bits
+    instead of growing into a big integer with every character.
+    """
+    if maximum & (maximum - 1): # Other moduli need the exact value
+        h = OFFSET_BASIS + seed
+        for char in text:
+            h = (h ^ ord(char)) * FNV_PRIME
+        return h % maximum
+
+    mask = maximum - 1
+    h = (OFFSET_BASIS + seed) & mask
+    if text.isascii(): # Iterating the bytes saves the ord() calls
+        for code in text.encode("ascii"):
+            h = ((h ^ code) * FNV_PRIME) & mask
+        return h
+    for char in text:
+        h = ((h ^ ord(char)) * FNV_PRIME) & mask
+    return h
+
+
+def fnv1a_many(texts, seed=0, maximum=2**10):
+    """ fnv1a of every text, as a list.
+
+    With NumPy (and a power of two maximum up to 2**64) the keys are hashed
+    together: one vector operation per character position, over the keys
+    at least that long, in wrapping 64-bit arithmetic.
+    """
+    texts = list(texts)
+    if np is None or not texts or maximum & (maximum - 1) or maximum > 2**64:
+        return [fnv1a(text, seed, maximum) for text in texts]
+
+    # surrogatepass: lone surrogates hash to their code point, as in fnv1a
+    codes = np.frombuffer("".join(texts).encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.uint64)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    offsets = np.zeros(len(texts), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+
+    # Longest first: the keys still being hashed at position j are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    descending = -lengths[order]
+    offsets = offsets[order]
+    h = np.full(len(texts), (OFFSET_BASIS + seed) % 2**64, dtype=np.uint64)
+    prime = np.uint64(FNV_PRIME)
+    for j in range(int(-descending[0])):
+        n = int(np.searchsorted(descending, -j, side="left")) # keys longer than j
+        h[:n] = (h[:n] ^ codes[offsets[:n] + j]) * prime
+
+    hashes = np.empty_like(h)
+    hashes[order] = h & np.uint64(maximum - 1)
+    return hashes.tolist()
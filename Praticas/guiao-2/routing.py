@@ -0,0 +1,67 @@
+""" Client side routing cache: ring segments learned from iterative lookups. """
+import time
+from bisect import bisect_left, insort
+
+from utils import contains
+
+CACHE_TTL = 30 # seconds a learned segment is trusted (nodes join and leave)
+CACHE_SIZE = 1024 # segments kept, the oldest are evicted first
+
+
+class RoutingCache:
+    """Ring segments (start, end] -> address of the node end, which owns them.
+
+    Segments are indexed by their end (the id of the owner), kept sorted, so the
+    segment of an id is the first one ending at or after it (wrapping around the
+    ring): a binary search.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self.ends = [] # sorted segment ends
+        self.segments = {} # end -> (start, address, expires), oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add(self, start, end, address):
+        """ Record that node end, at address, owns the ids in (start, end]. """
+
+        # Node end knows of no node in between: those cached there left the ring
+        for other in [other for other in self.ends if start == end or contains(start, end, other)]:
+            self._remove(other)
+
+        insort(self.ends, end)
+        self.segments[end] = (start, address, self.clock() + self.ttl)
+
+        while len(self.segments) > self.size:
+            self._remove(next(iter(self.segments)))
+
+    def get(self, identification):
+        """ Address of the node owning identification, None if unknown or expired. """
+
+        if self.ends:
+            end = self.ends[bisect_left(self.ends, identification) % len(self.ends)]
+            start, address, expires = self.segments[end]
+            if expires <= self.clock():
+                self._remove(end)
+            elif start == end or contains(start, end, identification): # start == end: a lone node
+                self.hits += 1
+                return address
+
+        self.misses += 1
+        return None
+
+    def invalidate(self, address):
+        """ Forget the segments of a node that stopped answering. """
+
+        for end in [end for end, segment in self.segments.items() if segment[1] == address]:
+            self._remove(end)
+
+    def _remove(self, end):
+        del self.segments[end]
+        del self.ends[bisect_left(self.ends, end)]
@@ -0,0 +1,125 @@
+"""Test the asyncio client against a two node DHT of its own."""
+import asyncio
+import logging
+import random
+import time
+
+import pytest
+
+from DHTAsyncClient import DHTAsyncClient, BATCH_BYTES
+from DHTNode import DHTNode
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = [DHTNode(("localhost", 7000)), DHTNode(("localhost", 7001), ("localhost", 7000))]
+    for node in nodes:
+        node.logger.setLevel(logging.WARNING)
+        node.start()
+        time.sleep(0.5)
+    yield nodes
+    for node in nodes:
+        node.done = True
+    for node in nodes:
+        node.join()
+
+
+@pytest.mark.parametrize("batch_bytes", [BATCH_BYTES, 0])
+def test_put_many_get_many(ring, batch_bytes):
+    async def scenario():
+        async with DHTAsyncClient(("localhost", 7000), batch_bytes=batch_bytes) as client:
+            items = {f"bulk{batch_bytes}-{i}": i for i in range(2000)}
+            assert await client.put_many(items) == [True] * len(items)
+            assert await client.get_many(items) == list(items.values())
+            assert await client.get_many(["missing", f"bulk{batch_bytes}-1"]) == [None, 1]
+            assert await client.get("missing") is None
+
+            # Storing the same value again succeeds (a retry), another value does not
+            assert await client.put_many([(f"bulk{batch_bytes}-0", 0), (f"bulk{batch_bytes}-1", 0)]) == [True, False]
+            assert await client.put(f"bulk{batch_bytes}-0", 0)
+            assert not await client.put(f"bulk{batch_bytes}-0", 1)
+            return client.datagrams
+
+    datagrams = asyncio.run(scenario())
+    # A request and a reply per key, or a few per batch of 8 KiB (~400 keys)
+    assert datagrams > 8000 if batch_bytes == 0 else datagrams < 100
+    assert all(node.keystore for node in ring)
+
+
+def test_large_values(ring):
+    """ values too many for a reply come back in several """
+    async def scenario():
+        async with DHTAsyncClient(("localhost", 7000)) as client:
+            items = {f"large-{i}": bytes([i]) * 20000 for i in range(20)}
+            assert await client.put_many(items) == [True] * len(items)
+            assert await client.get_many(items) == list(items.values())
+
+    asyncio.run(scenario())
+
+
+class LossySocket:
+    """ Socket losing some of the datagrams received. """
+
+    def __init__(self, sock, loss):
+        self.sock = sock
+        self.loss = loss
+        self.rng = random.Random(1)
+
+    def recvfrom(self, size):
+        while True:
+            payload, addr = self.sock.recvfrom(size)
+            if self.rng.random() >= self.loss:
+                return payload, addr
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+@pytest.mark.parametrize("batch_bytes", [256, 0])
+def test_lost_replies(ring, batch_bytes):
+    async def scenario():
+        async with DHTAsyncClient(("localhost", 7000), timeout=0.05, retries=8, batch_bytes=batch_bytes) as client:
+            client.socket = LossySocket(client.socket, 0.2) # A fifth of the replies are lost
+
+            items = [(f"lossy{batch_bytes}-{i}", i) for i in range(200)]
+            assert await client.put_many(items) == [True] * len(items)
+            assert await client.get_many(key for key, _ in items) == list(range(200))
+            assert client.retransmissions > 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("batch_bytes, requests", [(BATCH_BYTES, 1), (0, 2)])
+def test_no_reply(batch_bytes, requests):
+    async def scenario():
+        async with DHTAsyncClient(("localhost", 7999), timeout=0.02, retries=3, batch_bytes=batch_bytes) as client:
+            assert await client.get_many(["a", "b"]) == [None, None]
+            assert client.retransmissions == requests * 3
+            assert client.pending == {}
+
+    asyncio.run(scenario())
+
+
+def test_blob(ring):
+    """ values larger than a datagram are stored in chunks """
+    async def scenario():
+        async with DHTAsyncClient(("localhost", 7000), chunk_size=8192) as client:
+            blobs = {f"blob-{size}": random.Random(size).randbytes(size) for size in [0, 1, 8192, 100000]}
+            for key, data in blobs.items():
+                assert await client.put_blob(key, data)
+            for key, data in blobs.items():
+                assert await client.get_blob(key) == data
+            assert await client.put_blob("blob-1", blobs["blob-1"]) # again: the same chunks
+            assert await client.get_blob("missing") is None
+
+            # Chunks spread over the ring
+            assert all(any(key.startswith("blob-100000#") for key in node.keystore) for node in ring)
+
+            # A chunk lost (or replaced) is detected
+            for node in ring:
+                for key in list(node.keystore):
+                    if key.startswith("blob-100000#") and key.endswith("#3"):
+                        node.keystore[key] = b"x" * 8192
+            assert await client.get_blob("blob-100000") is None
+
+    asyncio.run(scenario())
@@ -1,6 +1,10 @@
 """Tests two clients."""
+import socket
+import threading
+
 import pytest
 from DHTClient import DHTClient
+from codec import encode, decode
 
 
 @pytest.fixture()
@@ -26,3 +30,24 @@ def test_put_remote(client):
 def test_get_remote(client):
     """ retrieve from DHT (this key is not on the first node -> remote search) """
     assert client.get("2") == "xpto"
+
+
+def test_late_reply():
+    """ the late reply to a request that timed out is not taken for the next one's """
+    node = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    node.bind(("localhost", 0))
+    client = DHTClient(node.getsockname(), timeout=0.2)
+
+    assert not client.put("a", 1) # No reply in time
+    put, address = node.recvfrom(1024)
+    node.sendto(encode({"method": "NACK", "req": decode(put)["args"]["req"]}), address)
+
+    def answer():
+        get = decode(node.recvfrom(1024)[0])
+        node.sendto(encode({"method": "ACK", "args": get["args"]["key"].upper(), "req": get["args"]["req"]}), address)
+
+    responder = threading.Thread(target=answer)
+    responder.start()
+    assert client.get("b") == "B" # Not the NACK of the put, waiting ahead of the reply
+    responder.join()
+    node.close()
@@ -0,0 +1,120 @@
+"""Tests the wire format of the messages."""
+import pickle
+
+import pytest
+
+from codec import encode, decode, CodecError, HEADER, MAX_DEPTH, PORT, VERSION
+
+ADDR = ("localhost", 5001)
+VALUES = [None, True, False, 0, -1, 2**63 - 1, -2**63, 2**200, -2**200, 1.5, "", "ação",
+          b"\x00\xff", [], (1, "a"), {"a": [1, {"b": (None,)}], 2: b""}]
+
+MESSAGES = [
+    {"method": "JOIN_REQ", "args": {"addr": ADDR, "id": 12}},
+    {"method": "JOIN_REP", "args": {"successor_id": 0, "successor_addr": ADDR}},
+    {"method": "NOTIFY", "args": {"predecessor_id": 2**160 - 1, "predecessor_addr": ADDR}},
+    {"method": "PUT", "args": {"key": "k", "value": VALUES}},
+    {"method": "PUT", "args": {"key": "k", "value": None, "from": ADDR, "req": 2**40}},
+    {"method": "GET", "args": {"key": "chave", "from": ADDR, "req": 0}},
+    {"method": "ACK", "args": None},
+    {"method": "ACK", "args": {"x": 1}, "req": 7},
+    {"method": "NACK", "req": 300},
+    {"method": "NACK"},
+    {"method": "PREDECESSOR"},
+    {"method": "STABILIZE", "args": 1000},
+    {"method": "STABILIZE", "args": None},
+    {"method": "SUCCESSOR", "args": {"id": 513, "from": ADDR}},
+    {"method": "SUCCESSOR_REP", "args": {"req_id": 1, "successor_id": 2**70, "successor_addr": ADDR}},
+    {"method": "LOOKUP", "args": {"id": 99}},
+    {"method": "LOOKUP_REP", "args": {"id": 99, "owner": True, "start": 10, "node_id": 100, "node_addr": ADDR}},
+    {"method": "LOOKUP_REP", "args": {"id": 99, "owner": False, "node_addr": ADDR}},
+    {"method": "MPUT", "args": {"items": [("a", 1), ("b", VALUES)], "req": 3}},
+    {"method": "MGET", "args": {"keys": ["a", "b"], "from": ADDR}},
+    {"method": "MPUT_REP", "args": {"stored": ["a"], "failed": []}, "req": 3},
+    {"method": "MGET_REP", "args": {"found": {"a": 1, "b": None}, "missing": ["c"]}, "req": 4},
+]
+
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda msg: msg["method"])
+def test_round_trip(msg):
+    assert decode(encode(msg)) == msg
+    assert decode(bytearray(encode(msg))) == msg
+
+
+def test_smaller_than_pickle():
+    for msg in MESSAGES[:3] + MESSAGES[9:]:
+        assert len(encode(msg)) < len(pickle.dumps(msg))
+
+
+def test_unencodable():
+    with pytest.raises(CodecError):
+        encode({"method": "EXEC", "args": None})
+    with pytest.raises(CodecError):
+        encode({"method": "GET", "args": {"key": "k", "extra": 1}})
+    with pytest.raises(CodecError):
+        encode({"method": "GET", "args": {"from": ADDR}}) # no key
+    with pytest.raises(CodecError):
+        encode({"method": "PUT", "args": {"key": "k", "value": object()}})
+    with pytest.raises(CodecError):
+        encode({"method": "PUT", "args": {"key": "k", "value": {1, 2}}})
+    with pytest.raises(CodecError):
+        encode({"method": "JOIN_REQ", "args": {"addr": ADDR, "id": -1}})
+
+    nested = []
+    for _ in range(MAX_DEPTH + 1):
+        nested = [nested]
+    with pytest.raises(CodecError):
+        encode({"method": "PUT", "args": {"key": "k", "value": nested}})
+
+
+@pytest.mark.parametrize("addr", [("", 5000), ("localhost", 0), ("localhost", 1 << 16), ("localhost", True),
+                                  ("localhost", "5000"), (None, 5000), ("h" * 256, 5000), ("localhost",)])
+def test_invalid_address(addr):
+    with pytest.raises(CodecError):
+        encode({"method": "GET", "args": {"key": "k", "from": addr}})
+
+
+def test_invalid_address_decoded():
+    header = HEADER.pack(VERSION, 5, 1, 0b11) + b"\x01k" # GET k, from:
+    assert decode(header + b"\x01h" + PORT.pack(1))["args"]["from"] == ("h", 1)
+    with pytest.raises(CodecError):
+        decode(header + b"\x00" + PORT.pack(5000))
+    with pytest.raises(CodecError):
+        decode(header + b"\x01h" + PORT.pack(0))
+
+
+def test_malformed():
+    payload = encode({"method": "MPUT", "args": {"items": [("a", [1, "x"]), ("b", 2.5)], "from": ADDR}})
+
+    # Every truncation, and trailing bytes
+    for end in range(len(payload)):
+        with pytest.raises(CodecError):
+            decode(payload[:end])
+    with pytest.raises(CodecError):
+        decode(payload + b"\x00")
+
+    # Every single byte changed either decodes to plain values or is rejected
+    for i in range(len(payload)):
+        for byte in range(256):
+            try:
+                decode(payload[:i] + bytes([byte]) + payload[i + 1:])
+            except CodecError:
+                pass
+
+    with pytest.raises(CodecError):
+        decode(HEADER.pack(VERSION + 1, 1, 1, 0b11) + payload[HEADER.size:])
+    with pytest.raises(CodecError):
+        decode(HEADER.pack(VERSION, 200, 1, 0))
+    with pytest.raises(CodecError):
+        decode(HEADER.pack(VERSION, 5, 1, 0b10)) # GET without its key
+    with pytest.raises(CodecError):
+        decode(pickle.dumps({"method": "PREDECESSOR"}))
+
+    # A huge count does not allocate: it is checked against the datagram first
+    with pytest.raises(CodecError):
+        decode(HEADER.pack(VERSION, 15, 1, 0b1) + b"\xff\xff\xff\xff\x0f")
+
+    # Nesting is limited when decoding too
+    value = b"\x08\x01" * (MAX_DEPTH + 1) + b"\x08\x00"
+    with pytest.raises(CodecError):
+        decode(HEADER.pack(VERSION, 6, 1, 0b1) + bytes([len(value)]) + value)
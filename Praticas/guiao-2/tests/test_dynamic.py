@@ -118,3 +118,23 @@ def test_finger_table_used(client, node1, node2):
             assert client.put("f", "No sweat")  # dht_hash("f") = 921
             assert put1.call_count == 1
             assert put2.call_count == 0
+
+
+def test_iterative():
+    """ requests go straight to the owner once its segment is cached """
+    client = DHTClient(("localhost", 5000), iterative=True, timeout=2)
+    keys = [f"iterative-{i}" for i in range(20)]
+    for key in keys:
+        assert client.put(key, key.upper())
+    for key in keys:
+        assert client.get(key) == key.upper()
+
+    # One lookup per node, then every key is found in the cache
+    assert client.cache.misses == len(client.cache) <= 8
+    assert client.cache.hits == 2 * len(keys) - client.cache.misses
+
+    # A node that stopped answering is forgotten, the bootstrap node forwards
+    client.cache.add(0, 2 ** 10 - 1, ("localhost", 5999))
+    client.socket.settimeout(0.2)
+    assert client.get(keys[0]) == keys[0].upper()
+    assert len(client.cache) == 0
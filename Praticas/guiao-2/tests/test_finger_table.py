@@ -1,6 +1,9 @@
 """Tests finger table."""
-import pytest
+import random
+from bisect import bisect_left
+
 from DHTNode import FingerTable
+from utils import contains
 
 
 def test_finger_table():
@@ -40,3 +43,39 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_finger_table_large_ring():
+    node_id = 2**64 - 10
+    f = FingerTable(node_id, ("localhost", 5000), 64)
+
+    refresh = f.refresh()
+    assert len(refresh) == 64
+    assert refresh[-1][1] == (node_id + 2**63) % 2**64
+    for index, start, _ in refresh:
+        assert f.getIdxFromId(start) == index
+
+    # Exact near powers of two (a float log2 rounds 2**63 - 1 up to 63.0)
+    assert f.getIdxFromId((node_id + 2**63 - 1) % 2**64) == 63
+
+
+def test_finger_table_find_matches_scan():
+    """ Binary search agrees with the scan from the top on well formed tables. """
+    rng = random.Random(7)
+    for m_bits in (4, 10, 64):
+        maximum = 2 ** m_bits
+        for _ in range(50):
+            ring = sorted({rng.randrange(maximum) for _ in range(rng.randint(1, 20))})
+            node_id = rng.choice(ring)
+            f = FingerTable(node_id, ("localhost", node_id), m_bits)
+            for index, start, _ in f.refresh():
+                finger = ring[bisect_left(ring, start) % len(ring)]
+                f.update(index, finger, ("localhost", finger))
+
+            for key in [rng.randrange(maximum) for _ in range(50)] + ring:
+                expected = f.table[0][1]
+                for finger, address in reversed(f.table):
+                    if contains(finger, node_id, key):
+                        expected = address
+                        break
+                assert f.find(key) == expected
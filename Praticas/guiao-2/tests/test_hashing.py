@@ -0,0 +1,72 @@
+"""Tests the fast hashing against the original dht_hash."""
+import random
+import pytest
+import hashing
+from hashing import fnv1a, fnv1a_many
+from utils import dht_hash, dht_hash_many
+
+
+def reference_hash(text, seed=0, maximum=2**10):
+    """ Original dht_hash (exact big integer arithmetic). """
+    fnv_prime = 16777619
+    offset_basis = 2166136261
+    h = offset_basis + seed
+    for char in text:
+        h = h ^ ord(char)
+        h = h * fnv_prime
+    return h % maximum
+
+
+ALPHABETS = [
+    "0123456789",
+    "abcdefghijklmnopqrstuvwxyz(),' ",
+    "aáàãçéõü€✓",
+    "a\U0001F600\U00010000\x00￿",  # outside the BMP, NUL
+    "a\ud800\udfff\udc00",  # lone surrogates (e.g. keys decoded with surrogateescape)
+]
+MAXIMA = [2**10, 2**32, 2**64, 2**160, 1000, 3]
+
+
+def random_texts(rng, count):
+    texts = []
+    for _ in range(count):
+        alphabet = rng.choice(ALPHABETS)
+        texts.append("".join(rng.choice(alphabet) for _ in range(rng.randrange(0, 40))))
+    return texts
+
+
+def test_fnv1a_matches_reference():
+    rng = random.Random(1234)
+    texts = random_texts(rng, 300) + ["", str(("localhost", 5000)), "A", "2"]
+    for maximum in MAXIMA:
+        for seed in (0, 1, 2**40, -5):
+            for text in texts:
+                assert fnv1a(text, seed, maximum) == reference_hash(text, seed, maximum)
+
+
+def test_dht_hash_cached():
+    dht_hash.cache_clear()
+    assert dht_hash("d") == reference_hash("d") == 115
+    assert dht_hash("f") == 921
+    assert dht_hash("d") == 115
+    info = dht_hash.cache_info()
+    assert (info.hits, info.misses) == (1, 2)
+
+
+def test_fnv1a_many_fallback(monkeypatch):
+    monkeypatch.setattr(hashing, "np", None)
+    rng = random.Random(99)
+    texts = random_texts(rng, 200)
+    for maximum in MAXIMA:
+        assert fnv1a_many(texts, 7, maximum) == [reference_hash(t, 7, maximum) for t in texts]
+    assert fnv1a_many([]) == []
+
+
+def test_fnv1a_many_numpy():
+    pytest.importorskip("numpy")
+    rng = random.Random(4321)
+    texts = random_texts(rng, 1000) + ["", "", "x" * 200]
+    for maximum in MAXIMA:
+        for seed in (0, 3, -1):
+            assert dht_hash_many(texts, seed, maximum) == [reference_hash(t, seed, maximum) for t in texts]
+    assert dht_hash_many(iter(["A", "2"])) == [reference_hash("A"), reference_hash("2")]
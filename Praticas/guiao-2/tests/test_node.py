@@ -0,0 +1,102 @@
+"""Tests DHTNode handlers on their own (nodes not started)."""
+import socket
+import time
+
+import pytest
+
+from codec import encode, decode
+from DHTNode import DHTNode
+from utils import MAX_DATAGRAM
+
+
+@pytest.fixture
+def node():
+    node = DHTNode(("localhost", 7100))
+    yield node
+    node.socket.close()
+
+
+@pytest.fixture
+def peers():
+    """Two UDP sockets: a next hop and a client."""
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+    for sock in sockets:
+        sock.bind(("localhost", 0))
+        sock.settimeout(0.5)
+    yield sockets
+    for sock in sockets:
+        sock.close()
+
+
+def received(sock):
+    payloads = []
+    try:
+        while True:
+            payloads.append(sock.recvfrom(MAX_DATAGRAM)[0])
+    except socket.timeout:
+        return payloads
+
+
+def test_forward_split(node, peers):
+    hop, client = peers
+
+    # A client batch filling its datagram no longer fits once "from" is added
+    def size(items):
+        return len(encode({"method": "MPUT", "args": {"items": items, "req": 9}}))
+    items = [(f"k{i}", bytes(8000)) for i in range(8)]
+    items.append(("last", bytes(MAX_DATAGRAM - size(items + [("last", b"")]) - 4))) # 4: longer lengths
+    assert MAX_DATAGRAM - 8 < size(items) <= MAX_DATAGRAM
+
+    node.forward(hop.getsockname(), "MPUT", items, client.getsockname(), 9)
+    payloads = received(hop)
+    assert len(payloads) > 1
+    messages = [decode(payload) for payload in payloads]
+    assert [item for msg in messages for item in msg["args"]["items"]] == items
+    assert all(msg["args"]["from"] == client.getsockname() and msg["args"]["req"] == 9 for msg in messages)
+
+    node.forward(hop.getsockname(), "MGET", [f"key{i}" * 1000 for i in range(20)], client.getsockname(), 9)
+    assert sum(len(decode(payload)["args"]["keys"]) for payload in received(hop)) == 20
+
+
+def test_forward_too_large(node, peers):
+    hop, client = peers
+    node.forward(hop.getsockname(), "MPUT", [("big", bytes(MAX_DATAGRAM))], client.getsockname(), 4)
+    assert received(hop) == []
+    assert [decode(payload) for payload in received(client)] == [
+        {"method": "MPUT_REP", "args": {"stored": [], "failed": ["big"]}, "req": 4}]
+
+
+@pytest.fixture
+def running():
+    node = DHTNode(("localhost", 7101), timeout=2)
+    node.start()
+    while node.socket.getsockname()[1] == 0: # bound in run()
+        time.sleep(0.01)
+    yield node
+    node.done = True
+    node.join()
+    node.socket.close()
+
+
+def test_unresolvable_from(running, peers):
+    _, client = peers
+    running.predecessor_id = (running.identification + 1) % running.maximum # owns (about) every key
+    get = {"method": "GET", "args": {"key": "k", "from": ("no-such-host.invalid", 1), "req": 1}}
+    client.sendto(encode(get), running.addr)
+
+    # Still serving
+    get["args"].update({"from": client.getsockname(), "req": 2})
+    client.sendto(encode(get), running.addr)
+    assert [decode(payload) for payload in received(client)] == [{"method": "NACK", "req": 2}]
+    assert running.is_alive()
+
+
+def test_own_id_successor_rep(running, peers):
+    _, client = peers
+    table = list(running.finger_table.table)
+    reply = {"method": "SUCCESSOR_REP", "args": {
+        "req_id": running.identification, "successor_id": 1, "successor_addr": client.getsockname()}}
+    client.sendto(encode(reply), running.addr)
+    received(client)
+    assert running.finger_table.table == table
+    assert running.is_alive()
@@ -0,0 +1,63 @@
+"""Tests the client routing cache."""
+from routing import RoutingCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_routing_cache():
+    clock = Clock()
+    cache = RoutingCache(ttl=10, size=3, clock=clock)
+    assert cache.get(5) is None
+
+    cache.add(100, 200, "b")
+    cache.add(200, 300, "c")
+    cache.add(900, 100, "a") # wraps around the ring
+
+    assert cache.get(150) == "b"
+    assert cache.get(200) == "b"
+    assert cache.get(201) == "c"
+    assert cache.get(950) == "a"
+    assert cache.get(0) == "a"
+    assert cache.get(100) == "a"
+    assert cache.get(500) is None # between known segments
+    assert (cache.hits, cache.misses) == (6, 2)
+
+    # The oldest segment is evicted
+    cache.add(300, 400, "d")
+    assert len(cache) == 3
+    assert cache.get(150) is None
+    assert cache.get(350) == "d"
+
+    # Learned again: newest
+    cache.add(200, 300, "c")
+    cache.add(400, 500, "e")
+    assert cache.get(250) == "c"
+    assert cache.get(950) is None
+
+    cache.invalidate("c")
+    assert cache.get(250) is None
+    assert len(cache) == 2
+
+    # A node now owning a wider segment: the nodes cached in it are gone
+    cache.add(100, 400, "d2")
+    assert cache.get(350) == "d2"
+    assert cache.get(150) == "d2"
+    assert list(cache.segments) == [500, 400]
+
+    # Expiry
+    clock.now = 10
+    assert cache.get(350) is None
+    assert len(cache) == 1
+
+
+def test_routing_cache_lone_node():
+    cache = RoutingCache()
+    cache.add(42, 42, "a")
+    assert cache.get(42) == "a"
+    assert cache.get(7) == "a"
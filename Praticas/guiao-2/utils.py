@@ -1,12 +1,20 @@
-def dht_hash(text, seed=0, maximum=2**10):
-    """ FNV-1a Hash Function. """
-    fnv_prime = 16777619
-    offset_basis = 2166136261
-    h = offset_basis + seed
-    for char in text:
-        h = h ^ ord(char)
-        h = h * fnv_prime
-    return h % maximum
+from functools import lru_cache
+
+from hashing import fnv1a, fnv1a_many, CACHE_SIZE
+
+M_BITS = 10 # default identifier space of the ring: ids in [0, 2**M_BITS)
+MAX_DATAGRAM = 65507 # largest UDP payload (IPv4): room for batches of keys
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def dht_hash(text, seed=0, maximum=2**M_BITS):
+    """ FNV-1a Hash Function (cached, the same keys are hashed by every hop). """
+    return fnv1a(text, seed, maximum)
+
+
+def dht_hash_many(texts, seed=0, maximum=2**M_BITS):
+    """ FNV-1a Hash Function of many texts at once (see hashing.fnv1a_many). """
+    return fnv1a_many(texts, seed, maximum)
 
 
 def contains(begin, end, node):